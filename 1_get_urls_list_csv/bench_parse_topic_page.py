@@ -0,0 +1,84 @@
+"""
+topicページのリンク抽出のマイクロベンチマーク。
+従来の「リストのdivごとにdecode_contents()して再パースする」方式と、extract_listings()の1回だけパースする方式を、
+fixtures/*.html と(あれば)http_cache/に保存されたtopicページに対して比較する。
+結果が従来方式と一致するかも同時に確認する。ネットワークには一切アクセスしない。
+"""
+
+import time
+from pathlib import Path
+import gzip
+import sys
+from bs4 import BeautifulSoup
+from make_raw_urls_csv import extract_listings, safe_find_text, HTMLParser
+
+SCRIPT_DIR = Path(__file__).parent
+FIXTURE_DIR = SCRIPT_DIR / 'fixtures'
+CACHE_BLOB_DIR = SCRIPT_DIR / 'http_cache' / 'blobs'
+REPEAT = 20
+
+
+# 比較用の、変更前のscrape()と同じ再パース方式
+def extract_listings_reparse(html, url):
+    soup = BeautifulSoup(html, 'html.parser')
+    section = soup.find('section', class_='topic-container')
+    if not section:
+        return None
+    h1_text = safe_find_text(section, 'h1')
+    topic_children = soup.find('div', class_='topic-children')
+    if not topic_children:
+        return None
+    child_divs = topic_children.find_all('div', recursive=False)
+    content_list = [div.decode_contents() for div in child_divs] if child_divs else [topic_children.decode_contents()]
+    listings = []
+    for listing in content_list:
+        listing_soup = BeautifulSoup(listing, 'html.parser')
+        listings.append((safe_find_text(listing_soup, 'h2'), [a_tag.get('href') for a_tag in listing_soup.find_all('a')]))
+    return h1_text, listings
+
+
+def load_pages():
+    pages = [path.read_text(encoding='utf-8') for path in sorted(FIXTURE_DIR.glob('*.html'))]
+    for path in sorted(CACHE_BLOB_DIR.glob('*/*.html.gz')):
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            pages.append(file.read())
+    return pages
+
+
+def bench(name, func, pages):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        results = [func(html) for html in pages]
+    elapsed = time.perf_counter() - start
+    per_page = elapsed / (REPEAT * len(pages)) * 1000
+    print(f'{name:<24} {per_page:8.3f} ms/page')
+    return results, per_page
+
+
+def main():
+    pages = load_pages()
+    if not pages:
+        print(f'ベンチマーク用のhtmlが見つかりません: {FIXTURE_DIR}')
+        sys.exit(1)
+    print(f'{len(pages)}ページ x {REPEAT}回')
+
+    candidates = [('html.parser', lambda html: extract_listings(html, 'bench', 'html.parser'))]
+    try:
+        import lxml  # noqa: F401
+        candidates.append(('lxml', lambda html: extract_listings(html, 'bench', 'lxml')))
+    except ImportError:
+        print('lxmlがインストールされていないので飛ばします')
+    if HTMLParser is not None:
+        candidates.append(('selectolax', lambda html: extract_listings(html, 'bench', 'selectolax')))
+    else:
+        print('selectolaxがインストールされていないので飛ばします')
+
+    expected, baseline = bench('reparse (従来)', lambda html: extract_listings_reparse(html, 'bench'), pages)
+    for name, func in candidates:
+        results, per_page = bench(f'single-parse {name}', func, pages)
+        status = '一致' if results == expected else '不一致!'
+        print(f'{"":<24} x{baseline / per_page:.2f}  結果: {status}')
+
+
+if __name__ == "__main__":
+    main()
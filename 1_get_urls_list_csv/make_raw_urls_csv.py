@@ -12,13 +12,24 @@ import random
 import time
 import logging
 import csv
+import json
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 import requests
 from bs4 import BeautifulSoup
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:
+    HTMLParser = None
 import os
 import sys
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_root)
 import config as cfg
+from http_fetch import Fetcher, HostRateLimiter
+from http_cache import ResponseCache
+from url_canon import canonical_url
 
 # スクリプトのディレクトリを取得
 SCRIPT_DIR = Path(__file__).parent
@@ -28,6 +39,13 @@ TOPLEVEL_URLS_CSV = cfg.TOPLEVEL_URLS_CSV
 RAW_URLS_CSV = cfg.RAW_URLS_CSV
 ERROR_LOG = cfg.ERROR_LOG
 USER_AGENTS = cfg.USER_AGENTS
+CRAWL_WORKERS = cfg.CRAWL_WORKERS
+CRAWL_MIN_INTERVAL = cfg.CRAWL_MIN_INTERVAL
+HTTP_CACHE_ENABLED = cfg.HTTP_CACHE_ENABLED
+OFFLINE_MODE = cfg.OFFLINE_MODE
+HTML_PARSER = cfg.HTML_PARSER
+CRAWL_STATE_DB = cfg.CRAWL_STATE_DB
+CRAWL_RESUME = cfg.CRAWL_RESUME
 
 YOUTUBE_ANSWER_STRING = 'youtube/answer'
 YOUTUBE_TOPIC_STRING = 'youtube/topic'
@@ -49,6 +67,8 @@ HEADERS = {
 input_file = SCRIPT_DIR / TOPLEVEL_URLS_CSV
 output_file = SCRIPT_DIR / RAW_URLS_CSV
 log_file = SCRIPT_DIR / ERROR_LOG
+cache_dir = SCRIPT_DIR / 'http_cache'
+state_file = SCRIPT_DIR / CRAWL_STATE_DB
 
 # ロガーの設定
 logger = logging.getLogger(__name__)
@@ -61,8 +81,8 @@ handler1.setLevel(logging.DEBUG)
 handler1.setFormatter(formatter)
 logger.addHandler(handler1)
 
-# ハンドラ2: ファイル出力
-handler2 = logging.FileHandler(log_file)
+# ハンドラ2: ファイル出力。delay=Trueで最初に警告を書くときにファイルを開くので、importしただけではerror.logを作らない
+handler2 = logging.FileHandler(log_file, delay=True)
 handler2.setLevel(logging.WARNING)
 handler2.setFormatter(formatter)
 logger.addHandler(handler2)
@@ -99,106 +119,289 @@ def safe_find_text(soup, tag, class_=None):
 
 
 # aタグ中のurlには'https://www.google.com/'が付いてないので補完。また、言語設定をこの段ではとりあえず一律英語とする。
+# 表記の揺れ(スラッシュの重複やref_topicなど)はcanonical_url()で揃え、answerのurlは記事IDだけから組み立てる
 def modify_url(original_url):
     base_url = BASE_URL
     modified_url = base_url + original_url
 
     question_mark_index = modified_url.find('?')
     if question_mark_index != -1:
-        modified_url = modified_url[:question_mark_index] + '?hl=en'
-        return modified_url
+        return canonical_url(modified_url[:question_mark_index], 'en')
     else:
         logger.warning(f'このurlの中には?マークが見当たりませんのでリストに入れず飛ばします: {original_url}')
         return ""
 
 
-# メインとなる、スクレイピングをする関数
-def scrape(url, title="", depth=0):
-    if depth > MAX_RECURSION_DEPTH:
-        logger.warning(f'{depth}階層目に達したのでこのurl: {url} のスクレイピングを中断して次のurlに進みます')
-        return []
-    else:
-        logger.info(f'{depth}階層目をスクレイピングしています ***')
+# topicページのhtmlを1度だけパースし、(h1のテキスト, [(h2のテキスト, [aタグのhref, ...]), ...])を返す関数。
+# 各リストのdivを文字列に戻して再パースすることはせず、パース済みのツリーをそのまま辿る。解析できないページの場合はNone
+def extract_listings(html, url, parser=HTML_PARSER):
+    if parser == 'selectolax':
+        return extract_listings_selectolax(html, url)
 
-    final_list = []
-    try:
-        # 2.0 から 3.0 の間の浮動小数点数をランダムに生成してスリープ。claudeによると、もう少し長い時間を取っても良いとのこと
+    soup = BeautifulSoup(html, parser)
+
+    section = soup.find('section', class_='topic-container')
+    if section:
+        h1_text = safe_find_text(section, 'h1') # safe_find_textは自前の関数。
+    else:
+        #以下は特殊ケースで、top階層のurlが既にanswerのページだった場合の特別なハンドリング
+        logger.warning(f'このページ(top階層): {url}に存在するはずのsectionタグが見つかりません。つまりh1も見つかりませんでしたのでリストに入れず飛ばします')
+        return None
+
+    if h1_text == "":
+        logger.warning(f'このページ: {url}の上部にあるはずのタイトル(h1タグ要素)が見つかりませんでした')
+
+    topic_children = soup.find('div', class_='topic-children')
+    if not topic_children:
+        logger.warning(f'このページ(top階層): {url} には、存在するはずのリンクのリスト部(divタグ>topic-childrenクラス)が見つかりませんでしたのでリストに入れず飛ばします')
+        return None
+
+    # 直下のdivがない場合はtopic-children全体を1つのリストとして扱う
+    child_divs = topic_children.find_all('div', recursive=False) or [topic_children]
+    return h1_text, [(safe_find_text(div, 'h2'), [a_tag.get('href') for a_tag in div.find_all('a')]) for div in child_divs]
+
+
+# extract_listings()のselectolax版。cfg.HTML_PARSERが'selectolax'の場合に使われ、戻り値も同じ形
+def extract_listings_selectolax(html, url):
+    tree = HTMLParser(html)
+
+    section = tree.css_first('section.topic-container')
+    if section is None:
+        logger.warning(f'このページ(top階層): {url}に存在するはずのsectionタグが見つかりません。つまりh1も見つかりませんでしたのでリストに入れず飛ばします')
+        return None
+
+    h1 = section.css_first('h1')
+    h1_text = h1.text().strip() if h1 else ""
+    if h1_text == "":
+        logger.warning(f'このページ: {url}の上部にあるはずのタイトル(h1タグ要素)が見つかりませんでした')
+
+    topic_children = tree.css_first('div.topic-children')
+    if topic_children is None:
+        logger.warning(f'このページ(top階層): {url} には、存在するはずのリンクのリスト部(divタグ>topic-childrenクラス)が見つかりませんでしたのでリストに入れず飛ばします')
+        return None
+
+    child_divs = [node for node in topic_children.iter() if node.tag == 'div'] or [topic_children]
+    listings = []
+    for div in child_divs:
+        h2 = div.css_first('h2')
+        listings.append((h2.text().strip() if h2 else "", [a_tag.attributes.get('href') for a_tag in div.css('a')]))
+    return h1_text, listings
+
+
+# クロールの途中経過を保存しておくためのsqlite3のデータベース。
+# 取得済みのtopicページごとにextract_listings()の結果(親のtitleに依存しない部分)を保存しておき、
+# 同じページが複数の親から辿られても取得は1回で済ませる。中断後に再実行すると、保存済みのページは通信せずに辿り直され、
+# 未取得のページ(=フロンティア)から続きを取得する。runには出力ファイル名を入れ、別の出力ファイルの実行とは混ざらないようにする。
+# csvを最後まで書き込めた場合は途中経過を消すので、再開されるのは中断した実行だけになる
+class CrawlState:
+    MISSING = object()
+
+    def __init__(self, path, run):
+        self.run = run
+        self.hits = 0
+        self._lock = threading.Lock()
+        # ワーカースレッドからも使うので、ロックで守った上でcheck_same_thread=Falseにする
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS crawled_pages (
+            run TEXT,
+            url TEXT,
+            listings TEXT,
+            PRIMARY KEY (run, url)
+        )
+        ''')
+        self.conn.commit()
+
+    def count(self):
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM crawled_pages WHERE run = ?', (self.run,)).fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute('DELETE FROM crawled_pages WHERE run = ?', (self.run,))
+            self.conn.commit()
+
+    def get(self, url):
+        with self._lock:
+            row = self.conn.execute('SELECT listings FROM crawled_pages WHERE run = ? AND url = ?', (self.run, url)).fetchone()
+            if row is None:
+                return self.MISSING
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, url, extracted):
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO crawled_pages (run, url, listings) VALUES (?, ?, ?)',
+                              (self.run, url, json.dumps(extracted, ensure_ascii=False)))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+# topicページを取得してextract_listings()の結果を返す。CrawlStateに保存済みであれば通信しない
+def load_topic_page(url, fetcher, state, delay=False):
+    extracted = state.get(url)
+    if extracted is not CrawlState.MISSING:
+        return extracted
+
+    # 2.0 から 3.0 の間の浮動小数点数をランダムに生成してスリープ。claudeによると、もう少し長い時間を取っても良いとのこと
+    # オフラインモードではキャッシュから読むだけなので待たない
+    if delay and not OFFLINE_MODE:
         time.sleep(random.uniform(2, 3))
 
-        response = requests.get(url, headers=HEADERS)
+    # 一時的なエラーはfetcherの中でリトライされ、それでも失敗した場合やステータスコードが400以上の場合は例外が発生する
+    html = fetcher.get_text(url)
+    extracted = extract_listings(html, url)
+    state.put(url, extracted)
+    return extracted
 
-        # HTTP ステータスコードが 400 以上（クライアントエラーまたはサーバーエラー）の場合、例外を発生させるメソッド
-        # これによりコードを簡潔に保ちつつ、明示的にステータスコードをチェックする必要がなくなる
-        response.raise_for_status()
 
-        soup = BeautifulSoup(response.text, 'html.parser')
+# extract_listings()の結果から、ページ内のリンクを(種類, full_title, url)のリストとして組み立てる関数。
+# 種類は'answer'か'topic'。解析できなかったページの場合は空のリストを返す。
+def build_links(extracted, url, title=""):
+    if extracted is None:
+        return []
+    h1_text, listings = extracted
 
-        section = soup.find('section', class_='topic-container')
-        if section:
-            h1_text = safe_find_text(section, 'h1') # safe_find_textは自前の関数。
+    links = []
+    for mid_title, hrefs in listings:
+        if mid_title:
+            full_title = f"{title}__{h1_text}__{mid_title}" if title else f"{h1_text}__{mid_title}"
         else:
-            #以下は特殊ケースで、top階層のurlが既にanswerのページだった場合の特別なハンドリング
-            logger.warning(f'このページ(top階層): {url}に存在するはずのsectionタグが見つかりません。つまりh1も見つかりませんでしたのでリストに入れず飛ばします')
-            return []
+            full_title = f"{title}__{h1_text}" if title else f"{h1_text}"
+
+        if hrefs:
+            for href in hrefs:
+                link_url = href.strip()
+                modified_url = modify_url(link_url)
+                if modified_url == "":
+                     continue
+                elif YOUTUBE_ANSWER_STRING in modified_url:
+                    links.append(('answer', full_title, modified_url))
+                elif YOUTUBE_TOPIC_STRING in modified_url:
+                    links.append(('topic', full_title, modified_url))
+                else:
+                    logger.warning(f'*** このページ: {link_url} は、topicページでもanswerページでもないようなので、リストに入れず飛ばします ***')
+                    continue
+        else:
+            logger.warning(f'このページ: {url}の特定サブカテゴリー{mid_title}内にあるはずのリンク(aタグ)が一つも見つかりませんでした')
 
-        if h1_text == "":
-            logger.warning(f'このページ: {url}の上部にあるはずのタイトル(h1タグ要素)が見つかりませんでした')
+    return links
 
-        topic_children = soup.find('div', class_='topic-children')
 
-        content_list = []
-        if topic_children:
-            child_divs = topic_children.find_all('div', recursive=False)
-            # decode_contents()は、タグとその子要素の内容を、Unicode文字列としてタグがある状態で返します。
-            content_list = [div.decode_contents() for div in child_divs] if child_divs else [topic_children.decode_contents()]
-        else:
-            logger.warning(f'このページ(top階層): {url} には、存在するはずのリンクのリスト部(divタグ>topic-childrenクラス)が見つかりませんでしたのでリストに入れず飛ばします')
-            return []
+# メインとなる、スクレイピングをする関数(CRAWL_WORKERSが0の場合に使う、1ページずつ取得する従来版)
+def scrape(url, fetcher, state, title="", depth=0):
+    if depth > MAX_RECURSION_DEPTH:
+        logger.warning(f'{depth}階層目に達したのでこのurl: {url} のスクレイピングを中断して次のurlに進みます')
+        return []
+    else:
+        logger.info(f'{depth}階層目をスクレイピングしています ***')
 
-        for listing in content_list:
-            listing_soup = BeautifulSoup(listing, 'html.parser')
-            mid_title = safe_find_text(listing_soup, 'h2')
-            if mid_title:
-                full_title = f"{title}__{h1_text}__{mid_title}" if title else f"{h1_text}__{mid_title}"
-            else:
-                full_title = f"{title}__{h1_text}" if title else f"{h1_text}"
-
-            a_tags = listing_soup.find_all('a', recursive=True)
-            if a_tags:
-                for a_tag in a_tags:
-                    link_url = a_tag.get('href').strip()
-                    modified_url = modify_url(link_url)
-                    if modified_url == "":
-                         continue
-                    elif YOUTUBE_ANSWER_STRING in modified_url:
-                        final_list.append({ full_title : modified_url })
-                    elif YOUTUBE_TOPIC_STRING in modified_url: # ここで再起処理に入る
-                        final_list.extend(scrape(modified_url, full_title, depth + 1))
-                    else:
-                        logger.warning(f'*** このページ: {link_url} は、topicページでもanswerページでもないようなので、リストに入れず飛ばします ***')
-                        continue
-            else:
-                logger.warning(f'このページ: {url}の特定サブカテゴリー{mid_title}内にあるはずのリンク(aタグ)が一つも見つかりませんでした')
+    final_list = []
+    try:
+        extracted = load_topic_page(url, fetcher, state, delay=True)
+
+        for kind, full_title, modified_url in build_links(extracted, url, title):
+            if kind == 'answer':
+                final_list.append({ full_title : modified_url })
+            else: # ここで再起処理に入る
+                final_list.extend(scrape(modified_url, fetcher, state, full_title, depth + 1))
 
         return final_list
 
+    # リトライしても取得できなかったページはerror.logに記録し、その配下だけを飛ばしてクロールを続ける
     except requests.exceptions.HTTPError as err:
-        logger.error(f"HTTP エラーが発生しました: {err}")
-        sys.exit(1)
+        logger.error(f"HTTP エラーが発生しました。このページの配下は飛ばします: {url} {err}")
+        return []
     except requests.exceptions.ConnectionError as err:
-        logger.error(f"接続エラーが発生しました: {err}")
-        sys.exit(1)
+        logger.error(f"接続エラーが発生しました。このページの配下は飛ばします: {url} {err}")
+        return []
     except requests.exceptions.Timeout as err:
-        logger.error(f"タイムアウトエラーが発生しました: {err}")
-        sys.exit(1)
+        logger.error(f"タイムアウトエラーが発生しました。このページの配下は飛ばします: {url} {err}")
+        return []
     except requests.exceptions.RequestException as err:
-        logger.error(f"その他のリクエストエラーが発生しました: {err}")
-        sys.exit(1)
-    except (requests.RequestException, Exception) as e:
+        logger.error(f"その他のリクエストエラーが発生しました。このページの配下は飛ばします: {url} {err}")
+        return []
+    except Exception as e:
         logger.error("Error scraping %s: %s", url, str(e))
         sys.exit(1)
 
 
+# topicページのフロンティアを複数ワーカーで並行して取得するクローラー。
+# 各ページの結果は「answerの辞書」と「子topicページのFuture」を元の順序で並べたリストになっていて、
+# メインスレッドでそれを深さ優先に展開することで、再帰版scrape()と全く同じ順序とfull_titleを得る
+class ConcurrentCrawler:
+    def __init__(self, fetcher, state, workers):
+        self.fetcher = fetcher
+        self.state = state
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # 取得中・取得済みのurlとその結果のFuture。同じページを同時に複数のワーカーが取得しないようにする
+        self._loads = {}
+        self._loads_lock = threading.Lock()
+
+    def submit(self, url, title="", depth=0):
+        return self.executor.submit(self._crawl_page, url, title, depth)
+
+    def _load(self, url):
+        with self._loads_lock:
+            future = self._loads.get(url)
+            is_owner = future is None
+            if is_owner:
+                future = self._loads[url] = Future()
+        if not is_owner:
+            return future.result()
+
+        try:
+            extracted = load_topic_page(url, self.fetcher, self.state)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        future.set_result(extracted)
+        return extracted
+
+    def _crawl_page(self, url, title, depth):
+        if depth > MAX_RECURSION_DEPTH:
+            logger.warning(f'{depth}階層目に達したのでこのurl: {url} のスクレイピングを中断して次のurlに進みます')
+            return []
+        else:
+            logger.info(f'{depth}階層目をスクレイピングしています *** {url}')
+
+        try:
+            extracted = self._load(url)
+        except requests.exceptions.RequestException as err:
+            # リトライしても取得できなかったページはerror.logに記録し、その配下だけを飛ばしてクロールを続ける
+            logger.error(f"リクエストエラーが発生しました。このページの配下は飛ばします: {url} {err}")
+            return []
+
+        items = []
+        for kind, full_title, modified_url in build_links(extracted, url, title):
+            if kind == 'answer':
+                items.append({ full_title : modified_url })
+            else: # 子topicページはすぐにフロンティアに入れ、結果はFutureとして順序を保ったまま持っておく
+                items.append(self.submit(modified_url, full_title, depth + 1))
+        return items
+
+    def iter_results(self, future):
+        for item in future.result():
+            if isinstance(item, Future):
+                yield from self.iter_results(item)
+            else:
+                yield item
+
+    def crawl(self, urls):
+        try:
+            roots = [self.submit(url) for url in urls]
+            for url, root in zip(urls, roots):
+                logger.info(f'***Topレベルurlからスクレイピングを開始しています : {url} ***')
+                yield from self.iter_results(root)
+                print('----------------------------------------')
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# dic_listにはジェネレーターも渡せる。見つかった行から順に書き込み、都度flushするので途中で落ちてもそこまでの行は残る
 def create_csv(dic_list):
     try:
         # newline='' は、改行の取り扱いに関するオプション。newline='' だとPythonが行末の改行コードをそのまま使い、追加の改行コードを挿入しない
@@ -207,6 +410,7 @@ def create_csv(dic_list):
             for dic in dic_list:
                 for key, value in dic.items():
                     writer.writerow([key, value])
+                file.flush()
 
         logger.info(f'CSVファイル "{output_file}" が正常に作成されました。')
 
@@ -222,20 +426,54 @@ def create_csv(dic_list):
 
 
 def main():
+    if HTML_PARSER == 'selectolax' and HTMLParser is None:
+        logger.critical("cfg.HTML_PARSERに'selectolax'が指定されていますが、selectolaxがインストールされていません。")
+        sys.exit(1)
+
     urls = read_urls_from_csv()
     if not urls:
         logger.critical("ファイルにURLが一つも含まれていません。")
         sys.exit(1)
 
-    article_list = []
-    for url in urls:
-        logger.info(f'***Topレベルurlからスクレイピングを開始しています : {url} ***')
-        result = scrape(url, "")
-        article_list.extend(result)
-        print('----------------------------------------')
+    if OFFLINE_MODE:
+        logger.info('オフラインモードです。キャッシュだけを使って実行します')
+    cache = ResponseCache(cache_dir) if HTTP_CACHE_ENABLED or OFFLINE_MODE else None
+
+    state = CrawlState(state_file, RAW_URLS_CSV)
+    if not CRAWL_RESUME:
+        state.clear()
+    resumed = state.count()
+    if resumed:
+        logger.info(f'前回の途中経過が{resumed}ページ分見つかりました。取得済みのページは通信せずに続きから実行します')
+
+    if CRAWL_WORKERS > 0:
+        fetcher = Fetcher(HEADERS, pool_size=CRAWL_WORKERS, rate_limiter=HostRateLimiter(CRAWL_MIN_INTERVAL),
+                          cache=cache, offline=OFFLINE_MODE)
+        crawler = ConcurrentCrawler(fetcher, state, CRAWL_WORKERS)
+        rows = crawler.crawl(urls)
+    else:
+        fetcher = Fetcher(HEADERS, pool_size=1, cache=cache, offline=OFFLINE_MODE)
+
+        def iter_rows():
+            for url in urls:
+                logger.info(f'***Topレベルurlからスクレイピングを開始しています : {url} ***')
+                yield from scrape(url, fetcher, state, "")
+                print('----------------------------------------')
+
+        rows = iter_rows()
 
-    create_csv(article_list)
-    logger.info(f'このurlとその子url全てのスクレイピングが終了しました {url}')
+    # 行は見つかった順にcsvへ書き込まれていく
+    try:
+        create_csv(rows)
+        # 最後まで終わったので途中経過は消す。残しておくと、次の実行が通信せずに古い結果をそのまま書き出してしまう
+        state.clear()
+    finally:
+        fetcher.close()
+        state.close()
+
+    stats = fetcher.stats
+    logger.info(f"途中経過から再利用 {state.hits}ページ, キャッシュ: 通信なし {stats['fresh']}件, 304 {stats['not_modified']}件, 新規取得 {stats['fetched']}件")
+    logger.info(f'全てのTopレベルurlとその子url全てのスクレイピングが終了しました')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,70 @@
+"""
+delete_duplicated_urls.pyの重複除去方式のベンチマーク。
+合成したcsv(デフォルトで300万行)を一時ディレクトリに作り、各方式を別プロセスで実行して、
+処理時間と最大メモリ使用量(ru_maxrss)を比べ、出力が'memory'方式と一致するかを確認する。
+
+python bench_dedupe.py [行数] [urlの種類数]
+"""
+
+import csv
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).parent
+DEFAULT_ROWS = 3_000_000
+DEFAULT_UNIQUE_URLS = 1_000_000
+
+
+def make_synthetic_csv(path, rows, unique_urls):
+    rng = random.Random(0)
+    with path.open('w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        for _ in range(rows):
+            answer_id = rng.randrange(unique_urls)
+            writer.writerow([f'Category {answer_id % 97}__Sub {answer_id % 13}',
+                             f'https://support.google.com//youtube/answer/{answer_id}?hl=en'])
+
+
+# 子プロセスとして1つの方式だけを実行し、時間とメモリを出力する
+def run_child(mode, input_path, output_path):
+    sys.path.insert(0, str(SCRIPT_DIR))
+    import delete_duplicated_urls as dedupe
+    dedupe.logger.setLevel('WARNING') # 'memory'方式は重複ごとにログを出すので抑える
+    start = time.perf_counter()
+    dedupe.DEDUPE_FUNCTIONS[mode](Path(input_path), Path(output_path))
+    elapsed = time.perf_counter() - start
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'{elapsed:.2f} {max_rss_mb:.1f}')
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ROWS
+    unique_urls = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_UNIQUE_URLS
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        input_path = temp_dir / 'raw.csv'
+        make_synthetic_csv(input_path, rows, unique_urls)
+        print(f'{rows}行 (urlの種類 最大{unique_urls}) {input_path.stat().st_size / 1024 / 1024:.0f}MB')
+
+        outputs = {}
+        for mode in ['memory', 'two_pass', 'partitioned']:
+            output_path = temp_dir / f'{mode}.csv'
+            result = subprocess.run([sys.executable, __file__, '--child', mode, str(input_path), str(output_path)],
+                                    capture_output=True, text=True, check=True)
+            elapsed, max_rss_mb = result.stdout.split()
+            outputs[mode] = output_path.read_bytes()
+            status = '一致' if outputs[mode] == outputs['memory'] else '不一致!'
+            print(f'{mode:<12} {float(elapsed):7.2f}秒  最大メモリ {float(max_rss_mb):8.1f}MB  出力: {status}')
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        run_child(*sys.argv[2:5])
+    else:
+        main()
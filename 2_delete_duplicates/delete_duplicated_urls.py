@@ -2,23 +2,40 @@
 1で作った(cfg.RAW_URLS_CSV)をこのスクリプトの階層に同名でコピーして、このスクリプトを実行。
 cvsのリストの後ろから順に調べていって、除外する。
 結果として850行の重複のないurlリスト(cfg.CLEANED_URLS_CSV)が出力される
+cfg.DEDUPE_MODEで、全行をメモリに読み込む従来の方式('memory')の他に、
+ファイルを2回読むだけでメモリがurlの種類数にしか比例しない方式('two_pass')と、
+urlのハッシュでいくつかの一時ファイルに分けてから処理し、メモリに収まらない大きさの入力にも対応する方式('partitioned')を選べる。
+どの方式でも「同じurlは最後に出てきた行を残し、元の順序を保つ」という結果は同じになる。
+重複の判定はurl_canon.dedupe_key()で行い、answerのurlは記事IDが同じであれば表記が違っても同じ記事とみなす。
+出力するurlはcanonical_url()で正規化した形になる。どの方式でも、除いた重複の行数と、そのうち正規化によって除けた重複の数を報告する。
+cfg.DELTA_MODEがTrueの場合は、さらに前回のurlリスト(cfg.PREVIOUS_CLEANED_URLS_CSV)と比べて、
+追加(_added)・削除(_removed)・継続(_retained)の3つのcsvをcfg.CLEANED_URLS_CSVと同じ名前の後ろに付けて出力する。
 '''
 
 import csv
+import heapq
 import os
+import tempfile
+import zlib
 import sys
 import logging
 from pathlib import Path
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_root)
 import config as cfg
+from url_canon import canonical_url, dedupe_key
 
 RAW_URLS_CSV = cfg.RAW_URLS_CSV
 CLEANED_URLS_CSV = cfg.CLEANED_URLS_CSV
+DEDUPE_MODE = cfg.DEDUPE_MODE
+DEDUPE_PARTITIONS = cfg.DEDUPE_PARTITIONS
+DELTA_MODE = cfg.DELTA_MODE
+PREVIOUS_CLEANED_URLS_CSV = cfg.PREVIOUS_CLEANED_URLS_CSV
 
 current_dir = Path(__file__).parent
 input_path = current_dir / RAW_URLS_CSV
 output_path = current_dir / CLEANED_URLS_CSV
+previous_path = current_dir / PREVIOUS_CLEANED_URLS_CSV
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -39,25 +56,161 @@ def write_csv(output_path, rows):
         writer = csv.writer(file)
         writer.writerows(rows)
 
+# urlを正規化した行を返す
+def canonical_row(row):
+    return [row[0], canonical_url(row[1])] + row[2:]
+
+
+# 正規化によって、元の表記のままでは見つけられなかった重複をいくつ除けたかを報告する。
+# exact_url_countは元の表記のurlの種類数、key_countは正規化後のキーの種類数
+def report_canonical_savings(exact_url_count, key_count):
+    saved = exact_url_count - key_count
+    logger.info(f'urlの表記の揺れを正規化したことで、さらに{saved}件の重複を除きました。'
+                f'3のスクレイピング(ページの取得と保存)が{saved}回、4のチャンク分割と5のembeddingが{saved}記事分少なくなります')
+    return saved
+
+
 def process_rows(rows):
+    seen_keys = set()
     seen_urls = set()
     unique_rows = []
+    duplicates = 0
     for row in reversed(rows):
         if len(row) > 1:
             url = row[1]
-            if url not in seen_urls:
-                seen_urls.add(url)
-                unique_rows.append(row) # Claudeによると、大規模なcsvの場合メモリ節約のため、この部分をgeneratorにしてもいいとの事。
+            seen_urls.add(url)
+            key = dedupe_key(url)
+            if key not in seen_keys:
+                seen_keys.add(key)
+                unique_rows.append(canonical_row(row)) # Claudeによると、大規模なcsvの場合メモリ節約のため、この部分をgeneratorにしてもいいとの事。
             else:
                 logger.info(f'このurlは重複しているため、新しいファイルには含めません: {url}')
+                duplicates += 1
+    logger.info(f'重複していた{duplicates}行を除きました')
+    report_canonical_savings(len(seen_urls), len(seen_keys))
     return list(reversed(unique_rows))
 
 
+def dedupe_in_memory(input_path, output_path):
+    rows = read_csv(input_path)
+    processed_rows = process_rows(rows)
+    write_csv(output_path, processed_rows)
+
+
+# 1行ずつ読み込むジェネレーター
+def iter_csv(input_path):
+    with input_path.open('r', newline='', encoding='utf-8') as file:
+        yield from csv.reader(file)
+
+
+# 1回目でurlごとに最後に出てくる行番号を調べ、2回目でその行だけを書き出す
+def dedupe_two_pass(input_path, output_path):
+    last_index = {}
+    exact_urls = set() # 正規化で除けた重複の数を報告するためだけに使う。メモリはlast_indexと同じくurlの種類数に比例する
+    for i, row in enumerate(iter_csv(input_path)):
+        if len(row) > 1:
+            last_index[dedupe_key(row[1])] = i
+            exact_urls.add(row[1])
+
+    duplicates = 0
+    with output_path.open('w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        for i, row in enumerate(iter_csv(input_path)):
+            if len(row) > 1:
+                if last_index[dedupe_key(row[1])] == i:
+                    writer.writerow(canonical_row(row))
+                else:
+                    duplicates += 1
+    logger.info(f'重複していた{duplicates}行を除きました')
+    report_canonical_savings(len(exact_urls), len(last_index))
+
+
+# urlのハッシュ値で行をpartitions個の一時ファイルに振り分け(同じurlは必ず同じファイルに入る)、
+# ファイルごとに重複を除いて行番号順に並べ直した後、全ファイルを行番号でマージして書き出す。
+# 一度にメモリに載るのは1つのファイル分だけになる
+def dedupe_partitioned(input_path, output_path, partitions=DEDUPE_PARTITIONS):
+    with tempfile.TemporaryDirectory(dir=output_path.parent) as temp_dir:
+        temp_dir = Path(temp_dir)
+        partition_paths = [temp_dir / f'partition_{n}.csv' for n in range(partitions)]
+        files = [path.open('w', newline='', encoding='utf-8') for path in partition_paths]
+        try:
+            writers = [csv.writer(file) for file in files]
+            for i, row in enumerate(iter_csv(input_path)):
+                if len(row) > 1:
+                    # 正規化後のキーで振り分けるので、同じ記事の行は表記が違っても同じファイルに入る
+                    writers[zlib.crc32(dedupe_key(row[1]).encode('utf-8')) % partitions].writerow([i] + row)
+        finally:
+            for file in files:
+                file.close()
+
+        duplicates = 0
+        exact_url_count = 0
+        key_count = 0
+        sorted_paths = []
+        for path in partition_paths:
+            last_rows = {}
+            exact_urls = set() # 同じキーのurlは全て同じファイルに入るので、表記の種類数もファイルごとに数えて足せばよい
+            for indexed_row in iter_csv(path):
+                key = dedupe_key(indexed_row[2])
+                if key in last_rows:
+                    duplicates += 1
+                last_rows[key] = indexed_row
+                exact_urls.add(indexed_row[2])
+            exact_url_count += len(exact_urls)
+            key_count += len(last_rows)
+            sorted_path = path.with_suffix('.sorted.csv')
+            write_csv(sorted_path, sorted(last_rows.values(), key=lambda indexed_row: int(indexed_row[0])))
+            sorted_paths.append(sorted_path)
+            path.unlink()
+
+        streams = [iter_csv(path) for path in sorted_paths]
+        with output_path.open('w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            for indexed_row in heapq.merge(*streams, key=lambda indexed_row: int(indexed_row[0])):
+                writer.writerow(canonical_row(indexed_row[1:]))
+    logger.info(f'重複していた{duplicates}行を除きました')
+    report_canonical_savings(exact_url_count, key_count)
+
+
+# 前回と今回のurlリストを記事ごと(dedupe_key)に比べ、追加・削除・継続の3つのcsvを書き出す。
+# どちらのファイルも重複除去済みなので、キーの集合だけをメモリに持ち、行は流しながら書き出す
+def write_delta(previous_path, current_path):
+    previous_keys = {dedupe_key(row[1]) for row in iter_csv(previous_path) if len(row) > 1}
+    current_keys = {dedupe_key(row[1]) for row in iter_csv(current_path) if len(row) > 1}
+
+    delta_paths = {name: current_path.with_name(f'{current_path.stem}_{name}.csv') for name in ['added', 'removed', 'retained']}
+    with delta_paths['added'].open('w', newline='', encoding='utf-8') as added_file, \
+         delta_paths['retained'].open('w', newline='', encoding='utf-8') as retained_file:
+        added_writer = csv.writer(added_file)
+        retained_writer = csv.writer(retained_file)
+        for row in iter_csv(current_path):
+            if len(row) > 1:
+                (retained_writer if dedupe_key(row[1]) in previous_keys else added_writer).writerow(row)
+    with delta_paths['removed'].open('w', newline='', encoding='utf-8') as removed_file:
+        removed_writer = csv.writer(removed_file)
+        for row in iter_csv(previous_path):
+            if len(row) > 1 and dedupe_key(row[1]) not in current_keys:
+                removed_writer.writerow(canonical_row(row))
+
+    added = len(current_keys - previous_keys)
+    removed = len(previous_keys - current_keys)
+    logger.info(f'前回({previous_path.name})との差分: 追加 {added}件, 削除 {removed}件, 継続 {len(current_keys) - added}件')
+
+
+DEDUPE_FUNCTIONS = {
+    'memory': dedupe_in_memory,
+    'two_pass': dedupe_two_pass,
+    'partitioned': dedupe_partitioned,
+}
+
+
 def main():
     try:
-        rows = read_csv(input_path)
-        processed_rows = process_rows(rows)
-        write_csv(output_path, processed_rows)
+        if DEDUPE_MODE not in DEDUPE_FUNCTIONS:
+            raise ValueError(f'cfg.DEDUPE_MODEの値が不正です: {DEDUPE_MODE}')
+        DEDUPE_FUNCTIONS[DEDUPE_MODE](input_path, output_path)
+        if DELTA_MODE:
+            write_delta(previous_path, output_path)
 
         logger.debug(f"処理が完了しました。結果は {output_path} に保存されました。")
 
@@ -0,0 +1,121 @@
+"""
+1つの長寿命なChromiumを起動しておき、そのタブ(page)を使い回してページを描画するためのプール。
+同時に開くタブの数はセマフォで制限する。エラーになったタブは閉じて作り直し、
+ブラウザ自体が落ちていれば起動し直す。またrestart_everyページごとに新しいブラウザに切り替え、
+古いブラウザは使用中のタブがなくなった時点で閉じることで、メモリの増加を抑える。
+page_setupを渡すと、新しいタブを作るたびにそのタブを引数として呼ばれる(リクエストのインターセプトの設定など)。
+"""
+
+import asyncio
+import logging
+import random
+from pyppeteer import launch
+
+logger = logging.getLogger(__name__)
+
+LAUNCH_ARGS = ['--no-sandbox', '--disable-setuid-sandbox']
+
+
+class _BrowserGeneration:
+    def __init__(self, browser):
+        self.browser = browser
+        self.idle_pages = []
+        self.active = 0
+        self.retired = False
+
+    def is_alive(self):
+        process = self.browser.process
+        return process is None or process.poll() is None
+
+
+class BrowserPool:
+    def __init__(self, concurrency, restart_every, user_agents, page_setup=None):
+        self.concurrency = concurrency
+        self.restart_every = restart_every
+        self.user_agents = user_agents
+        self.page_setup = page_setup
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rendered_count = 0
+        self._current = None
+        self._pages_on_current = 0
+        self._lock = asyncio.Lock()
+
+    async def _launch(self):
+        browser = await launch(headless=True, args=LAUNCH_ARGS)
+        logger.info('Chromiumを起動しました')
+        return _BrowserGeneration(browser)
+
+    async def _close_generation(self, generation):
+        for page in generation.idle_pages:
+            await self._close_page(page)
+        generation.idle_pages = []
+        try:
+            await generation.browser.close()
+        except Exception as e:
+            logger.warning(f'ブラウザを閉じる際にエラーが発生しました: {e}')
+
+    async def _close_page(self, page):
+        try:
+            await page.close()
+        except Exception:
+            pass
+
+    async def _checkout(self):
+        async with self._lock:
+            # 一定ページ数ごと、またはブラウザが落ちている場合は新しいブラウザに切り替える
+            if self._current is None or not self._current.is_alive() or self._pages_on_current >= self.restart_every:
+                if self._current is not None:
+                    old = self._current
+                    old.retired = True
+                    logger.info(f'{self._pages_on_current}ページを描画したのでChromiumを起動し直します' if old.is_alive() else 'Chromiumが落ちているので起動し直します')
+                    if old.active == 0:
+                        await self._close_generation(old)
+                self._current = await self._launch()
+                self._pages_on_current = 0
+
+            generation = self._current
+            self._pages_on_current += 1
+            generation.active += 1
+            page = generation.idle_pages.pop() if generation.idle_pages else None
+
+        if page is None:
+            try:
+                page = await generation.browser.newPage()
+                await page.setUserAgent(random.choice(self.user_agents))
+                if self.page_setup:
+                    await self.page_setup(page)
+            except BaseException:
+                await self._checkin(generation, None)
+                raise
+        return generation, page
+
+    async def _checkin(self, generation, page, broken=False):
+        async with self._lock:
+            generation.active -= 1
+            if page is not None:
+                if broken or generation.retired or page.isClosed():
+                    await self._close_page(page)
+                else:
+                    generation.idle_pages.append(page)
+            if generation.retired and generation.active == 0:
+                await self._close_generation(generation)
+
+    # render_fn(page, url)をプールのタブで実行して、その戻り値を返す。
+    # 例外が発生した場合は、そのタブを閉じてから例外をそのまま投げる(次回は新しいタブが使われる)
+    async def render(self, url, render_fn):
+        async with self.semaphore:
+            generation, page = await self._checkout()
+            try:
+                result = await render_fn(page, url)
+            except BaseException:
+                await self._checkin(generation, page, broken=True)
+                raise
+            await self._checkin(generation, page)
+            self.rendered_count += 1
+            return result
+
+    async def close(self):
+        async with self._lock:
+            if self._current is not None:
+                await self._close_generation(self._current)
+                self._current = None
@@ -1,6 +1,10 @@
 """
 新規でデータベースファイルを作る、または新しいテーブルを作る。
 データベースは一度作ってあるので(cfg.SQLITE_PATH)、主に後者の目的で使うことになる。韓国語版、英語版のテーブルなど。。
+cfg.LANGUAGESを指定している場合は、全言語共通のcfg.ARTICLES_TABLE_NAMEも作る。
+テーブルが既にある場合は、language列と(reference_url, language)のユニークインデックスを追加する(古い形のテーブルの移行)。
+cfg.NORMALIZED_STORAGEがTrueの場合はテーブルの代わりに、正規化したスキーマ(content_store.py)と、上記のテーブル名のviewを作る。
+既存の従来の形式のテーブルを正規化したスキーマに移すにはmigrate_to_normalized_schema.pyを使う。
 """
 
 import sqlite3
@@ -9,37 +13,79 @@ import sys
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_root)
 import config as cfg
+import content_store
+from sqlite_writer import prepare_article_table, prepare_localized_table
 
 SQLITE_PATH = cfg.SQLITE_PATH
 SQLITE_TABLE_NAME = cfg.SQLITE_TABLE_NAME
+LANGUAGE = cfg.LANGUAGE
+LANGUAGES = cfg.LANGUAGES
+ARTICLES_TABLE_NAME = cfg.ARTICLES_TABLE_NAME
+NORMALIZED_STORAGE = cfg.NORMALIZED_STORAGE
 
-# データベースファイルを開く（存在しない場合は作成）
-try:
-    conn = sqlite3.connect(f'{SQLITE_PATH}')
-    print("Connected to the database.")
 
+# 正規化したスキーマと、スナップショットごとのviewを作る
+def create_normalized_views(conn):
+    content_store.prepare_schema(conn)
+    for snapshot in [SQLITE_TABLE_NAME] + ([ARTICLES_TABLE_NAME] if LANGUAGES else []):
+        if content_store.object_type(conn, snapshot) == 'table':
+            print(f"{snapshot} is a legacy table. Run migrate_to_normalized_schema.py to move it.")
+        else:
+            content_store.create_snapshot_view(conn, snapshot)
+            print(f"View {snapshot} created.")
+
+
+# 従来の形式のテーブルを作る
+def create_tables(conn):
     # カーソルオブジェクトを作成
     cursor = conn.cursor()
 
     # テーブルを作成
     cursor.execute(f'''
-    CREATE TABLE {SQLITE_TABLE_NAME} (
+    CREATE TABLE IF NOT EXISTS {SQLITE_TABLE_NAME} (
         id INTEGER PRIMARY KEY,
         category TEXT,
         reference_url TEXT,
-        content TEXT
+        content TEXT,
+        language TEXT
     )
     ''')
+    # 既存のテーブルの場合はlanguage列を追加し、upsert用のユニークインデックスを作る
+    prepare_article_table(conn, SQLITE_TABLE_NAME, LANGUAGE)
     print("Table created.")
 
+    if LANGUAGES:
+        prepare_localized_table(conn, ARTICLES_TABLE_NAME)
+        print(f"Table {ARTICLES_TABLE_NAME} created.")
+
     # 変更をコミット
     conn.commit()
 
-except sqlite3.Error as e:
-    print(f"An error occurred: {e}")
 
-finally:
-    # データベース接続を閉じる
-    if conn:
-        conn.close()
-        print("Close the database connection.")
\ No newline at end of file
+def main():
+    # データベースファイルを開く（存在しない場合は作成）
+    conn = None
+    try:
+        conn = sqlite3.connect(f'{SQLITE_PATH}')
+        print("Connected to the database.")
+
+        # 3の書き込みスレッドと読み込みが同時に行えるよう、WALモードにしておく(データベースファイルに記録される)
+        conn.execute('PRAGMA journal_mode=WAL')
+
+        if NORMALIZED_STORAGE:
+            create_normalized_views(conn)
+        else:
+            create_tables(conn)
+
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e}")
+
+    finally:
+        # データベース接続を閉じる
+        if conn:
+            conn.close()
+            print("Close the database connection.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+3の作業キュー。knowledge.sqlite3のscrape_jobsテーブルに、csvの1行の1言語分を1件のジョブとして登録しておき、
+各ワーカーはそこからジョブを取り出して処理する。状態はpending(未処理), in_progress(処理中), done(完了), failed(規定回数失敗)。
+ジョブは行番号、言語の順に取り出すので、複数言語の場合は同じ記事の各言語版が続けて(並行して)描画される。
+取り出しはBEGIN IMMEDIATEで書き込みロックを取ってから行うので、同じデータベースファイルを開いた複数のプロセスが並行して処理しても、
+同じジョブを二重に取り出すことはない。ただしSQLiteのWALはネットワークファイルシステムでは動かないので、
+複数のプロセスで使う場合も同じホストのローカルディスク上のデータベースファイルを開くこと(複数のマシンでは使えない)。
+処理中のまま一定時間が経ったジョブ(プロセスが落ちた場合など)はpendingに戻して取り直す。
+その時点で試行回数が上限に達していれば、ワーカーを落とし続けるジョブとみなしてfailedにする。
+接続は1つのスレッドに限らず使えるので、イベントループからはasyncio.to_thread()で呼ぶ(ロックで1回ずつ実行する)。
+doneへの更新はsqlite_writerの書き込みと同じトランザクションで行うので、途中で落ちても失われるのは処理中のページだけになる。
+"""
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+IN_PROGRESS = 'in_progress'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class JobQueue:
+    def __init__(self, path, table, max_attempts, stale_after, worker_id=None):
+        self.table = table
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        self.worker_id = worker_id or default_worker_id()
+        # 他のプロセスが書き込みロックを持っている間は最大30秒待つ
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS scrape_jobs (
+            table_name TEXT NOT NULL,
+            row_index INTEGER NOT NULL,
+            language TEXT NOT NULL,
+            category TEXT,
+            url TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            claimed_at REAL,
+            last_error TEXT,
+            PRIMARY KEY (table_name, row_index, language)
+        )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_scrape_jobs_status ON scrape_jobs (table_name, status, row_index)')
+
+    # csvの行を言語ごとにジョブとして登録する。既に登録済みの行(別のプロセスが登録したものも含む)で内容が同じものはそのまま。
+    # csvを作り直して同じ行番号のurlが変わった場合は、別の記事なのでurlを置き換えて(doneでも)pendingに戻し、試行回数もリセットする。
+    # 登録・更新したジョブの数を返す
+    def seed(self, rows, languages):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                before = self.conn.total_changes
+                self.conn.executemany(
+                    '''INSERT INTO scrape_jobs (table_name, row_index, language, category, url) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (table_name, row_index, language) DO UPDATE SET
+                        status = CASE WHEN scrape_jobs.url IS excluded.url THEN scrape_jobs.status ELSE ? END,
+                        attempts = CASE WHEN scrape_jobs.url IS excluded.url THEN scrape_jobs.attempts ELSE 0 END,
+                        last_error = CASE WHEN scrape_jobs.url IS excluded.url THEN scrape_jobs.last_error ELSE NULL END,
+                        category = excluded.category,
+                        url = excluded.url
+                    WHERE scrape_jobs.url IS NOT excluded.url OR scrape_jobs.category IS NOT excluded.category''',
+                    [(self.table, i, language, row[0], row[1], PENDING) for i, row in enumerate(rows) for language in languages])
+                added = self.conn.total_changes - before
+                self.conn.execute('COMMIT')
+            except sqlite3.Error:
+                self.conn.execute('ROLLBACK')
+                raise
+            return added
+
+    # pendingのジョブを1件取り出してin_progressにし、(row_index, language, category, url)を返す。残っていなければNone
+    def claim(self):
+        with self.lock:
+            return self._claim()
+
+    def _claim(self):
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            stale = (self.table, IN_PROGRESS, now - self.stale_after)
+            abandoned = self.conn.execute(
+                'UPDATE scrape_jobs SET status = ?, last_error = ? WHERE table_name = ? AND status = ? AND claimed_at < ? AND attempts >= ?',
+                (FAILED, '処理中のまま終わらなかった', *stale, self.max_attempts)).rowcount
+            if abandoned:
+                logger.error(f'処理中のまま{self.stale_after}秒以上経ち、試行回数が上限に達した{abandoned}件のジョブをfailedにしました')
+            reclaimed = self.conn.execute(
+                'UPDATE scrape_jobs SET status = ? WHERE table_name = ? AND status = ? AND claimed_at < ?',
+                (PENDING, *stale)).rowcount
+            if reclaimed:
+                logger.warning(f'処理中のまま{self.stale_after}秒以上経った{reclaimed}件のジョブを取り直します')
+            job = self.conn.execute(
+                'SELECT row_index, language, category, url FROM scrape_jobs WHERE table_name = ? AND status = ? ORDER BY row_index, language LIMIT 1',
+                (self.table, PENDING)).fetchone()
+            if job is not None:
+                self.conn.execute(
+                    'UPDATE scrape_jobs SET status = ?, attempts = attempts + 1, worker = ?, claimed_at = ? WHERE table_name = ? AND row_index = ? AND language = ?',
+                    (IN_PROGRESS, self.worker_id, now, self.table, job[0], job[1]))
+            self.conn.execute('COMMIT')
+        except sqlite3.Error:
+            self.conn.execute('ROLLBACK')
+            raise
+        return job
+
+    # 記事の書き込みと同じトランザクションで実行する、ジョブをdoneにするsql
+    def done_statement(self, row_index, language):
+        return ('UPDATE scrape_jobs SET status = ?, last_error = NULL WHERE table_name = ? AND row_index = ? AND language = ?',
+                (DONE, self.table, row_index, language))
+
+    # 失敗したジョブを、試行回数が上限に達していればfailed、そうでなければpendingに戻す
+    def mark_failed(self, row_index, language, error):
+        with self.lock:
+            self.conn.execute(
+                'UPDATE scrape_jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, last_error = ? WHERE table_name = ? AND row_index = ? AND language = ?',
+                (self.max_attempts, FAILED, PENDING, str(error), self.table, row_index, language))
+
+    # failedのジョブをpendingに戻し、試行回数をリセットする
+    def retry_failed(self):
+        with self.lock:
+            return self.conn.execute(
+                'UPDATE scrape_jobs SET status = ?, attempts = 0 WHERE table_name = ? AND status = ?',
+                (PENDING, self.table, FAILED)).rowcount
+
+    def counts(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT status, COUNT(*) FROM scrape_jobs WHERE table_name = ? GROUP BY status', (self.table,))
+            return dict(rows.fetchall())
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
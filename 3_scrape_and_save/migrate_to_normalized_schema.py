@@ -0,0 +1,139 @@
+"""
+knowledge.sqlite3の従来の形式のテーブル(言語・日付ごとの EN_08_07_2024 など、および全言語共通のarticles_*)を、
+content_store.pyの正規化したスキーマ(content_blobs/pages)に移す。テーブル名がそのままスナップショット名になる。
+移した後、元のテーブルは<テーブル名>_legacyに名前を変え、元の名前で同じ列を持つviewを作るので、4はそのまま動く。
+viewの内容と行数が元のテーブルと一致することを確認してから名前を変える。
+pagesは(answer_id, language)ごとに1行なので、同じ記事の行が複数ある(urlの形だけが違うなど)テーブルは移さずにエラーにする。
+--drop-legacyを付けると、_legacyのテーブルを削除してからVACUUMし、実際にファイルを小さくする。
+
+python migrate_to_normalized_schema.py [--drop-legacy]
+"""
+
+import logging
+import os
+import sqlite3
+import sys
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+import config as cfg
+import content_store
+from url_canon import url_language
+from url_canon import answer_id, dedupe_key
+
+SQLITE_PATH = cfg.SQLITE_PATH
+LANGUAGE = cfg.LANGUAGE
+CONTENT_CODEC = content_store.resolve_codec()
+LEGACY_SUFFIX = '_legacy'
+# 移行の対象外のテーブル
+SKIP_TABLES = {'content_blobs', 'pages', 'scrape_jobs'}
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler = logging.StreamHandler()
+handler.setLevel(logging.DEBUG)
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+# 記事の本文を持つ従来の形式のテーブルを探す
+def find_legacy_tables(conn):
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+    legacy = []
+    for table in tables:
+        if table in SKIP_TABLES or table.endswith(LEGACY_SUFFIX) or table.startswith('sqlite_'):
+            continue
+        if {'category', 'reference_url', 'content'} <= set(table_columns(conn, table)):
+            legacy.append(table)
+    return legacy
+
+
+# 従来のテーブルの行を(row_index, answer_id, language, category, url, content)の形で読む。
+# language列がない古いテーブルはurlのhl、それもなければcfg.LANGUAGEとする
+def iter_legacy_rows(conn, table):
+    columns = set(table_columns(conn, table))
+    row_index = 'row_index' if 'row_index' in columns else 'id - 1'
+    language = 'language' if 'language' in columns else 'NULL'
+    cursor = conn.execute(f'SELECT {row_index}, {language}, category, reference_url, content FROM {table} ORDER BY {row_index}')
+    for index, row_language, category, url, content in cursor:
+        row_language = row_language or url_language(url) or LANGUAGE
+        yield index, answer_id(url) or dedupe_key(url), row_language, category, url, content or ''
+
+
+def migrate_table(conn, table):
+    rows = 0
+    raw_bytes = 0
+    seen_urls = {} # (answer_id, language) -> url
+    blobs_before = conn.execute('SELECT COUNT(*) FROM content_blobs').fetchone()[0]
+    with conn:
+        for index, article_id, language, category, url, content in iter_legacy_rows(conn, table):
+            # 同じ記事の2行目はpagesの同じ行を上書きして1行目の内容が失われるので、ロールバックして中止する
+            if (article_id, language) in seen_urls:
+                raise ValueError(f'{table}に同じ記事({article_id}, {language})の行が複数あります: {seen_urls[(article_id, language)]} と {url}。'
+                                 'どちらかの行を削除してから再実行してください')
+            seen_urls[(article_id, language)] = url
+            for sql, params in content_store.page_statements(table, article_id, language, index, category, url, content, CONTENT_CODEC):
+                conn.execute(sql, params)
+            rows += 1
+            raw_bytes += len(content.encode('utf-8'))
+        new_blobs = conn.execute('SELECT COUNT(*) FROM content_blobs').fetchone()[0] - blobs_before
+
+        # viewと元のテーブルを行数と内容で突き合わせてから、元のテーブルの名前を変えてviewに置き換える
+        legacy_count = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        page_count = conn.execute('SELECT COUNT(*) FROM pages WHERE snapshot = ?', (table,)).fetchone()[0]
+        if not legacy_count == rows == page_count:
+            raise ValueError(f'移行後の行数({page_count})が元のテーブル{table}の行数({legacy_count})と一致しません')
+        expected = {(article_id, language): (index, category, url, content) for index, article_id, language, category, url, content in iter_legacy_rows(conn, table)}
+        actual = {(article_id, language): (index, category, url, content)
+                  for article_id, language, index, category, url, content in conn.execute(
+                      'SELECT pages.answer_id, pages.language, pages.row_index, pages.category, pages.reference_url, decompress_content(content_blobs.codec, content_blobs.data) '
+                      'FROM pages JOIN content_blobs ON content_blobs.hash = pages.content_hash WHERE pages.snapshot = ?', (table,))}
+        if actual != expected:
+            raise ValueError(f'移行後の内容が元のテーブル{table}と一致しません')
+
+        conn.execute(f'ALTER TABLE {table} RENAME TO {table}{LEGACY_SUFFIX}')
+    content_store.create_snapshot_view(conn, table)
+    logger.info(f'{table}: {rows}行を移行しました(新しく保存した本文 {new_blobs}件, 元の本文 {raw_bytes / 1024 / 1024:.1f}MB)')
+
+
+def main():
+    drop_legacy = '--drop-legacy' in sys.argv[1:]
+    try:
+        conn = sqlite3.connect(SQLITE_PATH)
+        content_store.register_functions(conn)
+        content_store.prepare_schema(conn)
+        logger.info(f"データベースと接続しました。本文は{CONTENT_CODEC}で圧縮します")
+    except sqlite3.Error as e:
+        logger.critical(f"データベース接続エラー。コードの実行を終了します: {e}", exc_info=True)
+        sys.exit(1)
+
+    size_before = os.path.getsize(SQLITE_PATH)
+    try:
+        for table in find_legacy_tables(conn):
+            migrate_table(conn, table)
+
+        if drop_legacy:
+            for table in [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB ?", (f'*{LEGACY_SUFFIX}',))]:
+                conn.execute(f'DROP TABLE {table}')
+                logger.info(f'{table}を削除しました')
+            conn.commit()
+            logger.info(f'どこからも参照されていない本文{content_store.delete_orphan_blobs(conn)}件を削除しました')
+            conn.execute('VACUUM')
+    except (sqlite3.Error, ValueError) as e:
+        logger.critical(f"移行に失敗しました。コードの実行を終了します: {e}", exc_info=True)
+        conn.close()
+        sys.exit(1)
+
+    blobs, stored, original = conn.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0), COALESCE(SUM(size), 0) FROM content_blobs').fetchone()
+    pages = conn.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+    conn.close()
+    logger.info(f'pages {pages}行, 本文 {blobs}件 (圧縮前 {original / 1024 / 1024:.1f}MB, 圧縮後 {stored / 1024 / 1024:.1f}MB)')
+    logger.info(f'データベースファイル: {size_before / 1024 / 1024:.1f}MB -> {os.path.getsize(SQLITE_PATH) / 1024 / 1024:.1f}MB')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+差分実行(cfg.DELTA_MODE)で、前回のスナップショットの内容を描画し直さずに引き継いでよいかを確かめるための記録。
+描画・キャッシュから保存した記事ごとに、ページ本体のレスポンスのETag/Last-Modifiedと、保存したhtmlのハッシュ値を
+page_validatorsテーブルに(スナップショット名, dedupe_key, 言語)をキーにして残しておく。
+次回の実行では、前回のスナップショットにもある記事についてこのETag/Last-Modifiedで条件付きGETを送り、
+304(変更なし)で、かつ前回のhtmlのハッシュ値が記録と一致する場合だけ前回の内容を引き継ぐ。
+記録がない、ETag/Last-Modifiedがない、または変更されていた場合は描画し直す。
+記録はsqlite_writerの書き込みと同じトランザクションで行う。
+"""
+
+import logging
+import requests
+from content_store import content_hash
+from http_cache import CacheEntry
+
+logger = logging.getLogger(__name__)
+
+
+def prepare_validator_table(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS page_validators (
+        snapshot TEXT NOT NULL,
+        url_key TEXT NOT NULL,
+        language TEXT NOT NULL,
+        etag TEXT,
+        last_modified TEXT,
+        content_hash TEXT NOT NULL,
+        PRIMARY KEY (snapshot, url_key, language)
+    )
+    ''')
+    conn.commit()
+
+
+# 1記事1言語分の記録をupsertする(sql, params)。記事の書き込みと同じリストに入れてsqlite_writerに渡す
+def validator_statement(snapshot, url_key, language, etag, last_modified, html):
+    sql = '''
+    INSERT INTO page_validators (snapshot, url_key, language, etag, last_modified, content_hash) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (snapshot, url_key, language) DO UPDATE SET
+        etag = excluded.etag,
+        last_modified = excluded.last_modified,
+        content_hash = excluded.content_hash
+    '''
+    return sql, (snapshot, url_key, language, etag, last_modified, content_hash(html))
+
+
+# スナップショットの記録を{(url_key, language): (etag, last_modified, content_hash)}で返す。テーブルがなければ空
+def load_validators(conn, snapshot):
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'page_validators'").fetchone()
+    if not exists:
+        return {}
+    rows = conn.execute('SELECT url_key, language, etag, last_modified, content_hash FROM page_validators WHERE snapshot = ?', (snapshot,))
+    return {(url_key, language): (etag, last_modified, digest) for url_key, language, etag, last_modified, digest in rows}
+
+
+# 前回のhtmlをそのまま使ってよければTrue。validatorはload_validators()の値(なければNone)。
+# 通信できない場合(fetcherがNone)や、条件付きGETに失敗した場合は描画し直すものとしてFalseを返す
+def is_previous_unchanged(fetcher, url, previous_html, validator):
+    if fetcher is None or validator is None:
+        return False
+    etag, last_modified, digest = validator
+    if digest != content_hash(previous_html):
+        return False # 記録したときのhtmlと前回のテーブルの内容が違う
+    try:
+        return fetcher.is_not_modified(url, CacheEntry(previous_html, etag, last_modified))
+    except requests.exceptions.RequestException as e:
+        logger.warning(f'前回からの変更を確かめられなかったので、ページを描画し直します: {url} {e}')
+        return False
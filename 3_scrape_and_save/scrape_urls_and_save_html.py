@@ -1,6 +1,23 @@
 """
 前段で作ったcleaned_urls_list.csvをこのディレクトリにコピーし、それを使って、htmlをスクレイピング。
 この段では単にhtmlをそのままsqlite3に保存するのみ。クリーンアップは次のsplit_into_md_chunksにて行う
+描画済みのhtmlはhttp_cache/にも保存し、次回はETag/Last-Modifiedで再検証して変わっていなければブラウザを起動せずにそれを使う。
+cfg.OFFLINE_MODEがTrueの場合は、キャッシュだけを使って一切通信せずに実行する。
+cfg.DELTA_MODEがTrueの場合は、前回のテーブル(cfg.PREVIOUS_SQLITE_TABLE_NAME)にも存在する記事のうち、
+前回保存したETag/Last-Modifiedでの条件付きGETで変更されていないと確かめられたものは描画せずに前回の内容を引き継ぎ、
+追加・変更された記事と、変更を確かめられない記事は描画する(page_validators.py)。オフラインモードでは確かめずに引き継ぐ。
+Chromiumは記事ごとに起動せず、browser_pool.BrowserPoolで1つを使い回し、複数のタブで並行して描画する。
+cfg.BLOCK_REQUESTSがTrueの場合は、画像・フォント・動画などのリソースと解析用などの外部ホストへのリクエストを中断し、
+ネットワークが静かになるのを待たずに.article-containerが現れた時点で処理を進める。ページごとに転送量と描画時間をログに出す。
+さらにcfg.BLOCKING_COMPARE_EVERYページごとに同じタブで中断なしでも描画し直し、最後に中断によって短縮できた描画時間を報告する。
+sqlite3への保存はsqlite_writer.SQLiteWriterの専用スレッドで行い、cfg.SQLITE_WRITE_BATCH_SIZE件またはcfg.SQLITE_WRITE_INTERVAL秒ごとにまとめてコミットする。
+記事は同じidまたは(reference_url, language)の行を置き換えて保存されるので、同じ範囲を再実行しても問題ない。
+処理する行はjob_queue.JobQueue(knowledge.sqlite3のscrape_jobsテーブル)から取り出す。csvの全行を最初にジョブとして登録し、
+同じホストで同じデータベースファイルを使う複数のプロセスで並行して実行できる(WALのため、ネットワークファイルシステム越しには使えない)。中断した場合はそのまま再実行すれば、終わっていない行だけが処理される。
+cfg.LANGUAGESを指定した場合は、各行をその全ての言語(?hl=)でジョブにして1回の実行で描画し、
+(answer_id, language)をキーにしたcfg.ARTICLES_TABLE_NAMEに保存する。同じ記事の各言語版は続けて取り出されるので、温まったタブで並行して描画される。
+cfg.NORMALIZED_STORAGEがTrueの場合は、上記のテーブル名をスナップショット名として、本文を圧縮してcontent_store.pyの正規化したテーブルに保存する。
+同じ名前のviewが作られるので、4からは従来のテーブルと同じように読める。
 """
 
 import csv
@@ -11,21 +28,56 @@ import logging
 from urllib.parse import urlparse
 import sqlite3
 import asyncio
-from pyppeteer import launch, errors
+import time
+from collections import Counter
+from pyppeteer import errors
+import requests
 import sys
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_root)
 import config as cfg
-
-
-RANGE_START = 810
-RANGE_END = 855
+from http_fetch import Fetcher
+from http_cache import ResponseCache
+from url_canon import dedupe_key, answer_id
+from browser_pool import BrowserPool
+from sqlite_writer import SQLiteWriter, prepare_article_table, prepare_localized_table, article_statements, localized_article_statement
+from job_queue import JobQueue
+from page_validators import prepare_validator_table, validator_statement, load_validators, is_previous_unchanged
+import content_store
 
 DOWNLOAD_LANGUAGE = cfg.LANGUAGE
 CLEANED_URLS_CSV = cfg.CLEANED_URLS_CSV
 SQLITE_PATH = cfg.SQLITE_PATH
 SQLITE_TABLE_NAME = cfg.SQLITE_TABLE_NAME
+LANGUAGES = cfg.LANGUAGES
+ARTICLES_TABLE_NAME = cfg.ARTICLES_TABLE_NAME
+# 複数言語をまとめて描画する場合は全言語共通のテーブルに、そうでなければ従来の言語ごとのテーブルに保存する
+FAN_OUT = bool(LANGUAGES)
+SCRAPE_LANGUAGES = LANGUAGES if FAN_OUT else [DOWNLOAD_LANGUAGE]
+TARGET_TABLE_NAME = ARTICLES_TABLE_NAME if FAN_OUT else SQLITE_TABLE_NAME
+NORMALIZED_STORAGE = cfg.NORMALIZED_STORAGE
+CONTENT_CODEC = content_store.resolve_codec()
 USER_AGENTS = cfg.USER_AGENTS
+HTTP_CACHE_ENABLED = cfg.HTTP_CACHE_ENABLED
+OFFLINE_MODE = cfg.OFFLINE_MODE
+DELTA_MODE = cfg.DELTA_MODE
+PREVIOUS_SQLITE_TABLE_NAME = cfg.PREVIOUS_SQLITE_TABLE_NAME
+BROWSER_CONCURRENCY = cfg.BROWSER_CONCURRENCY
+BROWSER_RESTART_EVERY = cfg.BROWSER_RESTART_EVERY
+SCRAPE_MAX_ATTEMPTS = cfg.SCRAPE_MAX_ATTEMPTS
+BLOCK_REQUESTS = cfg.BLOCK_REQUESTS
+BLOCKED_RESOURCE_TYPES = set(cfg.BLOCKED_RESOURCE_TYPES)
+BLOCKED_HOSTS = tuple(cfg.BLOCKED_HOSTS)
+BLOCKING_COMPARE_EVERY = cfg.BLOCKING_COMPARE_EVERY
+ZIPPY_SETTLE_MS = cfg.ZIPPY_SETTLE_MS
+ZIPPY_SETTLE_TIMEOUT_MS = cfg.ZIPPY_SETTLE_TIMEOUT_MS
+SQLITE_WRITE_BATCH_SIZE = cfg.SQLITE_WRITE_BATCH_SIZE
+SQLITE_WRITE_INTERVAL = cfg.SQLITE_WRITE_INTERVAL
+JOB_MAX_ATTEMPTS = cfg.JOB_MAX_ATTEMPTS
+JOB_STALE_SECONDS = cfg.JOB_STALE_SECONDS
+JOB_RETRY_FAILED = cfg.JOB_RETRY_FAILED
+
+CACHE_DIR = Path(__file__).parent / 'http_cache'
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -62,13 +114,128 @@ def read_csv():
         raise
 
 
-async def get_html(url, browser):
-    try:
-        page = await browser.newPage()
-        await page.setUserAgent(random.choice(USER_AGENTS))
+ZIPPY_SELECTOR = "div.zippy-container > h2, div.zippy-container > a, div.zippy-container > h3"
+
+# ページ内で実行するjavascript。全てのzippyを一度にクリックして開き、.article-container内のDOMの変化が
+# settleMsの間なくなるか、timeoutMsが経過するのを待ってから、.article-containerのinnerHTMLを返す(見つからなければnull)。
+# Python側から要素ごとにクリックして固定の時間sleepする方式に比べ、往復が1回で済み、待ち時間も必要な分だけになる
+EXPAND_ZIPPIES_AND_GET_HTML_JS = """
+async (selector, settleMs, timeoutMs) => {
+    const container = document.querySelector('.article-container');
+    if (container === null) {
+        return null;
+    }
+    const targets = Array.from(document.querySelectorAll(selector));
+    if (targets.length > 0) {
+        await new Promise((resolve) => {
+            let settleTimer = null;
+            let timeoutTimer = null;
+            const observer = new MutationObserver(() => {
+                clearTimeout(settleTimer);
+                settleTimer = setTimeout(finish, settleMs);
+            });
+            function finish() {
+                observer.disconnect();
+                clearTimeout(settleTimer);
+                clearTimeout(timeoutTimer);
+                resolve();
+            }
+            observer.observe(container, {subtree: true, childList: true, attributes: true, characterData: true});
+            timeoutTimer = setTimeout(finish, timeoutMs);
+            targets.forEach((element) => element.click());
+            settleTimer = setTimeout(finish, settleMs);
+        });
+    }
+    return container.innerHTML;
+}
+"""
+
+
+# タブごとのリクエストの集計。render_article()の最初にリセットされる
+class RequestStats:
+    def __init__(self):
+        self.blocked = Counter()
+        self.received_bytes = 0
+        self.responses = 0
+
+
+# 描画時間の集計。全ページの描画時間と、BLOCKING_COMPARE_EVERYページごとに同じページを中断あり・なしの両方で描画した時間の組を持つ
+class RenderTimings:
+    def __init__(self, compare_every):
+        self.compare_every = compare_every
+        self.seconds = []
+        self.pairs = [] # (中断ありの秒数, 中断なしの秒数)
 
+    # ページの描画時間を記録し、このページを中断なしでも描画して比べるべきならTrueを返す
+    def record(self, seconds):
+        self.seconds.append(seconds)
+        return BLOCK_REQUESTS and self.compare_every > 0 and len(self.seconds) % self.compare_every == 0
+
+    def log_summary(self):
+        if not self.seconds:
+            return
+        average = sum(self.seconds) / len(self.seconds)
+        logger.info(f"描画時間: 平均{average:.2f}秒, 合計{sum(self.seconds):.0f}秒 ({len(self.seconds)}ページ, リクエストの中断{'あり' if BLOCK_REQUESTS else 'なし'})")
+        if not self.pairs:
+            return
+        blocked = sum(pair[0] for pair in self.pairs) / len(self.pairs)
+        unblocked = sum(pair[1] for pair in self.pairs) / len(self.pairs)
+        saved = unblocked - blocked
+        logger.info(f"リクエストの中断による短縮: {len(self.pairs)}ページを中断なしでも描画した平均{unblocked:.2f}秒に対して中断ありは{blocked:.2f}秒で、"
+                    f"1ページあたり{saved:.2f}秒({saved / unblocked if unblocked else 0:.0%})、全{len(self.seconds)}ページで約{saved * len(self.seconds):.0f}秒短縮しました")
+
+
+RENDER_TIMINGS = RenderTimings(BLOCKING_COMPARE_EVERY)
+
+
+def is_blocked_request(request):
+    if request.resourceType in BLOCKED_RESOURCE_TYPES:
+        return True
+    host = urlparse(request.url).hostname or ''
+    return any(host == blocked or host.endswith('.' + blocked) for blocked in BLOCKED_HOSTS)
+
+
+async def handle_request(page, request):
+    try:
+        if is_blocked_request(request):
+            page.request_stats.blocked[request.resourceType] += 1
+            await request.abort()
+        else:
+            await request.continue_()
+    except errors.NetworkError:
+        pass # タブを閉じた後や、既に処理されたリクエストの場合
+
+
+def record_response(page, response):
+    page.request_stats.responses += 1
+    content_length = response.headers.get('content-length')
+    if content_length and content_length.isdigit():
+        page.request_stats.received_bytes += int(content_length)
+
+
+# BrowserPoolが新しいタブを作るたびに呼ばれ、リクエストのインターセプトと転送量の集計を設定する
+async def setup_page(page):
+    page.request_stats = RequestStats()
+    page.on('response', lambda response: record_response(page, response))
+    if BLOCK_REQUESTS:
+        await page.setRequestInterception(True)
+        page.on('request', lambda request: asyncio.ensure_future(handle_request(page, request)))
+
+
+# プールから渡されたタブ(page)でurlを描画し、.article-containerのinnerHTMLとページ本体のレスポンスヘッダーを返す
+async def render_article(page, url):
+    page.request_stats = RequestStats()
+    start = time.perf_counter()
+    try:
         try: # 操作のタイムアウト時間を15000ミリ秒（15秒）に設定
-            await page.goto(url, {'waitUntil': 'networkidle0', 'timeout': 15000})
+            if BLOCK_REQUESTS:
+                # 不要なリクエストは中断しているので、ネットワークが静かになるのを待たずに本文の要素が現れるのを待つ
+                response = await page.goto(url, {'waitUntil': 'domcontentloaded', 'timeout': 15000})
+                await page.waitForSelector('.article-container', {'timeout': 15000})
+            else:
+                response = await page.goto(url, {'waitUntil': 'networkidle0', 'timeout': 15000})
+            # キャッシュの再検証に使うため、ページ本体のレスポンスヘッダー(キーは小文字)を取っておく
+            response_headers = response.headers if response else {}
 
         except TimeoutError:
             logger.error(f"ページの読み込みがタイムアウトしました。: {url}")
@@ -80,48 +247,149 @@ async def get_html(url, browser):
             logger.error(f"その他のエラーが発生しました: {e}", exc_info=True)  # スタックトレースを出力
             raise
 
-        logger.info('ページの読み込みが完了しました。ページ内のリンクのクリックを行っていきます')
-        clickable_element_selector = "div.zippy-container > h2, div.zippy-container > a, div.zippy-container > h3"
-        clickable_elements = await page.querySelectorAll(clickable_element_selector)
-        for element in clickable_elements:
-            try:
-                await element.click()
-                await asyncio.sleep(random.uniform(0.9, 1))
-            except Exception as e:
-                logger.warning(f"要素のクリック中にエラーが発生しました: {e} ページurl: {url}")
-                raise
-
+        logger.info(f'ページの読み込みが完了しました。ページ内のzippyを全て開いていきます: {url}')
         try:
-            element_handle = await page.querySelector(".article-container")
-            if element_handle is None:
-                logger.error(f".article-container要素が見つかりませんでした")
-                raise
-
-            # pyppeteerでは、page.evaluate()メソッドを使用してJavaScriptを実行し、要素のinnerHTMLを取得する
-            html = await page.evaluate('(element) => element.innerHTML', element_handle)
-            await browser.close()
-            return html
+            # zippyのクリック、DOMの変化が落ち着くのを待つこと、innerHTMLの取得を1回のpage.evaluate()で行う
+            html = await page.evaluate(EXPAND_ZIPPIES_AND_GET_HTML_JS, ZIPPY_SELECTOR, ZIPPY_SETTLE_MS, ZIPPY_SETTLE_TIMEOUT_MS)
+            if html is None:
+                raise ValueError(f".article-container要素が見つかりませんでした: {url}")
 
         except Exception as e:
             logger.error(f"javascriptを使ったHTML処理の段でエラーが発生しました: {e}")
             raise
 
+        elapsed = time.perf_counter() - start
+        stats = page.request_stats
+        blocked = ', '.join(f'{resource_type}:{count}' for resource_type, count in stats.blocked.most_common())
+        logger.info(f'描画時間 {elapsed:.1f}秒, 受信 {stats.received_bytes / 1024:.0f}KB ({stats.responses}件), '
+                    f'中断したリクエスト {sum(stats.blocked.values())}件 [{blocked}]: {url}')
+        if RENDER_TIMINGS.record(elapsed):
+            await compare_unblocked_render(page, url, elapsed)
+
+        # サーバーに負荷をかけすぎないよう、タブごとに次のページまで少し間を空ける
+        await asyncio.sleep(random.uniform(4, 6))
+        return html, response_headers
+
     except Exception as e:
         logger.error(f"スクレイピング中に何らかのエラーが発生しました: {e}")
         raise
 
-def save_to_sqlite3(conn, cursor, row, category, url, text):
+
+# 同じタブで、リクエストを中断せずにネットワークが静かになるまで待つ従来の方法でもう一度描画し、時間を比べる。
+# 直前の描画でスクリプトなどはブラウザのキャッシュに入っているので、短縮できた時間は少なめに見積もられる。失敗しても描画済みのhtmlは使えるので、警告だけ出して比べるのをやめる
+async def compare_unblocked_render(page, url, blocked_seconds):
+    await page.setRequestInterception(False)
     try:
-        sql = f"INSERT INTO {SQLITE_TABLE_NAME} (id, category, reference_url, content) VALUES (?, ?, ?, ?)"
-        cursor.execute(sql, (row+1, category, url, text))
-        conn.commit()
-        logger.info(f"{row+1}行目が追加、コミットされました。")
-    except sqlite3.Error as e:
-        logger.error(f"データベースエラーが発生しました。この行は保存されません {row+1}行目 url:{url} {e}")
-        conn.rollback()
+        start = time.perf_counter()
+        await page.goto(url, {'waitUntil': 'networkidle0', 'timeout': 15000})
+        await page.evaluate(EXPAND_ZIPPIES_AND_GET_HTML_JS, ZIPPY_SELECTOR, ZIPPY_SETTLE_MS, ZIPPY_SETTLE_TIMEOUT_MS)
+        unblocked_seconds = time.perf_counter() - start
+        RENDER_TIMINGS.pairs.append((blocked_seconds, unblocked_seconds))
+        logger.info(f'比較のため中断なしでも描画しました: {unblocked_seconds:.1f}秒 (中断あり {blocked_seconds:.1f}秒): {url}')
+    except Exception as e:
+        logger.warning(f'中断なしでの描画時間を測れませんでした: {e}: {url}')
+    finally:
+        await page.setRequestInterception(True)
+
+
+# キャッシュに描画済みのhtmlがあり、それが有効期限内かサーバー側で変更されていない(304)場合はそのCacheEntryを返す。使えない場合はNone
+async def get_cached_entry(cache, fetcher, url):
+    entry = cache.get(url)
+    if entry is None:
+        return None
+    if OFFLINE_MODE or entry.is_fresh():
+        return entry
+    try:
+        if await asyncio.to_thread(fetcher.is_not_modified, url, entry):
+            return entry
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"キャッシュの再検証に失敗したので、ページを描画し直します: {url} {e}")
+    return None
+
+
+# 差分実行用に、前回のテーブルの内容を記事ごと(dedupe_key)に読み込む
+def load_previous_contents(cursor):
+    cursor.execute(f"SELECT reference_url, content FROM {PREVIOUS_SQLITE_TABLE_NAME}")
+    return {dedupe_key(url): content for url, content in cursor.fetchall()}
+
+
+# 1行分(1記事)を処理する。キャッシュや前回のテーブルから取れない場合はプールのタブで描画し、書き込みスレッドに渡す
+async def scrape_row(i, category, url, language, pool, writer, jobs, cache, fetcher, previous_contents, previous_validators):
+    url = url.replace('?hl=en', f'?hl={language}') if '?hl=en' in url else url + f'?hl={language}'
+
+    if not is_valid_url(url):
+        raise ValueError(f'このurlには問題があるようです。{i+1}行目: {url}')
+
+    url_key = dedupe_key(url)
+    html = None
+    etag = last_modified = None # 次回の差分実行で変更を確かめるために記録する、ページ本体のETag/Last-Modified
+    entry = await get_cached_entry(cache, fetcher, url) if cache else None
+    if entry is not None:
+        html, etag, last_modified = entry.body, entry.etag, entry.last_modified
+        logger.info(f'{i+1}行目はキャッシュのhtmlを使います: {url}')
+    # 前回のテーブルはDOWNLOAD_LANGUAGEのものなので、他の言語には引き継がない
+    elif language == DOWNLOAD_LANGUAGE and url_key in previous_contents:
+        previous_html = previous_contents[url_key]
+        validator = previous_validators.get((url_key, language))
+        # 前回の記録のETag/Last-Modifiedで変更されていないと確かめられた場合だけ引き継ぐ。オフラインモードでは確かめられないのでそのまま引き継ぐ
+        if OFFLINE_MODE or await asyncio.to_thread(is_previous_unchanged, fetcher, url, previous_html, validator):
+            html = previous_html
+            if validator:
+                etag, last_modified = validator[0], validator[1]
+            logger.info(f'{i+1}行目は前回のテーブルから内容を引き継ぎます: {url}')
+        else:
+            logger.info(f'{i+1}行目は前回から変更されたか、変更を確かめられないので描画し直します: {url}')
+
+    if html is None:
+        if OFFLINE_MODE:
+            raise LookupError(f'オフラインモードですが、このページはキャッシュに存在しません。{i+1}行目: {url}')
+
+        for attempt in range(1, SCRAPE_MAX_ATTEMPTS + 1):
+            try:
+                html, response_headers = await pool.render(url, render_article)
+                break
+            except Exception as e:
+                if attempt == SCRAPE_MAX_ATTEMPTS:
+                    logger.critical(f'スクレイピングが{attempt}回失敗しました{i+1}行目: {url} - {e}', exc_info=True)
+                    raise
+                # 失敗したタブは閉じられているので、次は新しいタブ(ブラウザが落ちていれば新しいブラウザ)で試す
+                logger.warning(f'スクレイピングに失敗したので新しいタブでやり直します({attempt}/{SCRAPE_MAX_ATTEMPTS}) {i+1}行目: {url} - {e}')
+
+        etag, last_modified = response_headers.get('etag'), response_headers.get('last-modified')
+        if cache:
+            cache.put(url, html, etag, last_modified)
+
+    try:
+        # キューに入れるだけなので、コミットを待たずに次の記事に進む。ジョブは記事と同じトランザクションでdoneになる
+        if NORMALIZED_STORAGE:
+            statements = content_store.page_statements(TARGET_TABLE_NAME, answer_id(url) or url_key, language, i, category, url, html, CONTENT_CODEC)
+        elif FAN_OUT:
+            statements = [localized_article_statement(TARGET_TABLE_NAME, answer_id(url) or url_key, language, i, category, url, html)]
+        else:
+            statements = article_statements(TARGET_TABLE_NAME, i+1, category, url, language, html)
+        writer.put([*statements, validator_statement(TARGET_TABLE_NAME, url_key, language, etag, last_modified, html),
+                    jobs.done_statement(i, language)])
+        logger.info(f"{i+1}行目を書き込みキューに追加しました。")
+
+    except Exception as e:
+        logger.critical(f"{i+1}行目のデータのsqlite3への保存中にエラーが発生しました: {url} - {e}", exc_info=True)
         raise
 
 
+# 作業キューからジョブを1件ずつ取り出して処理する。失敗したジョブは試行回数が上限に達するまでpendingに戻され、取り直される
+async def drain_jobs(pool, writer, jobs, cache, fetcher, previous_contents, previous_validators):
+    while writer.error is None:
+        # 取り出しは書き込みロックを待つことがあるので、描画中の他のページを止めないよう別スレッドで行う
+        job = await asyncio.to_thread(jobs.claim)
+        if job is None:
+            return
+        i, language, category, url = job
+        try:
+            await scrape_row(i, category, url, language, pool, writer, jobs, cache, fetcher, previous_contents, previous_validators)
+        except Exception as e:
+            logger.error(f"{i+1}行目の処理に失敗しました: {url} - {e}")
+            await asyncio.to_thread(jobs.mark_failed, i, language, e)
+
 
 async def main():
     try:
@@ -133,46 +401,91 @@ async def main():
 
     try:
         conn = sqlite3.connect(SQLITE_PATH)
+        content_store.register_functions(conn) # 前回のスナップショットがviewの場合に本文を展開するため
         cursor = conn.cursor()
         logger.info("データベースと接続しました")
     except sqlite3.Error as e:
         logger.critical(f"データベース接続エラー。コードの実行を終了します: {e}", exc_info=True)
         sys.exit(1)
 
-    for i in range(RANGE_START, RANGE_END):
-        category = data[i][0]
-        url = data[i][1]
-
-        url = url.replace('?hl=en', f'?hl={DOWNLOAD_LANGUAGE}') if '?hl=en' in url else url + f'?hl={DOWNLOAD_LANGUAGE}'
-
-        if not is_valid_url(url):
-            logger.critical(f'このurlには問題があるようです。コードの実行を終了します。{i+1}行目: {url}')
-            sys.exit(1)
+    if OFFLINE_MODE:
+        logger.info('オフラインモードです。キャッシュだけを使って実行します')
+    cache = ResponseCache(CACHE_DIR) if HTTP_CACHE_ENABLED or OFFLINE_MODE else None
+    # キャッシュの再検証と、差分実行で前回から変わっていないかの確認に使う
+    fetcher = Fetcher({'User-Agent': random.choice(USER_AGENTS)}, pool_size=BROWSER_CONCURRENCY) if (cache or DELTA_MODE) and not OFFLINE_MODE else None
 
+    previous_contents = {}
+    previous_validators = {}
+    if DELTA_MODE:
         try:
-            browser = await launch(headless=True, args=['--no-sandbox', '--disable-setuid-sandbox'])
-
-        except Exception as e:
-            logger.critical(f"ブラウザの起動に失敗しました。コードの実行を終了します。: {e}", exc_info=True)
+            previous_contents = load_previous_contents(cursor)
+            previous_validators = load_validators(conn, PREVIOUS_SQLITE_TABLE_NAME)
+            logger.info(f"差分実行です。前回のテーブル{PREVIOUS_SQLITE_TABLE_NAME}から{len(previous_contents)}件を読み込みました"
+                        f"(うち変更を確かめるためのETag/Last-Modifiedの記録があるもの{len(previous_validators)}件)")
+        except sqlite3.Error as e:
+            logger.critical(f"前回のテーブルの読み込みに失敗しました。コードの実行を終了します: {e}", exc_info=True)
             sys.exit(1)
 
-        try: # Claudeによると、この辺りで、スクレイぷに失敗したときに回数制限の下、リトライする機構を作るといいとのこと
-            html = await get_html(url, browser)
+    try:
+        if NORMALIZED_STORAGE:
+            if content_store.object_type(conn, TARGET_TABLE_NAME) == 'table':
+                logger.critical(f"{TARGET_TABLE_NAME}は従来の形式のテーブルです。先にmigrate_to_normalized_schema.pyで移行してください")
+                sys.exit(1)
+            content_store.prepare_schema(conn)
+            content_store.create_snapshot_view(conn, TARGET_TABLE_NAME)
+            logger.info(f"本文を{CONTENT_CODEC}で圧縮して保存します。スナップショット: {TARGET_TABLE_NAME}")
+        if FAN_OUT:
+            if not NORMALIZED_STORAGE:
+                prepare_localized_table(conn, TARGET_TABLE_NAME)
+            logger.info(f"{len(SCRAPE_LANGUAGES)}言語({', '.join(SCRAPE_LANGUAGES)})をまとめて描画し、{TARGET_TABLE_NAME}に保存します")
+        elif not NORMALIZED_STORAGE:
+            prepare_article_table(conn, TARGET_TABLE_NAME, DOWNLOAD_LANGUAGE)
+        prepare_validator_table(conn)
+    except sqlite3.Error as e:
+        logger.critical(f"テーブル{TARGET_TABLE_NAME}の準備に失敗しました。コードの実行を終了します: {e}", exc_info=True)
+        sys.exit(1)
+    try:
+        jobs = JobQueue(SQLITE_PATH, TARGET_TABLE_NAME, JOB_MAX_ATTEMPTS, JOB_STALE_SECONDS)
+        added = jobs.seed(data, SCRAPE_LANGUAGES)
+        if JOB_RETRY_FAILED:
+            logger.info(f"failedになっていた{jobs.retry_failed()}件のジョブをやり直します")
+        logger.info(f"{added}件のジョブを登録・更新しました。ジョブの状態: {jobs.counts()} (ワーカー {jobs.worker_id})")
+    except sqlite3.Error as e:
+        logger.critical(f"作業キューの準備に失敗しました。コードの実行を終了します: {e}", exc_info=True)
+        sys.exit(1)
 
-        except Exception as e:
-            logger.critical(f'スクレイピングが失敗したようなので作業を終了します{i+1}行目: {url} - {e}', exc_info=True)
-            await browser.close()
-            sys.exit(1)
+    writer = SQLiteWriter(SQLITE_PATH, SQLITE_WRITE_BATCH_SIZE, SQLITE_WRITE_INTERVAL)
+    writer.start()
 
+    # Chromiumは1つだけ起動し(BROWSER_RESTART_EVERYページごとに起動し直す)、BROWSER_CONCURRENCY個のタブで並行して描画する
+    pool = BrowserPool(BROWSER_CONCURRENCY, BROWSER_RESTART_EVERY, USER_AGENTS, page_setup=setup_page)
+    try:
+        await asyncio.gather(*[
+            drain_jobs(pool, writer, jobs, cache, fetcher, previous_contents, previous_validators)
+            for _ in range(BROWSER_CONCURRENCY)
+        ])
+    except Exception as e:
+        logger.critical(f"作業を終了します: {e}")
+        await pool.close()
         try:
-            save_to_sqlite3(conn, cursor, i, category, url, html)
-
-        except Exception as e:
-            logger.critical(f"{i+1}行目のデータのsqlite3への保存中にエラーが発生しました: {url} - {e}", exc_info=True)
-            sys.exit(1)
-
-        await asyncio.sleep(random.uniform(4, 6))
+            writer.close() # それまでに描画できた分は保存しておく
+        except RuntimeError as write_error:
+            logger.critical(write_error)
+        sys.exit(1)
 
+    await pool.close()
+    logger.info(f"ブラウザで描画したページ数: {pool.rendered_count}")
+    RENDER_TIMINGS.log_summary()
+    try:
+        writer.close()
+        logger.info(f"sqlite3に保存した記事数: {writer.written_count}")
+    except RuntimeError as e:
+        logger.critical(f"作業を終了します: {e}")
+        sys.exit(1)
+    logger.info(f"ジョブの状態: {jobs.counts()}")
+    jobs.close()
+    if fetcher:
+        fetcher.close()
     conn.close()
     logger.info("データベース接続を閉じました")
 
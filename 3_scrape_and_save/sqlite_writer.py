@@ -0,0 +1,139 @@
+"""
+スクレイピング結果をsqlite3に書き込む専用のスレッド。
+イベントループ側はキューに入れるだけで戻るので、コミット(fsync)の待ち時間がページの描画を止めることはない。
+接続はWALモードで開き、batch_size件またはflush_interval秒ごとにまとめて1つのトランザクションでコミットする。
+キューには「同じトランザクションで実行する(sql, params)のリスト」を1件として入れる。記事の書き込み文はarticle_statements()(言語ごとのテーブル)と
+localized_article_statement()(全言語をまとめたテーブル)で作る。どちらも既存の行を置き換えるので、同じ範囲を再実行しても主キーの重複エラーにはならない。
+"""
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+# 既存のテーブル(language列のない古い形)にlanguage列と(reference_url, language)のユニークインデックスを追加する
+def prepare_article_table(conn, table, language):
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if 'language' not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN language TEXT')
+        conn.execute(f'UPDATE {table} SET language = ? WHERE language IS NULL', (language,))
+        logger.info(f'テーブル{table}にlanguage列を追加しました')
+    conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_url_language ON {table} (reference_url, language)')
+    conn.commit()
+
+
+# 複数言語を1回で描画する場合の、(answer_id, language)をキーにした全言語共通のテーブルを作る
+def prepare_localized_table(conn, table):
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {table} (
+        answer_id TEXT NOT NULL,
+        language TEXT NOT NULL,
+        row_index INTEGER,
+        category TEXT,
+        reference_url TEXT,
+        content TEXT,
+        PRIMARY KEY (answer_id, language)
+    )
+    ''')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_language_row ON {table} (language, row_index)')
+    conn.commit()
+
+
+# 言語ごとのテーブルに1記事を書き込む(sql, params)のリスト。同じトランザクションで実行すること。
+# idは主キーなので、urlの正規化やcsvの行の増減でidとurlの組み合わせが前回と変わっていると、(reference_url, language)でのupsertでは
+# 別の行のidと重なってしまう。そのため、同じidまたは同じ(reference_url, language)の行を先に削除してから追加する
+def article_statements(table, row_id, category, url, language, content):
+    return [
+        (f'DELETE FROM {table} WHERE id = ? OR (reference_url = ? AND language = ?)', (row_id, url, language)),
+        (f'INSERT INTO {table} (id, category, reference_url, language, content) VALUES (?, ?, ?, ?, ?)',
+         (row_id, category, url, language, content)),
+    ]
+
+
+# 全言語共通のテーブルに1記事1言語分をupsertする(sql, params)
+def localized_article_statement(table, article_id, language, row_index, category, url, content):
+    sql = f'''
+    INSERT INTO {table} (answer_id, language, row_index, category, reference_url, content) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (answer_id, language) DO UPDATE SET
+        row_index = excluded.row_index,
+        category = excluded.category,
+        reference_url = excluded.reference_url,
+        content = excluded.content
+    '''
+    return sql, (article_id, language, row_index, category, url, content)
+
+
+class SQLiteWriter(threading.Thread):
+    def __init__(self, path, batch_size, flush_interval):
+        super().__init__(name='sqlite-writer', daemon=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written_count = 0
+        self.error = None
+        self._queue = queue.Queue()
+
+    # 1記事分の(sql, params)のリストをキューに入れる。リストの中の文は全て同じトランザクションで実行される
+    def put(self, statements):
+        if self.error is not None:
+            raise RuntimeError(f'sqlite3への書き込みスレッドが停止しています: {self.error}')
+        self._queue.put(list(statements))
+
+    def run(self):
+        try:
+            conn = sqlite3.connect(self.path)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL') # WALモードではNORMALでもコミット済みのデータは失われない
+        except sqlite3.Error as e:
+            self.error = e
+            logger.critical(f'書き込みスレッドでのデータベース接続エラー: {e}')
+            return
+
+        pending = []
+        deadline = None
+        stopping = False
+        try:
+            while not stopping:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+
+                if item is _STOP:
+                    stopping = True
+                elif item is not None:
+                    pending.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+
+                if pending and (stopping or len(pending) >= self.batch_size or time.monotonic() >= deadline):
+                    self._flush(conn, pending)
+                    pending = []
+                    deadline = None
+        except sqlite3.Error as e:
+            self.error = e
+            logger.critical(f'データベースエラーが発生しました。まだコミットされていない{len(pending)}件は保存されません: {e}')
+        finally:
+            conn.close()
+
+    def _flush(self, conn, pending):
+        with conn: # withブロックを抜けるときにまとめてコミット、例外の場合はロールバックされる
+            for statements in pending:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+        self.written_count += len(pending)
+        logger.info(f'{len(pending)}件をまとめてコミットしました(合計{self.written_count}件)')
+
+    # キューに残っている分を全て書き込んでからスレッドを終了する
+    def close(self):
+        self._queue.put(_STOP)
+        self.join()
+        if self.error is not None:
+            raise RuntimeError(f'sqlite3への書き込み中にエラーが発生しました: {self.error}')
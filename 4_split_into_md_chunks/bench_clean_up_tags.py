@@ -0,0 +1,106 @@
+"""
+clean_up_tags()の回帰テストとベンチマーク。
+knowledge.sqlite3に保存されている記事(split_and_make_md_chunks_json.pyと同じクエリで読む)に対して、
+従来の「規則ごとに木全体をfind_allする」方式と、現在の1回だけ木を辿る方式の出力がバイト単位で一致するかを確認し、処理時間を比べる。
+split_and_make_md_chunks_json.pyと同じディレクトリ(cfg.SQLITE_PATHが指す場所)で実行する。
+
+python bench_clean_up_tags.py [記事数の上限]
+"""
+
+import re
+import sqlite3
+import sys
+import time
+from bs4 import BeautifulSoup
+from split_and_make_md_chunks_json import clean_up_tags, DATA_FETCH_QUERY, DATA_FETCH_PARAMS, SQLITE_PATH
+import content_store
+
+REPEAT = 3
+
+
+# 比較用の、変更前のclean_up_tags()
+def clean_up_tags_reference(html):
+    html = re.sub(r'&nbsp;', ' ', html)
+    soup = BeautifulSoup(html, 'html.parser')
+
+    for gkms_element in soup.find_all('gkms-context-selector'):
+        gkms_element.decompose()
+
+    for el in soup.select('div.zippy-container > h2, div.zippy-container > a'):
+        h3 = soup.new_tag('h3')
+        h3.string = el.get_text(strip=True)
+        el.replace_with(h3)
+
+    for img in soup.find_all('img'):
+        img.decompose()
+
+    for iframe in soup.find_all('iframe'):
+        iframe.decompose()
+
+    for div in soup.find_all('div'):
+        div.unwrap()
+
+    for table in soup.find_all('table'):
+        br = soup.new_tag('br')
+        table.insert_before(br)
+
+    for tag in soup(['a', 'p', 'h2', 'h3', 'h4', 'span']):
+        if len(tag.get_text(strip=True)) == 0:
+            tag.decompose()
+
+    for span in soup.find_all('span'):
+        span.unwrap()
+
+    html = str(soup)
+
+    html = re.sub(r'(\n[ \t]*){3,}', '\n\n', html)
+
+    return html
+
+
+def load_contents(limit):
+    conn = sqlite3.connect(SQLITE_PATH)
+    try:
+        conn.text_factory = lambda x: str(x, 'utf-8', 'ignore')
+        content_store.register_functions(conn)
+        rows = conn.execute(DATA_FETCH_QUERY, DATA_FETCH_PARAMS).fetchmany(limit) if limit else conn.execute(DATA_FETCH_QUERY, DATA_FETCH_PARAMS).fetchall()
+        return [(row[2], row[3]) for row in rows]
+    finally:
+        conn.close()
+
+
+def bench(name, func, contents):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        results = [func(content) for _, content in contents]
+    elapsed = time.perf_counter() - start
+    per_article = elapsed / (REPEAT * len(contents)) * 1000
+    print(f'{name:<16} {per_article:8.2f} ms/記事')
+    return results, per_article
+
+
+def main():
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+    try:
+        contents = load_contents(limit)
+    except sqlite3.Error as e:
+        print(f'データベースの読み込みに失敗しました: {e}')
+        sys.exit(1)
+    if not contents:
+        print(f'記事が見つかりません: {SQLITE_PATH}')
+        sys.exit(1)
+    print(f'{len(contents)}記事 x {REPEAT}回')
+
+    expected, baseline = bench('従来', clean_up_tags_reference, contents)
+    results, per_article = bench('1回の走査', clean_up_tags, contents)
+
+    mismatches = [url for (url, _), old, new in zip(contents, expected, results) if old != new]
+    print(f'{"":<16} x{baseline / per_article:.2f}  一致しない記事: {len(mismatches)}件')
+    for url in mismatches[:10]:
+        print(f'  {url}')
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
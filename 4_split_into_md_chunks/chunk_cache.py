@@ -0,0 +1,74 @@
+"""
+4の分割結果のキャッシュ。スナップショットが変わっても内容の変わらない記事は、clean_up_tags()とsplitter()をやり直さずに前回の結果を使う。
+キーは「記事のhtmlのハッシュ値(sha256)」と「分割の設定(クリーンアップの版、MIN/MAXの値など。params_key()で作る)」の組み合わせで、
+値はsplitter()が返したマークダウンのチャンクのリスト(メタ情報を付ける前のもの)をjsonにして圧縮したもの。
+urlとカテゴリは末尾に付けるだけなのでキーに含めず、further_clean_up()は毎回行う。
+読み書きはメインプロセスだけで行い、書き込みはbatch_size件ごとにまとめてコミットする。
+"""
+
+import json
+import sqlite3
+import time
+import content_store
+
+CACHE_CODEC = 'zlib'
+
+
+# 分割結果に影響する設定をまとめて1つの文字列にする。どれかが変われば別のキーになるので、古い結果は使われない
+def params_key(**params):
+    return json.dumps(params, sort_keys=True, ensure_ascii=False)
+
+
+class ChunkCache:
+    def __init__(self, path, params, batch_size=100):
+        self.params = params
+        self.batch_size = batch_size
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS chunk_cache (
+            html_hash TEXT NOT NULL,
+            params TEXT NOT NULL,
+            codec TEXT NOT NULL,
+            data BLOB NOT NULL, -- splitter()の結果(文字列のリスト)のjsonを圧縮したもの
+            created_at REAL NOT NULL,
+            PRIMARY KEY (html_hash, params)
+        ) WITHOUT ROWID
+        ''')
+        self.conn.commit()
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, html_hash):
+        row = self.conn.execute('SELECT codec, data FROM chunk_cache WHERE html_hash = ? AND params = ?',
+                                (html_hash, self.params)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(content_store.decompress(row[0], row[1]))
+
+    def put(self, html_hash, chunks):
+        data = content_store.compress(json.dumps(chunks, ensure_ascii=False), CACHE_CODEC)
+        self.pending.append((html_hash, self.params, CACHE_CODEC, data, time.time()))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO chunk_cache (html_hash, params, codec, data, created_at) VALUES (?, ?, ?, ?, ?)',
+                                  self.pending)
+        self.pending = []
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
@@ -2,29 +2,64 @@
 sqlite3のデータベースから所定の言語バージョンのテーブルデータをfetchして、
 すべてのデータを分割と同時にhtml2textというパッケージを使ってマークダウン形式に変換し、
 json形式で保存する
+データベースの行はfetchmanyで少しずつ読む。cfg.JSON_FILE_NAMEの拡張子を.jsonlにすると、チャンクができた順に1行ずつJSON Linesで書き出し、
+各チャンクに元記事のurl、カテゴリ、記事ID、記事内での番号も記録する(chunk_io.py)。この場合は全チャンクをメモリに持たない。
+記事ごとの処理は互いに独立しているので、--workers N(またはcfg.CHUNK_WORKERS)でNプロセスに分けて並列に処理できる。出力の順番は変わらない。
+3でcfg.LANGUAGESを指定して複数言語をまとめて描画した場合は、全言語共通のcfg.ARTICLES_TABLE_NAMEからcfg.LANGUAGEの分だけを読む
+cfg.CHUNK_SIZE_UNIT = 'tokens'にすると、チャンクの大きさを文字数ではなくトークン数(token_estimator.py)で測るので、
+言語ごとにMIN_LENGTH, MAX_LENGTHを調整しなくても、どの言語でもembeddingのモデルの入力をほぼ同じだけ使うチャンクになる
+cfg.CHUNK_CACHE_ENABLEDがTrueなら、記事のhtmlと分割の設定が前回と同じ場合は前回の分割結果を使う(chunk_cache.py)。--no-cacheで使わないようにできる
+--profile timersで記事ごとの処理段階別の時間を、--profile cprofileでcProfileによる関数ごとの時間を表示する
 '''
 
+import argparse
+import cProfile
 import json
 import sqlite3
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 import html2text
 import re
 from urllib.parse import urlparse
 import logging
+import pstats
 import sys
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, CData, NavigableString, Tag
 import os
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_root)
 import config as cfg
+import content_store
+from chunk_cache import ChunkCache, params_key
+from chunk_io import is_jsonl, write_jsonl_record
+from token_estimator import TokenCounter
+from url_canon import answer_id
 
 LANGUAGE = cfg.LANGUAGE
 SQLITE_PATH = cfg.SQLITE_PATH
 SQLITE_TABLE_NAME = cfg.SQLITE_TABLE_NAME
+ARTICLES_TABLE_NAME = cfg.ARTICLES_TABLE_NAME
 # 指定されたテーブルから4つの特定のカラムのデータを取得し、可能であればそれらをID順にソートするクエリ
 DATA_FETCH_QUERY = f"SELECT id, category, reference_url, content FROM {SQLITE_TABLE_NAME} ORDER BY id"
+DATA_FETCH_PARAMS = ()
+if cfg.LANGUAGES:
+    # 全言語共通のテーブルの場合は、csvの行番号(row_index)+1を従来のidとして扱う
+    DATA_FETCH_QUERY = f"SELECT row_index + 1, category, reference_url, content FROM {ARTICLES_TABLE_NAME} WHERE language = ? ORDER BY row_index"
+    DATA_FETCH_PARAMS = (LANGUAGE,)
 JSON_FILE_NAME = cfg.JSON_FILE_NAME
 MIN_LENGTH = cfg.MIN_LENGTH
 MAX_LENGTH = cfg.MAX_LENGTH
+CHUNK_WORKERS = cfg.CHUNK_WORKERS
+CHUNK_SIZE_UNIT = cfg.CHUNK_SIZE_UNIT
+MIN_TOKENS = cfg.MIN_TOKENS
+MAX_TOKENS = cfg.MAX_TOKENS
+CHUNK_CACHE_ENABLED = cfg.CHUNK_CACHE_ENABLED
+CHUNK_CACHE_PATH = cfg.CHUNK_CACHE_PATH
+FETCH_BATCH_SIZE = 50 # データベースから1回に読む行数
+MAX_PENDING_PER_WORKER = 4 # プロセスプールに投入しておく、結果待ちの記事の数(1プロセスあたり)。これ以上は先読みしない
+PROGRESS_EVERY = 100 # この記事数ごとに進捗をログに出す
+PROFILE_TOP = 30 # --profile cprofileの場合に表示する関数の数
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -34,49 +69,108 @@ handler.setLevel(logging.DEBUG)
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+# 各チャンクのトークン数の記録と、CHUNK_SIZE_UNIT = 'tokens'の場合の分割に使う
+TOKEN_COUNTER = TokenCounter()
+
+
+# 正規表現は記事ごとにコンパイルし直さないよう、読み込み時に1回だけコンパイルしておく
+BLANK_LINES_PATTERN = re.compile(r'(\n[ \t]*){3,}')
+# URLの基本的な構造をチェックする正規表現パターン
+URL_PATTERN = re.compile(
+    r'^(?:http|ftp)s?://'
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'
+    r'localhost|'
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'
+    r'(?::\d+)?'
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+# \n に続いてスペースやタブのみがあり、その後に \n が続く場合。[ \t]+ はスペースまたはタブが1回以上続くことを意味します
+WHITESPACE_LINE_PATTERN = re.compile(r'\n[ \t]+\n')
+# 3つ以上の連続する改行
+MULTIPLE_NEWLINES_PATTERN = re.compile(r'\n{3,}')
+
+# clean_up_tags(), splitter()とhtml2textの設定の版。分割結果が変わる変更をしたら上げる(上げると前回までのキャッシュは使われなくなる)
+CLEANER_VERSION = 1
+# div.zippy-containerの直下にあればh3に置き換える見出しのタグ
+ZIPPY_HEADING_TAGS = {'h2', 'a'}
+# 中身の文字列が空(空白のみ)なら削除するタグ
+EMPTY_REMOVABLE_TAGS = {'a', 'p', 'h2', 'h3', 'h4', 'span'}
+# 文字列として数える種類。get_text()と同じく、コメントやscript, styleの中身は数えない
+TEXT_STRING_TYPES = {NavigableString, CData}
+
+
+# zippyの見出し(div.zippy-container > h2, a)の文字列。gkms-context-selectorの中身は含めない
+def zippy_heading_text(tag):
+    for gkms_element in tag.find_all('gkms-context-selector'):
+        gkms_element.decompose()
+    return tag.get_text(strip=True)
 
-def clean_up_tags(html):
-    html = re.sub(r'&nbsp;', ' ', html)
-    soup = BeautifulSoup(html, 'html.parser')
 
-    for gkms_element in soup.find_all('gkms-context-selector'):
-        gkms_element.decompose()
+# div.zippy-containerの直下のh2, aを、中身のテキスト部だけ取り出したh3タグで置き換える
+def replace_zippy_headings(soup, zippy):
+    for child in list(zippy.contents):
+        if isinstance(child, Tag) and child.name in ZIPPY_HEADING_TAGS:
+            h3 = soup.new_tag('h3')
+            h3.string = zippy_heading_text(child)
+            child.replace_with(h3)
 
-    # div.zippy-container > h2 または div.zippy-container > a を選択し、中身のテキスト部だけ取り出してh3タグで囲む
-    for el in soup.select('div.zippy-container > h2, div.zippy-container > a'):
-        # 新しいh3要素を作成
-        h3 = soup.new_tag('h3')
-        # テキスト内容を抽出
-        text_content = el.get_text(strip=True)
-        # 新しいh3要素にテキスト内容をセット
-        h3.string = text_content
-        # 元の要素をh3で置換
-        el.replace_with(h3)
 
-    for img in soup.find_all('img'):
-        img.decompose()
+# parentの子孫を1回だけ辿りながら、clean_up_tagsの全ての規則を適用する。parentの中に文字列が残っていればTrueを返す。
+# divは中に入る前にunwrapするので、各要素が移動するのは1回だけで済む。空のタグの判定は子を処理した結果から行うので、get_text()を何度も呼ばない
+def clean_up_children(soup, parent):
+    has_text = False
+    contents = parent.contents
+    i = 0
+    while i < len(contents):
+        child = contents[i]
+        if not isinstance(child, Tag):
+            if type(child) in TEXT_STRING_TYPES and child.strip():
+                has_text = True
+            i += 1
+            continue
+
+        name = child.name
+        if name == 'gkms-context-selector' or name == 'img' or name == 'iframe':
+            child.decompose()
+            continue
+
+        if name == 'div':
+            # zippyの見出しを置き換えてからdivの中身を親に移し、移した中身を続けてこのループで処理する
+            if 'zippy-container' in child.get('class', ()):
+                replace_zippy_headings(soup, child)
+            child.unwrap()
+            continue
+
+        #divタグを消去すると特殊なケースでtableタグの直前で段落の区切りがなくなり最初のセルがおかしくなる問題に対処する
+        if name == 'table':
+            child.insert_before(soup.new_tag('br'))
+            i += 1
 
-    for iframe in soup.find_all('iframe'):
-        iframe.decompose()
+        child_has_text = clean_up_children(soup, child)
+        if name in EMPTY_REMOVABLE_TAGS and not child_has_text:
+            child.decompose()
+            continue
 
-    for div in soup.find_all('div'):
-        div.unwrap()
+        if name == 'span':
+            moved = len(child.contents)
+            child.unwrap()
+            i += moved
+        else:
+            i += 1
+        has_text = has_text or child_has_text
+    return has_text
 
-    #上でdivタグを消去したために特殊なケースでtableタグの直前で段落の区切りがなくなり最初のセルがおかしくなる問題に対処する
-    for table in soup.find_all('table'):
-        br = soup.new_tag('br')
-        table.insert_before(br)
 
-    for tag in soup(['a', 'p', 'h2', 'h3', 'h4', 'span']):
-        if len(tag.get_text(strip=True)) == 0:
-            tag.decompose()
+def clean_up_tags(html):
+    html = html.replace('&nbsp;', ' ')
+    soup = BeautifulSoup(html, 'html.parser')
 
-    for span in soup.find_all('span'):
-        span.unwrap()
+    # gkms-context-selector, img, iframeの削除、zippyの見出しのh3への置き換え、divとspanのunwrap、
+    # tableの直前へのbrの挿入、空のタグの削除を、木を1回辿るだけでまとめて行う
+    clean_up_children(soup, soup)
 
     html = str(soup)
 
-    html = re.sub(r'(\n[ \t]*){3,}', '\n\n', html)
+    html = BLANK_LINES_PATTERN.sub('\n\n', html)
 
     return html
 
@@ -90,17 +184,8 @@ def edit_category(text):
 
 
 def validate_url(url):
-    # URLの基本的な構造をチェックする正規表現パターン
-    pattern = re.compile(
-        r'^(?:http|ftp)s?://'
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'
-        r'localhost|'
-        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'
-        r'(?::\d+)?'
-        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-
     # 正規表現パターンにマッチするかチェック
-    if not re.match(pattern, url):
+    if not URL_PATTERN.match(url):
         logger.error(f"URL文字列に問題があるようです")
         return False
 
@@ -113,79 +198,66 @@ def validate_url(url):
         return False
 
 
-def splitter(lines, mdconv, target_count):
+def splitter(lines, mdconv, target_count, measure=len, min_length=MIN_LENGTH):
     # h1, h2, h3, h4が出てきた場合はその直前の行で分割。またはtarget_count以上の長さになった場合はそこで分割
+    # 長さはmeasure(行)の合計。文字数ならlen、トークン数ならTOKEN_COUNTER.count_htmlを渡す。1行につき1回だけ測る
+    # 作りかけのchunkは行のリスト(parts)とその合計の長さ(length)で持ち、文字列の連結とlen()を行ごとに繰り返さない。
+    # 新しいchunkの先頭に付ける見出しの行(h1+h2, h1+h2+h3+h4)は、見出しが変わったときだけ作り直す。
+    # マークダウンへの変換はchunkを確定したときに1回だけ行う(見出しを別に変換して連結すると、見出しの後の改行が変わってしまうため)
     try:
         h1, h2, h3, h4 = "", "", "", ""
+        section_header = "" # h1 + h2
+        full_header = "" # h1 + h2 + h3 + h4
+        h1_length, section_header_length, full_header_length = 0, 0, 0
         chunks = []
-        temp_chunk = ""
+        parts = []
+        length = 0
 
         for line in lines:
-        #     if '<h1' in line:
-        #         h1 = mdconv.handle(line)
-        #         h2, h3, h4 = "", "", ""
-        #         if len(temp_chunk) > MIN_LENGTH:
-        #             chunks.append(temp_chunk)
-        #             temp_chunk = ""
-        #     elif '<h2' in line:
-        #         h2 = mdconv.handle(line)
-        #         h3, h4 = "", ""
-        #         if len(temp_chunk) > MIN_LENGTH:
-        #             chunks.append(temp_chunk)
-        #             temp_chunk = h1
-        #     elif '<h3' in line:
-        #         h3 = mdconv.handle(line)
-        #         h4 = ""
-        #         if len(temp_chunk) > MIN_LENGTH:
-        #             chunks.append(temp_chunk)
-        #             temp_chunk = h1 + h2
-        #     elif '<h4' in line:
-        #         h4 = mdconv.handle(line)
-        #         h3 = "" # h3とh4を同列で扱っている。これは両方のヒエラルキーがはっきりしていない為の妥協策
-        #         if len(temp_chunk) > MIN_LENGTH:
-        #             chunks.append(temp_chunk)
-        #             temp_chunk = h1 + h2
-        #     temp_chunk += mdconv.handle(line)
-
-        #     if len(temp_chunk) > target_count:
-        #         chunks.append(temp_chunk)
-        #         temp_chunk = h1 + h2 + h3 + h4 + line # 最後の１行を次のchunkの最初に加えている
-
-        # chunks.append(temp_chunk)
-        # return chunks
-
+            is_header = True
             if '<h1' in line:
                 h1 = line
                 h2, h3, h4 = "", "", ""
-                if len(temp_chunk) > MIN_LENGTH:
-                    chunks.append(mdconv.handle(temp_chunk))
-                    temp_chunk = ""
+                if length > min_length:
+                    chunks.append(mdconv.handle(''.join(parts)))
+                    parts, length = [], 0
             elif '<h2' in line:
                 h2 = line
                 h3, h4 = "", ""
-                if len(temp_chunk) > MIN_LENGTH:
-                    chunks.append(mdconv.handle(temp_chunk))
-                    temp_chunk = h1
+                if length > min_length:
+                    chunks.append(mdconv.handle(''.join(parts)))
+                    parts, length = [h1], h1_length
             elif '<h3' in line:
                 h3 = line
                 h4 = ""
-                if len(temp_chunk) > MIN_LENGTH:
-                    chunks.append(mdconv.handle(temp_chunk))
-                    temp_chunk = h1 + h2
+                if length > min_length:
+                    chunks.append(mdconv.handle(''.join(parts)))
+                    parts, length = [section_header], section_header_length
             elif '<h4' in line:
                 h4 = line
                 h3 = "" # h3とh4を同列で扱っている。これは両方のヒエラルキーがはっきりしていない為の妥協策
-                if len(temp_chunk) > MIN_LENGTH:
-                    chunks.append(mdconv.handle(temp_chunk))
-                    temp_chunk = h1 + h2
-
-            temp_chunk += line
-
-            if len(temp_chunk) > target_count:
-                chunks.append(mdconv.handle(temp_chunk))
-                temp_chunk = h1 + h2 + h3 + h4 + line # 最後の１行を次のchunkの最初に加えている
-
-        chunks.append(mdconv.handle(temp_chunk))
+                if length > min_length:
+                    chunks.append(mdconv.handle(''.join(parts)))
+                    parts, length = [section_header], section_header_length
+            else:
+                is_header = False
+
+            line_length = measure(line)
+            if is_header:
+                section_header = h1 + h2
+                full_header = section_header + h3 + h4
+                h1_length = measure(h1)
+                section_header_length = measure(section_header)
+                full_header_length = measure(full_header)
+
+            parts.append(line)
+            length += line_length
+
+            if length > target_count:
+                chunks.append(mdconv.handle(''.join(parts)))
+                parts, length = [full_header, line], full_header_length + line_length # 最後の１行を次のchunkの最初に加えている
+
+        chunks.append(mdconv.handle(''.join(parts)))
         return chunks
 
     except Exception as e:
@@ -198,11 +270,9 @@ def further_clean_up(chunks, meta):
         cleaned_chunks = []
         for chunk in chunks:
             with_meta = chunk + meta + "\n"
-            # 正規表現パターン: \n に続いてスペースやタブのみがあり、その後に \n が続く場合。
-            # [ \t]+ はスペースまたはタブが1回以上続くことを意味します
-            cleaned_chunk = re.sub(r'\n[ \t]+\n', '\n\n', with_meta)
+            cleaned_chunk = WHITESPACE_LINE_PATTERN.sub('\n\n', with_meta)
             # 3つ以上の連続する改行を2つの改行に置き換える
-            cleaned_chunk = re.sub(r'\n{3,}', '\n\n', cleaned_chunk)
+            cleaned_chunk = MULTIPLE_NEWLINES_PATTERN.sub('\n\n', cleaned_chunk)
             cleaned_chunk = cleaned_chunk + "\n"
             cleaned_chunks.append(cleaned_chunk)
         return cleaned_chunks
@@ -212,18 +282,25 @@ def further_clean_up(chunks, meta):
         raise
 
 
-def get_data():
+# 行をFETCH_BATCH_SIZE行ずつ読んで1行ずつ返すジェネレーター。全ての行を一度にメモリに読み込まない
+def iter_data():
+    conn = sqlite3.connect(SQLITE_PATH)
     try:
-        with sqlite3.connect(SQLITE_PATH) as conn:
-            conn.text_factory = lambda x: str(x, 'utf-8', 'ignore')
-            cursor = conn.cursor()
-            cursor.execute(DATA_FETCH_QUERY)
-            data = cursor.fetchall()
-            return data
+        conn.text_factory = lambda x: str(x, 'utf-8', 'ignore')
+        content_store.register_functions(conn) # テーブルが正規化したスキーマのviewの場合に本文を展開するため
+        cursor = conn.cursor()
+        cursor.execute(DATA_FETCH_QUERY, DATA_FETCH_PARAMS)
+        while True:
+            rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not rows:
+                return
+            yield from rows
 
     except sqlite3.Error as e:
         logger.error(f"データベースの操作中にエラーが発生しました: {str(e)}", exc_info=True)
         raise
+    finally:
+        conn.close()
 
 
 def write_json(chunks_json):
@@ -239,69 +316,252 @@ def write_json(chunks_json):
         raise
 
 
-def main():
-    try:
-        data = get_data()
-        logger.info("sqlite3のデータベースからデータを取得しました")
-    except sqlite3.Error:
-        sys.exit(1)
-    except Exception as e:
-        logger.error(f"データベース操作中に予期せぬエラーが発生しました: {str(e)}", exc_info=True)
-        sys.exit(1)
-
-    chunks_json = []
-    i = 0
-    for row in data:
-        try:
-            i += 1
-            print(i)
-            category = edit_category(row[1])
-
-            url = row[2]
-            # 各チャンクの末尾に付けられるurlを言語設定に合わせる
-            url = url.replace('?hl=en', f'?hl={LANGUAGE}') if LANGUAGE != 'en' else url
+# 分割結果のキャッシュのキーに含める設定
+def split_params():
+    if CHUNK_SIZE_UNIT == 'tokens':
+        return params_key(cleaner_version=CLEANER_VERSION, unit=CHUNK_SIZE_UNIT, min=MIN_TOKENS, max=MAX_TOKENS, tokenizer=TOKEN_COUNTER.name)
+    return params_key(cleaner_version=CLEANER_VERSION, unit=CHUNK_SIZE_UNIT, min=MIN_LENGTH, max=MAX_LENGTH)
 
-            if not validate_url(url):
-                logger.warning(f'無効なURLです。作業を中断します: url:{url}')
-                sys.exit(1)
 
-            meta = "\n\n[SOURCE] " + url + "\n\n" + "[CATEGORY] " + category + "\n\n\n"
+# --profile timersの場合に、html2textでの変換にかかった時間をsplitter全体の時間とは別に数えるためのラッパー
+class TimedConverter:
+    def __init__(self, mdconv):
+        self.mdconv = mdconv
+        self.seconds = 0.0
 
-            content = row[3]
-
-            content = clean_up_tags(content)
-            #ここからの作業で、クリーンアップと分解を行う
-            # </h1>終了タグの直後に改行が含まれていないようなので、改行を入れる作業
-            h1Index = content.find('</h1>')
-            if h1Index != -1:
-                content = content[:h1Index + 5] + '\n' + content[h1Index + 5:]
-
-            mdconv = html2text.HTML2Text()
-            mdconv.unicode_snob = True
-            mdconv.ignore_links = True
-            mdconv.body_width = 0 #これがないと行が右に連なると\nが強制的に入ってしまう
+    def handle(self, html):
+        start = time.perf_counter()
+        try:
+            return self.mdconv.handle(html)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+# 記事をチャンクに分割する処理一式。1プロセスに1つだけ作り(init_engine())、全ての記事で使い回す。
+# 長さの測り方などの分割の設定は記事ごとに決め直さない。--workersの場合は各子プロセスの起動時に作る。
+# html2textの変換器は記事をまたいで使い回すと、前の記事の途中の状態(リストや段落の区切りなど)が残って出力が変わるので、
+# new_converter()で記事ごとに設定済みのものを作る(作るのにかかるのは数マイクロ秒)
+class ChunkEngine:
+    def __init__(self, profile=None):
+        self.profile = profile
+        if CHUNK_SIZE_UNIT == 'tokens':
+            # タグはマークダウンに変換すると消えるので、タグを除いた文字列のトークン数で測る
+            self.measure, self.min_length = TOKEN_COUNTER.count_html, MIN_TOKENS
+        else:
+            self.measure, self.min_length = len, MIN_LENGTH
+
+    @staticmethod
+    def new_converter():
+        mdconv = html2text.HTML2Text()
+        mdconv.unicode_snob = True
+        mdconv.ignore_links = True
+        mdconv.body_width = 0 #これがないと行が右に連なると\nが強制的に入ってしまう
+        return mdconv
+
+    def target_count(self, content):
+        if CHUNK_SIZE_UNIT == 'tokens':
+            return MAX_TOKENS * 0.98 # 2%分を引くのは文字数の場合の100文字と同じ理由
+        char_count = len(content)
+        divisor =  char_count / MAX_LENGTH
+        return char_count / divisor - 100 # 100文字分を引くことによってさらに均等分割に近づくと思われる
+
+    # 1記事分(1行)をチャンクに分割し、(チャンクのレコードのリスト, 処理段階ごとの秒数, キャッシュに保存する(htmlのハッシュ値, 分割結果))を返す。
+    # cached_chunksがあればクリーンアップと分割を省いてそれを使い、キャッシュに保存するものはNoneになる
+    def process_row(self, row, html_hash=None, cached_chunks=None):
+        timings = {}
+        category = edit_category(row[1])
+
+        url = row[2]
+        # 各チャンクの末尾に付けられるurlを言語設定に合わせる
+        url = url.replace('?hl=en', f'?hl={LANGUAGE}') if LANGUAGE != 'en' else url
+
+        if not validate_url(url):
+            raise ValueError(f'無効なURLです。作業を中断します: url:{url}')
+
+        meta = "\n\n[SOURCE] " + url + "\n\n" + "[CATEGORY] " + category + "\n\n\n"
+
+        if cached_chunks is not None:
+            return self.make_records(row, url, category, meta, cached_chunks, timings), timings, None
+
+        content = row[3]
+
+        start = time.perf_counter()
+        content = clean_up_tags(content)
+        timings['clean_up_tags'] = time.perf_counter() - start
+        #ここからの作業で、クリーンアップと分解を行う
+        # </h1>終了タグの直後に改行が含まれていないようなので、改行を入れる作業
+        h1Index = content.find('</h1>')
+        if h1Index != -1:
+            content = content[:h1Index + 5] + '\n' + content[h1Index + 5:]
+
+        mdconv = self.new_converter()
+        if self.profile == 'timers':
+            mdconv = TimedConverter(mdconv)
+
+        start = time.perf_counter()
+        lines = content.split('\n')
+        chunks = splitter(lines, mdconv, self.target_count(content), self.measure, self.min_length)
+        timings['splitter'] = time.perf_counter() - start
+        if self.profile == 'timers':
+            timings['html2text'] = mdconv.seconds # splitterの時間のうち、マークダウンへの変換にかかった時間
+
+        if chunks == []:
+            raise ValueError(f'チャンク分割に失敗しました: url:{url}')
+
+        cache_entry = (html_hash, chunks) if html_hash else None
+        return self.make_records(row, url, category, meta, chunks, timings), timings, cache_entry
+
+    # splitter()の結果にメタ情報を付けて、チャンクのレコードのリストにする
+    def make_records(self, row, url, category, meta, chunks, timings):
+        start = time.perf_counter()
+        cleaned_chunks = further_clean_up(chunks, meta)
+        timings['further_clean_up'] = time.perf_counter() - start
+        if cleaned_chunks == []:
+            raise ValueError(f'チャンクのクリーンアップ中に問題が発生したようです: url:{url}')
+
+        start = time.perf_counter()
+        token_counts = [TOKEN_COUNTER.count(chunk) for chunk in cleaned_chunks]
+        timings['count_tokens'] = time.perf_counter() - start
+
+        return [{"content" : chunk, "source_url": url, "category": category, "article_id": answer_id(url), "row_id": row[0], "chunk_index": n, "token_count": tokens}
+                for n, (chunk, tokens) in enumerate(zip(cleaned_chunks, token_counts))]
+
+
+_engine = None
+
+
+# このプロセスのChunkEngineを作る。--workersの場合はProcessPoolExecutorのinitializerとして各子プロセスで1回だけ呼ばれる
+def init_engine(profile=None):
+    global _engine
+    _engine = ChunkEngine(profile)
+
+
+# --workersで並列に実行する場合は子プロセスで呼ばれるので、エラーは例外として呼び出し元に返す
+def process_row(row, html_hash=None, cached_chunks=None):
+    if _engine is None:
+        init_engine()
+    return _engine.process_row(row, html_hash, cached_chunks)
+
+
+# 記事ごとに、process_row()に渡す(row, htmlのハッシュ値, キャッシュにあった分割結果)を返すジェネレーター。cacheがNoneならキャッシュを使わない
+def iter_cache_lookups(rows, cache):
+    for row in rows:
+        if cache is None:
+            yield row, None, None
+            continue
+        html_hash = content_store.content_hash(row[3])
+        yield row, html_hash, cache.get(html_hash)
+
+
+# 記事を順に処理し、process_row()の結果を元の記事の順番で返すジェネレーター。itemsはprocess_row()の引数のタプル。
+# workersが2以上ならプロセスプールで並列に処理する。結果は投入した順に取り出すので、出力の順番は変わらない。
+# executor.mapは入力を最初に全て読んでしまうので使わず、結果待ちがMAX_PENDING_PER_WORKER * workers件を超えたら先頭の結果を待つ
+def iter_processed_rows(items, workers, profile=None):
+    if workers <= 1:
+        init_engine(profile)
+        for item in items:
+            yield process_row(*item)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_engine, initargs=(profile,)) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(process_row, *item))
+            if len(pending) >= workers * MAX_PENDING_PER_WORKER:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='sqlite3のhtmlをマークダウンのチャンクに分割してjsonに保存する')
+    parser.add_argument('--workers', type=int, default=CHUNK_WORKERS,
+                        help=f'記事を並列に処理するプロセス数。1なら並列にしない (デフォルト: cfg.CHUNK_WORKERS={CHUNK_WORKERS})')
+    parser.add_argument('--no-cache', action='store_true',
+                        help=f'分割結果のキャッシュ({CHUNK_CACHE_PATH})を使わずに全記事を分割し直す')
+    parser.add_argument('--profile', choices=['timers', 'cprofile'],
+                        help='timers: 記事ごとに処理段階別の時間(html2textでの変換を含む)をログに出す。'
+                             f'cprofile: cProfileで計測し、累積時間の多い{PROFILE_TOP}個の関数を最後に表示する(1プロセスで実行する)')
+    return parser.parse_args()
 
-            char_count = len(content)
-            divisor =  char_count / MAX_LENGTH
-            target_count = char_count / divisor - 100 # 100文字分を引くことによってさらに均等分割に近づくと思われる
 
-            lines = content.split('\n')
-            chunks = splitter(lines, mdconv, target_count)
+def main():
+    args = parse_args()
+    if args.profile == 'cprofile' and args.workers > 1:
+        # 子プロセスの中はcProfileで計測できないので、1プロセスで実行する
+        logger.warning("--profile cprofileの場合は1プロセスで処理します")
+        args.workers = 1
+    streaming = is_jsonl(JSON_FILE_NAME)
+    logger.info(f"{args.workers}プロセスで処理します" + (f"。チャンクはJSON Linesで順に書き出します: {JSON_FILE_NAME}" if streaming else ""))
+
+    cache = None
+    if CHUNK_CACHE_ENABLED and not args.no_cache:
+        try:
+            cache = ChunkCache(CHUNK_CACHE_PATH, split_params())
+        except sqlite3.Error as e:
+            logger.error(f"分割結果のキャッシュを開けませんでした: {str(e)}", exc_info=True)
+            sys.exit(1)
 
-            if chunks == []:
-                logger.error(f'チャンク分割に失敗しました: url:{url}')
-                raise
+    chunks_json = []
+    chunk_count = 0
+    article_count = 0
+    max_tokens = 0
+    over_limit_count = 0 # MAX_TOKENSを超えたチャンクの数
+    stage_seconds = Counter()
+    profiler = cProfile.Profile() if args.profile == 'cprofile' else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        jsonl_file = open(JSON_FILE_NAME, 'w', encoding='utf-8') if streaming else None
+        try:
+            for article_count, (records, timings, cache_entry) in enumerate(iter_processed_rows(iter_cache_lookups(iter_data(), cache), args.workers, args.profile), 1):
+                if cache_entry:
+                    cache.put(*cache_entry)
+                if streaming:
+                    for record in records:
+                        write_jsonl_record(jsonl_file, record)
+                else:
+                    chunks_json.extend({"content": record["content"]} for record in records)
+                chunk_count += len(records)
+                for record in records:
+                    max_tokens = max(max_tokens, record["token_count"])
+                    over_limit_count += record["token_count"] > MAX_TOKENS
+                stage_seconds.update(timings)
+                if args.profile == 'timers':
+                    logger.info(f"{records[0]['row_id']} {records[0]['source_url']}: " + ", ".join(f"{stage} {seconds * 1000:.1f}ms" for stage, seconds in timings.items()))
+                if article_count % PROGRESS_EVERY == 0:
+                    logger.info(f"{article_count}記事を処理しました")
+        finally:
+            if profiler:
+                profiler.disable()
+            if jsonl_file:
+                jsonl_file.close()
+            if cache:
+                cache.close()
 
-            cleaned_chunks = further_clean_up(chunks, meta)
-            if cleaned_chunks == []:
-                logger.error(f'チャンクのクリーンアップ中に問題が発生したようです: url:{url}')
-                raise
-            for chunk in cleaned_chunks:
-                chunks_json.append({"content" : chunk})
+    except sqlite3.Error:
+        sys.exit(1)
+    except (IOError, OSError) as e:
+        logger.error(f"JSON Linesファイルの書き込み中にエラーが発生しました: {str(e)}", exc_info=True)
+        sys.exit(1)
+    except Exception as e:
+        logger.error(f"{str(e)}")
+        sys.exit(1)
 
-        except Exception as e:
-            logger.error(f"{str(e)}")
-            sys.exit(1)
+    elapsed = time.perf_counter() - start
+    logger.info(f"{article_count}記事, {chunk_count}チャンク, {elapsed:.1f}秒 ({article_count / elapsed if elapsed else 0:.1f}記事/秒, {args.workers}プロセス)")
+    # 並列の場合は全プロセスの合計(CPU時間に近い)なので、経過時間より長くなる
+    logger.info("処理段階ごとの合計時間: " + ", ".join(f"{stage} {seconds:.1f}秒" for stage, seconds in stage_seconds.items()))
+    if cache:
+        logger.info(f"分割結果のキャッシュ: {cache.hits}記事ヒット, {cache.misses}記事分割 (ヒット率 {cache.hit_rate():.1%})")
+    if profiler:
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    logger.info(f"チャンクの大きさ: {CHUNK_SIZE_UNIT}, トークン数({TOKEN_COUNTER.name}): 最大{max_tokens}, {MAX_TOKENS}を超えたチャンク{over_limit_count}個")
+
+    if streaming:
+        logger.info("JSON Linesファイルの書き込みが完了しました")
+        print(chunk_count)
+        return
 
     try:
         write_json(chunks_json)
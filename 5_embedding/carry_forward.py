@@ -0,0 +1,35 @@
+"""
+差分実行(cfg.DELTA_MODE)用に、前回のチャンク(jsonまたはjsonl)とFAISSインデックスから「チャンクの内容 → ベクトル」の対応を作る。
+内容が全く同じチャンクは、embeddingをやり直さずに前回のベクトルをそのまま使う。
+前回のインデックスがIndexIDMap2(cfg.FAISS_ID_MAP)で対応表(vector_metadata.py)があれば、内容のハッシュ値からベクトルIDを引いて対応させる。
+そうでなければ、jsonの順にベクトルを追加したものとして位置で対応させる。
+"""
+
+import faiss
+from chunk_io import iter_chunk_contents
+from content_store import content_hash
+from vector_metadata import VectorMetadata, metadata_path
+
+
+def load_previous_vectors(json_path, faiss_path):
+    previous_chunks = list(iter_chunk_contents(json_path))
+
+    index = faiss.read_index(str(faiss_path))
+    if hasattr(index, 'id_map') and metadata_path(faiss_path).exists():
+        meta = VectorMetadata(metadata_path(faiss_path))
+        try:
+            ids = meta.ids_by_content_hash()
+        finally:
+            meta.close()
+        vectors = {}
+        for chunk in previous_chunks:
+            vector_id = ids.get(content_hash(chunk))
+            if vector_id is not None:
+                vectors[chunk] = index.reconstruct(int(vector_id))
+        return vectors
+
+    if index.ntotal != len(previous_chunks):
+        raise ValueError(f'前回のチャンク数({len(previous_chunks)})とベクトル数({index.ntotal})が一致しません')
+
+    vectors = index.reconstruct_n(0, index.ntotal)
+    return {chunk: vectors[i] for i, chunk in enumerate(previous_chunks)}
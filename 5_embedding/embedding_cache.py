@@ -0,0 +1,59 @@
+"""
+embeddingのベクトルのキャッシュ。キーは「チャンクの内容のハッシュ値(sha256)」と「モデル名」の組み合わせで、値はfloat32のベクトルのバイト列。
+carry_forward.py(差分実行)は直前の1回分のインデックスからしか引き継げないが、こちらは実行をまたいで全てのベクトルを保存しておくので、
+どのスナップショットのチャンクでも、一度embeddingした内容はAPIに送らずに済む。
+"""
+
+import sqlite3
+import time
+import numpy as np
+from content_store import content_hash
+
+
+class EmbeddingCache:
+    def __init__(self, path, model, dimension):
+        self.model = model
+        self.dimension = dimension
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS embeddings (
+            chunk_hash TEXT NOT NULL,
+            model TEXT NOT NULL,
+            dimension INTEGER NOT NULL,
+            vector BLOB NOT NULL, -- float32のバイト列
+            created_at REAL NOT NULL,
+            PRIMARY KEY (chunk_hash, model)
+        ) WITHOUT ROWID
+        ''')
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    # chunksのうちキャッシュにあるものの{チャンク: ベクトル}を返す
+    def get_many(self, chunks):
+        if not chunks:
+            return {}
+        hashes = {content_hash(chunk): chunk for chunk in chunks}
+        placeholders = ', '.join('?' * len(hashes))
+        rows = self.conn.execute(f'SELECT chunk_hash, vector FROM embeddings WHERE model = ? AND dimension = ? AND chunk_hash IN ({placeholders})',
+                                 (self.model, self.dimension, *hashes)).fetchall()
+        found = {hashes[chunk_hash]: np.frombuffer(vector, dtype=np.float32) for chunk_hash, vector in rows}
+        self.hits += sum(1 for chunk in chunks if chunk in found)
+        self.misses += sum(1 for chunk in chunks if chunk not in found)
+        return found
+
+    # {チャンク: ベクトル}をまとめて1つのトランザクションで保存する
+    def put_many(self, vectors):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO embeddings (chunk_hash, model, dimension, vector, created_at) VALUES (?, ?, ?, ?, ?)',
+                                  [(content_hash(chunk), self.model, self.dimension, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                                   for chunk, vector in vectors.items()])
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,204 @@
+"""
+embeddingのAPIにバッチを並行して送るための共通の実行部分。gemini_embedding.pyとopenai_embedding.pyで使う。
+- 1バッチずつ送って毎回固定の秒数sleepする代わりに、最大concurrency個のバッチを同時に送る
+- 送る前にトークンバケット(1分あたりのリクエスト数rpmとトークン数tpm)で待つので、クォータを超えない範囲でできるだけ速く送れる
+- 429が返ってきたら、Retry-After(なければジッター付き指数バックオフ)の間は全てのバッチの送信を止め、失敗したバッチだけを送り直す。
+  あわせてrpmを下げ、その後はリクエストが成功するたびに少しずつ設定したrpmまで戻す(AIMD)
+  5xxや通信エラーも同じように、そのバッチだけをリトライする
+- 結果はバッチを渡した順に返すので、FAISSのインデックスにはjsonの順にベクトルを追加できる
+APIはSDKを使わずにRESTで呼ぶ(requests)。送り先(base_url)を変えれば、mock_embedding_server.pyに対して試せる。
+"""
+
+import asyncio
+import logging
+import random
+import time
+from collections import Counter, deque
+import requests
+from requests.adapters import HTTPAdapter
+from http_fetch import parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = {500, 502, 503, 504}
+
+
+# 429が返ってきた場合の例外。retry_afterはRetry-Afterヘッダーの秒数(なければNone)
+class RateLimited(Exception):
+    def __init__(self, retry_after=None):
+        super().__init__(f'レート制限(429)に達しました。Retry-After: {retry_after}')
+        self.retry_after = retry_after
+
+
+# 5xxや通信エラーなど、同じバッチを送り直せば成功する見込みのある失敗
+class TransientError(Exception):
+    pass
+
+
+class RestProvider:
+    def __init__(self, base_url, timeout=60, pool_size=10):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def post(self, path, payload, headers):
+        try:
+            response = self.session.post(self.base_url + path, json=payload, headers=headers, timeout=self.timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            raise TransientError(f'通信エラー: {e}') from e
+        if response.status_code == 429:
+            raise RateLimited(parse_retry_after(response.headers.get('Retry-After')))
+        if response.status_code in RETRY_STATUS_CODES:
+            raise TransientError(f'ステータス{response.status_code}: {response.text[:200]}')
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self.session.close()
+
+
+class GeminiProvider(RestProvider):
+    def __init__(self, api_key, model, base_url, task_type='RETRIEVAL_DOCUMENT', **kwargs):
+        super().__init__(base_url, **kwargs)
+        self.api_key = api_key
+        self.model = model if model.startswith('models/') else f'models/{model}'
+        self.task_type = task_type
+
+    # textsのベクトル(floatのリスト)のリストを返す
+    def embed(self, texts):
+        payload = {'requests': [{'model': self.model, 'content': {'parts': [{'text': text}]}, 'taskType': self.task_type, 'title': ''}
+                                for text in texts]}
+        result = self.post(f'/v1beta/{self.model}:batchEmbedContents', payload, {'x-goog-api-key': self.api_key})
+        return [embedding['values'] for embedding in result['embeddings']]
+
+
+class OpenAIProvider(RestProvider):
+    def __init__(self, api_key, model, base_url, **kwargs):
+        super().__init__(base_url, **kwargs)
+        self.api_key = api_key
+        self.model = model
+
+    def embed(self, texts):
+        result = self.post('/v1/embeddings', {'model': self.model, 'input': texts}, {'Authorization': f'Bearer {self.api_key}'})
+        return [item['embedding'] for item in sorted(result['data'], key=lambda item: item['index'])]
+
+
+# 1分あたりのリクエスト数(rpm)とトークン数(tpm)のトークンバケット。全てのバッチで1つを共有する。
+# バケットは1分分まで貯まり、空になったら必要な分が貯まるまで待つ。pause()で全体の送信を一定時間止められ、slow_down()でrpmを下げる。
+# 下げたrpmはspeed_up()が呼ばれるたびに、設定したrpmのrecovery_step倍ずつ設定値まで戻る
+class RateLimiter:
+    def __init__(self, rpm, tpm, recovery_step=0.05):
+        self.configured_rpm = rpm
+        self.recovery_step = recovery_step
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens):
+        tokens = min(tokens, self.tpm) # 1バッチがtpmより大きい場合は、バケットが満杯になるまで待てば送れるものとする
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.requests >= 1 and self.tokens >= tokens:
+                        self.requests -= 1
+                        self.tokens -= tokens
+                        return
+                    wait = max((1 - self.requests) * 60 / self.rpm, (tokens - self.tokens) * 60 / self.tpm)
+                await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    # 429が返ってきた場合に、設定したrpmが実際のクォータより大きかったとみなして、以降のリクエストの間隔を広げる
+    def slow_down(self, factor=0.8):
+        self.rpm = max(1.0, self.rpm * factor)
+        self.requests = min(self.requests, 0.0)
+
+    # リクエストが成功した場合に、下げていたrpmを少しだけ設定値に近づける
+    def speed_up(self):
+        if self.rpm < self.configured_rpm:
+            self.rpm = min(self.configured_rpm, self.rpm + self.configured_rpm * self.recovery_step)
+
+
+class EmbeddingRunner:
+    def __init__(self, provider, limiter, concurrency, max_retries, backoff_base, backoff_max):
+        self.provider = provider
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.semaphore = None
+        # 集計。requests=送ったリクエスト, rate_limited=429の回数, retried=リトライした回数
+        self.stats = Counter()
+
+    # フルジッター方式の指数バックオフ
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    # 1バッチをembeddingする。失敗した場合はこのバッチだけを送り直し、max_retries回を超えたら例外を投げる
+    async def embed_batch(self, texts, tokens):
+        if not texts:
+            return []
+        attempt = 0
+        while True:
+            await self.limiter.acquire(tokens)
+            try:
+                async with self.semaphore:
+                    self.stats['requests'] += 1
+                    vectors = await asyncio.to_thread(self.provider.embed, texts)
+                if len(vectors) != len(texts):
+                    raise ValueError(f'{len(texts)}個のチャンクに対して{len(vectors)}個のベクトルが返ってきました')
+                self.limiter.speed_up()
+                return vectors
+            except RateLimited as e:
+                if attempt >= self.max_retries:
+                    raise
+                self.stats['rate_limited'] += 1
+                delay = min(self.backoff_max, e.retry_after) if e.retry_after is not None else self._backoff(attempt)
+                # 他のバッチも同じクォータを使っているので、全体の送信を止め、再開後も間隔を広げる
+                self.limiter.pause(delay)
+                self.limiter.slow_down()
+                logger.warning(f'レート制限(429)のため {delay:.1f}秒後にこのバッチを送り直します({attempt + 1}/{self.max_retries})')
+            except TransientError as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f'{e} のため {delay:.1f}秒後にこのバッチを送り直します({attempt + 1}/{self.max_retries})')
+                await asyncio.sleep(delay)
+            self.stats['retried'] += 1
+            attempt += 1
+
+    # batchesは(キー, チャンクのリスト, トークン数)を順に返すiterable。(キー, ベクトルのリスト)を渡された順に返す非同期ジェネレーター。
+    # 結果待ちはconcurrencyの2倍までにして、batchesを先に全て読んでしまわないようにする
+    async def run(self, batches):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        pending = deque()
+        try:
+            for key, texts, tokens in batches:
+                pending.append((key, asyncio.create_task(self.embed_batch(texts, tokens))))
+                if len(pending) >= self.concurrency * 2:
+                    key, task = pending.popleft()
+                    yield key, await task
+            while pending:
+                key, task = pending.popleft()
+                yield key, await task
+        finally:
+            for _, task in pending:
+                task.cancel()
@@ -1,22 +1,33 @@
 
 """
 GEMINIのembeddingを使った場合のコード。最新版の現状では英語しか対応していないので、日本語には使えない。
-トップ階層にあるjson(チャンク分割済み)を開いて、100個づつバッチ処理をする。
-フリーバージョンの場合、1分あたりトータルで1000チャンクしか処理できないのでsleep timeを8秒に設定してある。
+トップ階層にあるjson(チャンク分割済み、.jsonlも可)を開いて、100個づつバッチ処理をする。
+フリーバージョンの場合、1分あたりトータルで1000チャンクしか処理できないので、毎回sleepする代わりに
+embedding_runner.pyでcfg.GEMINI_EMBEDDING_RPM/TPMを超えないように待ちながら、最大cfg.EMBEDDING_CONCURRENCY個のバッチを同時に送る。
+ベクトルはバッチごとにvector_store.pyのファイルに追記するので、途中で落ちても次の実行で続きから再開できる。FAISSのインデックスは最後にまとめて書き出す。
+インデックスの横には、ベクトルIDからチャンクのurl・カテゴリなどを引ける対応表(<FAISSのファイル名>.meta.sqlite3)も書き出す(vector_metadata.py)。
+cfg.FAISS_ID_MAP = True(既定はFalse)なら、インデックスはIDが1から始まるIndexIDMap2になり、差分実行では前回のインデックスのIDを引き継いで
+内容の変わったチャンクだけを入れ替える。この形式の検索結果のIDはjsonでの位置ではないので、対応表で引くこと。
 """
 
+import asyncio
 import json
+import sqlite3
 from pathlib import Path
-import time
 import logging
 import os
 import sys
 import numpy as np
-import google.generativeai as genai
-import faiss
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_root)
 import config as cfg
+from carry_forward import load_previous_vectors
+from chunk_io import iter_chunk_records, iter_chunk_contents, iter_batches
+from embedding_cache import EmbeddingCache
+from vector_store import VectorStore
+from vector_metadata import write_index_with_metadata
+from embedding_runner import EmbeddingRunner, RateLimiter, GeminiProvider
+from token_estimator import TokenCounter
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -32,60 +43,134 @@ GEMINI_API_KEY = os.getenv(cfg.GEMINI_API_KEY)
 GEMINI_EMBEDDING_MODEL = cfg.GEMINI_EMBEDDING_MODEL
 JSON_FILE_NAME = cfg.JSON_FILE_NAME
 FAISS_DATABASE_NAME = cfg.FAISS_DATABASE_NAME
+DELTA_MODE = cfg.DELTA_MODE
+PREVIOUS_JSON_FILE_NAME = cfg.PREVIOUS_JSON_FILE_NAME
+PREVIOUS_FAISS_DATABASE_NAME = cfg.PREVIOUS_FAISS_DATABASE_NAME
+EMBEDDING_CACHE_ENABLED = cfg.EMBEDDING_CACHE_ENABLED
+EMBEDDING_CACHE_PATH = cfg.EMBEDDING_CACHE_PATH
+GEMINI_API_BASE = cfg.GEMINI_API_BASE
+GEMINI_EMBEDDING_RPM = cfg.GEMINI_EMBEDDING_RPM
+GEMINI_EMBEDDING_TPM = cfg.GEMINI_EMBEDDING_TPM
+EMBEDDING_CONCURRENCY = cfg.EMBEDDING_CONCURRENCY
+EMBEDDING_MAX_RETRIES = cfg.EMBEDDING_MAX_RETRIES
+HTTP_BACKOFF_BASE = cfg.HTTP_BACKOFF_BASE
+HTTP_BACKOFF_MAX = cfg.HTTP_BACKOFF_MAX
+EMBEDDING_RESUME = cfg.EMBEDDING_RESUME
+EMBEDDING_CHECKPOINT_EVERY = cfg.EMBEDDING_CHECKPOINT_EVERY
+FAISS_ID_MAP = cfg.FAISS_ID_MAP
+LANGUAGE = cfg.LANGUAGE
 
 DIMENSION = 768
-SLEEP_TIME = 5
 
-try:
-    genai.configure(api_key=GEMINI_API_KEY)
-except Exception as e:
-    logger.error(f"API キーの設定中にエラーが発生しました: {e}")
+if not GEMINI_API_KEY:
+    logger.error(f"環境変数 {cfg.GEMINI_API_KEY} が設定されていません")
     sys.exit(1)
 
-try:
-    file_path = Path('.') / JSON_FILE_NAME
-    with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    chunks = [dic['content'] for dic in data]
-    logger.info(f"JSONファイルから {len(chunks)} 個のコンテンツを読み込みました")
-
-except FileNotFoundError:
+# チャンクはループの中で1バッチずつ読む(.jsonlなら1行ずつ読むので、全チャンクを一度にメモリに持たない)
+file_path = Path('.') / JSON_FILE_NAME
+if not file_path.exists():
     logger.error(f"ファイル {JSON_FILE_NAME} が見つかりません")
     sys.exit(1)
 
-except json.JSONDecodeError:
-    logger.error(f"ファイル {JSON_FILE_NAME} の JSON 形式が無効です")
-    sys.exit(1)
+# 差分実行の場合は、前回と内容が全く同じチャンクのベクトルを引き継ぐ
+previous_vectors = {}
+if DELTA_MODE:
+    try:
+        previous_vectors = load_previous_vectors(PREVIOUS_JSON_FILE_NAME, PREVIOUS_FAISS_DATABASE_NAME)
+        logger.info(f"前回のインデックスから {len(previous_vectors)} 個のベクトルを読み込みました")
+    except (OSError, ValueError, RuntimeError, json.JSONDecodeError) as e:
+        logger.error(f"前回のチャンクまたはインデックスの読み込み中にエラーが発生しました: {e}")
+        sys.exit(1)
 
-# FAISSインデックスの初期化。新たにまっさらなインデックスが作られる
-index = faiss.IndexFlatL2(DIMENSION)
+# 実行をまたいで、一度embeddingしたチャンクのベクトルを保存しておくキャッシュ(キーはチャンクの内容とモデル)
+embedding_cache = None
+if EMBEDDING_CACHE_ENABLED:
+    try:
+        embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, f'{GEMINI_EMBEDDING_MODEL}/retrieval_document', DIMENSION)
+    except sqlite3.Error as e:
+        logger.error(f"ベクトルのキャッシュを開けませんでした: {e}")
+        sys.exit(1)
 
+# ベクトルはバッチごとにVectorStoreのファイルに追記し、どのバッチまで終わったかを記録する。
+# 前回の実行が途中で終わっていれば、入力・モデルなどが同じ場合に限り、最後に終わったバッチの次から再開する
 batch_size = 100
-for i in range(0, len(chunks), batch_size):
-    batch = chunks[i:i + batch_size]
-    try:
-        result = genai.embed_content(
-            model=GEMINI_EMBEDDING_MODEL,
-            content=batch,
-            task_type='retrieval_document',
-            title=''
-        )
-        embedding_array = np.array(result['embedding'], dtype=np.float32)
-        index.add(embedding_array)
-        logger.info(f"バッチ {i//batch_size + 1} を処理しました。総ベクター数: {index.ntotal}")
-        time.sleep(SLEEP_TIME)
+try:
+    store = VectorStore(FAISS_DATABASE_NAME, DIMENSION, f'{GEMINI_EMBEDDING_MODEL}/retrieval_document', file_path, batch_size, resume=EMBEDDING_RESUME)
+except OSError as e:
+    logger.error(f"ベクトルの保存先を準備できませんでした: {e}")
+    sys.exit(1)
+if store.resumed:
+    logger.info(f"前回の続きから再開します。完了済み: {store.completed_batches}バッチ, {store.vector_count}ベクトル")
+reused_count = 0
+cached_count = 0
+
+token_counter = TokenCounter()
+runner = EmbeddingRunner(GeminiProvider(GEMINI_API_KEY, GEMINI_EMBEDDING_MODEL, GEMINI_API_BASE),
+                         RateLimiter(GEMINI_EMBEDDING_RPM, GEMINI_EMBEDDING_TPM),
+                         EMBEDDING_CONCURRENCY, EMBEDDING_MAX_RETRIES, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX)
+
 
+# 100個づつのバッチごとに、前回のベクトルを引き継げず、キャッシュにもないチャンクだけをAPIに送るものとしてrunnerに渡す。
+# 前回の実行で完了済みのバッチは読み飛ばす
+def iter_requests():
+    for batch_number, batch in enumerate(iter_batches(iter_chunk_contents(file_path), batch_size), 1):
+        if batch_number <= store.completed_batches:
+            continue
+        missing = [chunk for chunk in batch if chunk not in previous_vectors]
+        cached_vectors = embedding_cache.get_many(missing) if embedding_cache else {}
+        missing = [chunk for chunk in missing if chunk not in cached_vectors]
+        yield (batch_number, batch, cached_vectors, missing), missing, sum(token_counter.count(chunk) for chunk in missing)
+
+
+# partial(途中のチェックポイント)の場合は、まだembeddingしていないチャンクを対応表から削除しない
+def save_index(partial=False):
+    try:
+        counts = write_index_with_metadata(store, iter_chunk_records(file_path), FAISS_DATABASE_NAME, FAISS_ID_MAP, LANGUAGE, partial=partial,
+                                           base_path=PREVIOUS_FAISS_DATABASE_NAME if DELTA_MODE else None)
+        logger.info(f"FAISS インデックスと対応表を保存しました。追加: {counts['added']}, 削除: {counts['removed']}, 変更なし: {counts['kept']}")
     except Exception as e:
-        logger.error(f"エンベディング生成中にエラーが発生しました: {e}")
+        logger.error(f"FAISS インデックスの保存中にエラーが発生しました: {e}")
         sys.exit(1)
 
-# FAISSインデックスの保存
+
+# runnerは複数のバッチを同時に送るが、結果はバッチの順に返ってくるので、ベクトルはjsonの順に保存される
+async def embed_all():
+    global reused_count, cached_count
+    async for (batch_number, batch, cached_vectors, missing), vectors in runner.run(iter_requests()):
+        new_vectors = dict(zip(missing, vectors))
+        embedding_array = np.array([new_vectors[chunk] if chunk in new_vectors else cached_vectors[chunk] if chunk in cached_vectors else previous_vectors[chunk] for chunk in batch], dtype=np.float32)
+        store.append(batch_number, embedding_array)
+        if embedding_cache and new_vectors:
+            embedding_cache.put_many(new_vectors)
+        cached_count += sum(1 for chunk in batch if chunk in cached_vectors)
+        reused_count += len(batch) - len(missing)
+        logger.info(f"バッチ {batch_number} を処理しました。総ベクター数: {store.vector_count} (うち前回から引き継ぎ・キャッシュ: {reused_count})")
+        if EMBEDDING_CHECKPOINT_EVERY and batch_number % EMBEDDING_CHECKPOINT_EVERY == 0:
+            save_index(partial=True)
+
+
 try:
-    faiss.write_index(index, FAISS_DATABASE_NAME)
-    logger.info(f"FAISS インデックスを保存しました。総ベクター数: {index.ntotal}")
+    asyncio.run(embed_all())
+
+except json.JSONDecodeError:
+    logger.error(f"ファイル {JSON_FILE_NAME} の JSON 形式が無効です")
+    sys.exit(1)
 
 except Exception as e:
-    logger.error(f"FAISS インデックスの保存中にエラーが発生しました: {e}")
+    logger.error(f"エンベディング生成中にエラーが発生しました: {e}")
+    logger.info(f"{store.completed_batches}バッチ目までは保存済みなので、もう一度実行すると続きから再開します")
     sys.exit(1)
 
-print(f"処理が完了しました。総ベクター数: {index.ntotal}")
\ No newline at end of file
+finally:
+    runner.provider.close()
+
+logger.info(f"APIへのリクエスト: {runner.stats['requests']}回 (うち429: {runner.stats['rate_limited']}回, リトライ: {runner.stats['retried']}回)")
+
+# FAISSインデックスの保存
+save_index()
+
+if embedding_cache:
+    logger.info(f"ベクトルのキャッシュ: {cached_count}個ヒット (APIに送る必要があったチャンクのうちヒット率 {embedding_cache.hit_rate():.1%})")
+    embedding_cache.close()
+
+print(f"処理が完了しました。総ベクター数: {store.vector_count}")
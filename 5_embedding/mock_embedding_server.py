@@ -0,0 +1,141 @@
+"""
+embedding_runner.pyを本物のAPIを使わずに試すための、ローカルのモックサーバー(標準ライブラリのみ)。
+GeminiのbatchEmbedContentsとOpenAIの/v1/embeddingsと同じ形のリクエストを受け、テキストのハッシュ値から作った決まったベクトルを返す。
+--rpmを超えるリクエストや、--fail-rateの割合のリクエストには429(Retry-After付き)を返すので、レート制限とリトライの動きも確かめられる。
+tests/test_embedding_runner.pyでは、make_handler()で同じプロセス内に立ち上げ、MockState.fail_next()で決まったリクエストに429を返して使う。
+
+python mock_embedding_server.py --port 8765 --dimension 768 --rpm 60 --fail-rate 0.1
+cfg.GEMINI_API_BASE(またはcfg.OPENAI_API_BASE)を'http://127.0.0.1:8765'にしてからgemini_embedding.py(openai_embedding.py)を実行する
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import struct
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# テキストごとに毎回同じベクトルを返す
+def fake_vector(text, dimension):
+    values = []
+    counter = 0
+    while len(values) < dimension:
+        digest = hashlib.sha256(f'{counter}:{text}'.encode('utf-8')).digest()
+        values.extend(value / 2 ** 32 - 0.5 for value in struct.unpack('<8I', digest))
+        counter += 1
+    return values[:dimension]
+
+
+class MockState:
+    def __init__(self, dimension, rpm, fail_rate, delay):
+        self.dimension = dimension
+        self.rpm = rpm
+        self.fail_rate = fail_rate
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.recent = deque() # 直近1分間に受け付けたリクエストの時刻
+        self.counts = {'ok': 0, 'rate_limited': 0}
+        self.forced_failures = 0
+        self.forced_retry_after = 1
+        # 受け取ったリクエストの記録。(時刻, テキストのリスト, ステータス)のリスト(テストで送られ方を確かめるため)
+        self.requests = []
+
+    # 次のcount件のリクエストに、必ずRetry-After: retry_after秒の429を返す
+    def fail_next(self, count, retry_after=1):
+        with self.lock:
+            self.forced_failures = count
+            self.forced_retry_after = retry_after
+
+    # 受け付けられるならTrue。直近1分間のリクエスト数がrpmに達していれば、空くまでの秒数を返す
+    def admit(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.recent and now - self.recent[0] >= 60:
+                self.recent.popleft()
+            if self.forced_failures:
+                self.forced_failures -= 1
+                self.counts['rate_limited'] += 1
+                return self.forced_retry_after
+            if self.fail_rate and random.random() < self.fail_rate:
+                self.counts['rate_limited'] += 1
+                return 1
+            if self.rpm and len(self.recent) >= self.rpm:
+                self.counts['rate_limited'] += 1
+                return max(1, int(60 - (now - self.recent[0])) + 1)
+            self.recent.append(now)
+            self.counts['ok'] += 1
+            return True
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self.path.endswith(':batchEmbedContents'):
+                texts = [request['content']['parts'][0]['text'] for request in payload['requests']]
+            elif self.path == '/v1/embeddings':
+                texts = payload['input'] if isinstance(payload['input'], list) else [payload['input']]
+            else:
+                self.send_json(404, {'error': {'code': 404, 'message': f'unknown path: {self.path}'}})
+                return
+
+            admitted = state.admit()
+            with state.lock:
+                state.requests.append((time.monotonic(), texts, 200 if admitted is True else 429))
+            if admitted is not True:
+                self.send_json(429, {'error': {'code': 429, 'message': 'rate limited'}}, {'Retry-After': str(admitted)})
+                return
+            if state.delay:
+                time.sleep(state.delay)
+
+            if self.path.endswith(':batchEmbedContents'):
+                self.send_json(200, {'embeddings': [{'values': fake_vector(text, state.dimension)} for text in texts]})
+            else:
+                self.send_json(200, {'object': 'list', 'model': payload.get('model'),
+                                     'data': [{'object': 'embedding', 'index': i, 'embedding': fake_vector(text, state.dimension)}
+                                              for i, text in enumerate(texts)]})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GeminiとOpenAIのembedding APIのモックサーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--dimension', type=int, default=768, help='返すベクトルの次元数(geminiは768、openaiのtext-embedding-3-largeは3072)')
+    parser.add_argument('--rpm', type=int, default=0, help='1分あたりに受け付けるリクエスト数。超えると429を返す。0なら制限しない')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='この割合のリクエストにランダムに429を返す')
+    parser.add_argument('--delay', type=float, default=0.0, help='1リクエストごとに待つ秒数(APIの応答時間の代わり)')
+    args = parser.parse_args()
+
+    state = MockState(args.dimension, args.rpm, args.fail_rate, args.delay)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    print(f'http://{args.host}:{args.port} で待ち受けています (Ctrl+Cで終了)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"受け付けたリクエスト: {state.counts['ok']}, 429を返したリクエスト: {state.counts['rate_limited']}")
+
+
+if __name__ == "__main__":
+    main()
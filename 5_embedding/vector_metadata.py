@@ -0,0 +1,239 @@
+"""
+FAISSのインデックスの横に置く、ベクトルID → チャンクの情報の対応表(<FAISSのファイル名>.meta.sqlite3)。
+チャンクの情報は、記事ID・言語・記事内の番号から作るチャンクのキー(chunk_key)、元記事のurl、カテゴリ、内容のハッシュ値。
+検索でヒットしたベクトルIDから、jsonを読み込み直さずに主キーで引ける(VectorMetadata.lookup())。
+cfg.FAISS_ID_MAP = False(既定)の場合は従来どおりjsonの順のIndexFlatL2を作り直し、ベクトルIDはjsonでの位置(0から)になる。
+Trueの場合は、インデックスをIndexIDMap2で作り、ベクトルIDをチャンクごとに1から振る(一度使ったIDは再利用しない)。
+この形式では検索結果のIDはjsonでの位置ではないので、読む側は必ずVectorMetadata.lookup()でチャンクを引くこと。
+元にするインデックス(base_path。差分実行ではcfg.PREVIOUS_FAISS_DATABASE_NAME)を指定すると、そのIDと対応表を引き継ぎ、
+内容の変わらないチャンクのIDとベクトルはそのまま残し、内容の変わったチャンクと無くなったチャンクだけを削除(remove_ids)して、
+新しいIDで追加(add_with_ids)する。書き出し先に同じ元から作った途中のインデックスがあれば(チェックポイント)、そちらを元にする。
+"""
+
+import re
+import sqlite3
+from collections import Counter
+from itertools import islice
+from pathlib import Path
+import numpy as np
+import faiss
+from content_store import content_hash
+from url_canon import url_language
+from url_canon import answer_id
+from vector_store import INDEX_ADD_ROWS, write_faiss_index
+
+# .json(contentだけの形式)の場合に、チャンクの末尾のメタ情報からurlとカテゴリを読む
+SOURCE_PATTERN = re.compile(r'^\[SOURCE\] (\S+)', re.MULTILINE)
+CATEGORY_PATTERN = re.compile(r'^\[CATEGORY\] (.*)$', re.MULTILINE)
+
+
+def metadata_path(faiss_path):
+    return Path(f'{faiss_path}.meta.sqlite3')
+
+
+# チャンクのレコード(chunk_io.iter_chunk_records())を、対応表の1行分のdictにして順に返す。
+# .jsonlのレコードの項目を優先し、ない場合(.json)はチャンクの末尾の[SOURCE], [CATEGORY]から補う
+def iter_chunk_metadata(records, default_language):
+    chunk_numbers = Counter()
+    seen_keys = Counter()
+    for record in records:
+        content = record['content']
+        url = record.get('source_url')
+        if not url:
+            sources = SOURCE_PATTERN.findall(content)
+            url = sources[-1] if sources else ''
+        category = record.get('category')
+        if category is None:
+            categories = CATEGORY_PATTERN.findall(content)
+            category = categories[-1].strip() if categories else ''
+        article_id = record.get('article_id') or answer_id(url) or url
+        language = url_language(url) or default_language
+        chunk_index = record['chunk_index'] if 'chunk_index' in record else chunk_numbers[(article_id, language)]
+        chunk_numbers[(article_id, language)] += 1
+
+        chunk_key = f'{article_id}:{language}:{chunk_index}'
+        # 同じ記事が2回出てくるなどしてキーが重なった場合は、出てきた順の番号を付けて区別する
+        seen_keys[chunk_key] += 1
+        if seen_keys[chunk_key] > 1:
+            chunk_key = f'{chunk_key}#{seen_keys[chunk_key]}'
+        yield {'chunk_key': chunk_key, 'article_id': article_id, 'language': language, 'chunk_index': chunk_index,
+               'source_url': url, 'category': category, 'content_hash': content_hash(content)}
+
+
+class VectorMetadata:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript('''
+        CREATE TABLE IF NOT EXISTS vectors (
+            vector_id INTEGER PRIMARY KEY AUTOINCREMENT, -- FAISSのインデックスのID
+            chunk_key TEXT NOT NULL UNIQUE, -- 記事ID:言語:記事内の番号
+            article_id TEXT,
+            language TEXT,
+            chunk_index INTEGER,
+            source_url TEXT,
+            category TEXT,
+            content_hash TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_vectors_content_hash ON vectors (content_hash);
+        CREATE TABLE IF NOT EXISTS index_info (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        ''')
+        self.conn.commit()
+
+    # 対応表を作ったときのインデックスの種類('id_map'または'positional')
+    def mode(self):
+        row = self.conn.execute("SELECT value FROM index_info WHERE key = 'mode'").fetchone()
+        return row[0] if row else None
+
+    # 'id_map'の場合に、IDを引き継いだ元のインデックスのパス(なければ''。記録されていない古い対応表ではNone)
+    def base(self):
+        row = self.conn.execute("SELECT value FROM index_info WHERE key = 'base'").fetchone()
+        return row[0] if row else None
+
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM vectors').fetchone()[0]
+
+    # {chunk_key: (vector_id, content_hash)}
+    def existing(self):
+        return {row['chunk_key']: (row['vector_id'], row['content_hash'])
+                for row in self.conn.execute('SELECT vector_id, chunk_key, content_hash FROM vectors')}
+
+    # {content_hash: vector_id}。carry_forward.pyで前回のベクトルを内容から引くのに使う
+    def ids_by_content_hash(self):
+        return {row['content_hash']: row['vector_id'] for row in self.conn.execute('SELECT vector_id, content_hash FROM vectors')}
+
+    # 検索結果のベクトルIDのリストから、{vector_id: チャンクの情報のdict}を返す
+    def lookup(self, vector_ids):
+        vector_ids = [int(vector_id) for vector_id in vector_ids if vector_id >= 0]
+        if not vector_ids:
+            return {}
+        placeholders = ', '.join('?' * len(vector_ids))
+        rows = self.conn.execute(f'SELECT * FROM vectors WHERE vector_id IN ({placeholders})', vector_ids)
+        return {row['vector_id']: dict(row) for row in rows}
+
+    def close(self):
+        self.conn.close()
+
+
+def _insert(conn, metadata, vector_id=None):
+    cursor = conn.execute('''INSERT INTO vectors (vector_id, chunk_key, article_id, language, chunk_index, source_url, category, content_hash)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                          (vector_id, metadata['chunk_key'], metadata['article_id'], metadata['language'], metadata['chunk_index'],
+                           metadata['source_url'], metadata['category'], metadata['content_hash']))
+    return cursor.lastrowid
+
+
+def _set_mode(conn, mode):
+    conn.execute("INSERT OR REPLACE INTO index_info (key, value) VALUES ('mode', ?)", (mode,))
+
+
+# jsonの順にベクトルIDを振ったIndexFlatL2と対応表を作り直す
+def _write_positional(store, metadata_rows, faiss_path, meta):
+    total = write_faiss_index(store, faiss_path)
+    with meta.conn:
+        meta.conn.execute('DELETE FROM vectors')
+        for position, metadata in enumerate(metadata_rows):
+            _insert(meta.conn, metadata, position)
+        _set_mode(meta.conn, 'positional')
+    return {'added': total, 'removed': 0, 'kept': 0}
+
+
+# pathのIndexIDMap2のインデックスを、対応表と一致していれば読み込む。なければNone
+def _read_id_mapped(path, meta):
+    if meta.mode() != 'id_map' or not Path(path).exists():
+        return None
+    index = faiss.read_index(str(path))
+    if not hasattr(index, 'id_map') or index.ntotal != meta.count():
+        return None # インデックスと対応表が食い違っている
+    return index
+
+
+# 元にするインデックスの対応表を、IDの採番の続きも含めて書き出し先の対応表に写す
+def _copy_metadata(meta, base_metadata_path):
+    meta.conn.execute('ATTACH DATABASE ? AS base', (str(base_metadata_path),))
+    try:
+        with meta.conn:
+            meta.conn.execute('DELETE FROM vectors')
+            meta.conn.execute('INSERT INTO vectors SELECT * FROM base.vectors')
+            meta.conn.execute("DELETE FROM sqlite_sequence WHERE name = 'vectors'")
+            meta.conn.execute("INSERT INTO sqlite_sequence (name, seq) SELECT name, seq FROM base.sqlite_sequence WHERE name = 'vectors'")
+    finally:
+        meta.conn.execute('DETACH DATABASE base')
+
+
+# 更新の元にするIndexIDMap2を返す。書き出し先に同じ元から作ったインデックスがあればそれ、なければbase_pathのもの、
+# どちらもなければ空のインデックス。返す時点で、metaの対応表は返したインデックスと一致している
+def _base_index(store, faiss_path, meta, base_path):
+    base_key = str(base_path or '')
+    if (meta.base() or '') == base_key:
+        index = _read_id_mapped(faiss_path, meta)
+        if index is not None:
+            return index
+    index = None
+    if base_path and Path(base_path) != Path(faiss_path) and metadata_path(base_path).exists():
+        base_meta = VectorMetadata(metadata_path(base_path))
+        try:
+            index = _read_id_mapped(base_path, base_meta)
+        finally:
+            base_meta.close()
+    if index is not None:
+        _copy_metadata(meta, metadata_path(base_path))
+    else:
+        with meta.conn:
+            meta.conn.execute('DELETE FROM vectors')
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(store.dimension))
+    with meta.conn:
+        meta.conn.execute("INSERT OR REPLACE INTO index_info (key, value) VALUES ('base', ?)", (base_key,))
+    return index
+
+
+# IndexIDMap2のインデックスを対応表との差分だけ更新する。partialなら(途中のチェックポイント)、まだ出てきていないチャンクは削除しない
+def _write_id_mapped(store, metadata_rows, faiss_path, meta, partial, base_path):
+    index = _base_index(store, faiss_path, meta, base_path)
+
+    existing = meta.existing()
+    seen = set()
+    removed_ids = []
+    added = [] # (jsonでの位置, チャンクの情報)
+    for position, metadata in enumerate(metadata_rows):
+        seen.add(metadata['chunk_key'])
+        old = existing.get(metadata['chunk_key'])
+        if old and old[1] == metadata['content_hash']:
+            continue
+        if old:
+            removed_ids.append(old[0])
+        added.append((position, metadata))
+    if not partial:
+        removed_ids.extend(vector_id for chunk_key, (vector_id, _) in existing.items() if chunk_key not in seen)
+
+    vectors = store.vectors()
+    # 対応表の変更はインデックスを書き出してからコミットする。書き出しに失敗した場合は対応表も元に戻る
+    with meta.conn:
+        if removed_ids:
+            meta.conn.executemany('DELETE FROM vectors WHERE vector_id = ?', [(vector_id,) for vector_id in removed_ids])
+            index.remove_ids(np.array(removed_ids, dtype=np.int64))
+        for start in range(0, len(added), INDEX_ADD_ROWS):
+            part = added[start:start + INDEX_ADD_ROWS]
+            ids = np.array([_insert(meta.conn, metadata) for _, metadata in part], dtype=np.int64)
+            index.add_with_ids(np.ascontiguousarray(vectors[[position for position, _ in part]]), ids)
+        _set_mode(meta.conn, 'id_map')
+        faiss.write_index(index, str(faiss_path))
+    return {'added': len(added), 'removed': len(removed_ids), 'kept': index.ntotal - len(added)}
+
+
+# storeのベクトル(jsonの順)とチャンクのレコードから、FAISSのインデックスと対応表を書き出す。
+# id_mapの場合、base_pathはIDを引き継ぐ元のインデックス(なければNone)。追加・削除・そのまま残したベクトルの数のdictを返す
+def write_index_with_metadata(store, records, faiss_path, id_map, default_language, partial=False, base_path=None):
+    meta = VectorMetadata(metadata_path(faiss_path))
+    try:
+        metadata_rows = list(iter_chunk_metadata(islice(records, store.vector_count), default_language))
+        if len(metadata_rows) != store.vector_count:
+            raise ValueError(f'チャンク数({len(metadata_rows)})と保存したベクトル数({store.vector_count})が一致しません')
+        if id_map:
+            return _write_id_mapped(store, metadata_rows, faiss_path, meta, partial, base_path)
+        return _write_positional(store, metadata_rows, faiss_path, meta)
+    finally:
+        meta.close()
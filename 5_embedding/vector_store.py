@@ -0,0 +1,105 @@
+"""
+embeddingの途中経過の保存先。バッチが終わるごとにベクトルをfloat32のバイト列としてファイル(<FAISSのファイル名>.vectors.f32)の末尾に追記し、
+どのバッチまで終わったかをマニフェスト(<FAISSのファイル名>.manifest.json)に記録する。
+途中で落ちても、次の実行では同じ入力(jsonのパス・サイズ・更新時刻)・モデル・次元数・バッチサイズであれば、最後に終わったバッチの次から再開する。
+追記は1回の書き込みで済むので、全体のインデックスを毎回書き直す場合のように、書き込みの量がベクトル数の2乗で増えることはない。
+FAISSのインデックスはwrite_faiss_index()でファイルをmemmapで読んで作る(最後に1回、またはcfg.EMBEDDING_CHECKPOINT_EVERYバッチごと)。
+"""
+
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import faiss
+
+MANIFEST_VERSION = 1
+INDEX_ADD_ROWS = 10000 # インデックスを作る際に1回でaddする行数
+
+
+def source_fingerprint(path):
+    stat = os.stat(path)
+    return {'path': str(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class VectorStore:
+    def __init__(self, prefix, dimension, model, source_path, batch_size, resume=True):
+        self.vectors_path = Path(f'{prefix}.vectors.f32')
+        self.manifest_path = Path(f'{prefix}.manifest.json')
+        self.dimension = dimension
+        settings = {'version': MANIFEST_VERSION, 'source': source_fingerprint(source_path), 'model': model,
+                    'dimension': dimension, 'batch_size': batch_size}
+
+        manifest = self._load_manifest() if resume else None
+        self.resumed = manifest is not None and all(manifest.get(key) == value for key, value in settings.items())
+        if self.resumed:
+            self.manifest = manifest
+            # マニフェストに記録する前に落ちた場合の、最後の中途半端な追記を切り捨てる
+            with open(self.vectors_path, 'ab') as f:
+                f.truncate(self.vector_count * self.dimension * 4)
+        else:
+            self.manifest = {**settings, 'completed_batches': 0, 'vector_count': 0}
+            self.vectors_path.parent.mkdir(parents=True, exist_ok=True)
+            open(self.vectors_path, 'wb').close()
+            self._save_manifest()
+
+    @property
+    def completed_batches(self):
+        return self.manifest['completed_batches']
+
+    @property
+    def vector_count(self):
+        return self.manifest['vector_count']
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        # ベクトルのファイルがマニフェストの記録より短い場合は、ファイルが壊れているので最初からやり直す
+        if not self.vectors_path.exists() or self.vectors_path.stat().st_size < manifest.get('vector_count', 0) * self.dimension * 4:
+            return None
+        return manifest
+
+    # 書き込みの途中で落ちても壊れたマニフェストが残らないよう、一時ファイルに書いてから置き換える
+    def _save_manifest(self):
+        self.manifest['updated_at'] = time.time()
+        fd, tmp_path = tempfile.mkstemp(dir=self.manifest_path.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.manifest_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    # batch_number番目のバッチのベクトルを追記し、そのバッチまで終わったことを記録する。バッチは順番に渡すこと
+    def append(self, batch_number, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[1] != self.dimension:
+            raise ValueError(f'ベクトルの形が{vectors.shape}です。次元数は{self.dimension}である必要があります')
+        with open(self.vectors_path, 'ab') as f:
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self.manifest['completed_batches'] = batch_number
+        self.manifest['vector_count'] += len(vectors)
+        self._save_manifest()
+
+    # これまでに保存した全てのベクトル((ベクトル数, 次元数)の配列)。メモリには読み込まずにmemmapで返す
+    def vectors(self):
+        if self.vector_count == 0:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        return np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self.vector_count, self.dimension))
+
+
+# 保存したベクトルから、jsonの順にベクトルを追加したIndexFlatL2を作ってpathに書き込む
+def write_faiss_index(store, path):
+    index = faiss.IndexFlatL2(store.dimension)
+    vectors = store.vectors()
+    for start in range(0, len(vectors), INDEX_ADD_ROWS):
+        index.add(np.ascontiguousarray(vectors[start:start + INDEX_ADD_ROWS]))
+    faiss.write_index(index, str(path))
+    return index.ntotal
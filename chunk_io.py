@@ -0,0 +1,45 @@
+"""
+4で作るチャンクのファイルの読み書き。ファイル名の拡張子で形式を決める。
+- .json: 従来どおり[{"content": ...}, ...]を1つのjsonとして保存する(全チャンクを一度にメモリに持つ)
+- .jsonl: 1行に1チャンクのJSON Lines。チャンクができた順に書き出し、読む側も1行ずつ読むので、全体をメモリに持たない。
+  各行はcontentの他に、元記事のurl(source_url)、カテゴリ(category)、記事ID(article_id)、記事内でのチャンクの番号(chunk_index)、トークン数(token_count、token_estimator.pyで数えた値)を持つ
+5のembeddingとcarry_forward.pyはどちらの形式もiter_chunk_records()で読む。
+"""
+
+import json
+
+
+def is_jsonl(path):
+    return str(path).endswith('.jsonl')
+
+
+# チャンクのレコード(dict)を順に返すジェネレーター
+def iter_chunk_records(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        if not is_jsonl(path):
+            yield from json.load(f)
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_chunk_contents(path):
+    for record in iter_chunk_records(path):
+        yield record['content']
+
+
+def write_jsonl_record(file, record):
+    file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+# iterableをbatch_size個ずつのリストにまとめて返す
+def iter_batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
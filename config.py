@@ -12,25 +12,107 @@ RAW_URLS_CSV = 'raw_urls_08_07_2024.csv' # 1で出力、2で入力
 
 ERROR_LOG = 'error.log' # 1で出力
 
+CRAWL_WORKERS = 4 # 1で同時に取得するtopicページの数。0にすると従来の再帰的なscrape()で1ページずつ取得する
+CRAWL_MIN_INTERVAL = 1.0 # 1で同一ホストへリクエストを送る最小間隔(秒)。全ワーカーで共有される
+HTML_PARSER = 'html.parser' # 1でtopicページの解析に使うパーサー。'html.parser', 'lxml'(要lxml), 'selectolax'(要selectolax)のいずれか
+CRAWL_STATE_DB = 'crawl_state.sqlite3' # 1の途中経過(取得済みtopicページ)の保存先。RAW_URLS_CSVごとに別扱いになる
+CRAWL_RESUME = True # Trueなら前回中断した1の実行の続きから再開する(最後まで終わった実行の途中経過は消えるので、次は最初から取得する)。Falseにすると同じRAW_URLS_CSVの途中経過を消して最初からやり直す
+
+# http_fetch.py(共通のHTTP取得レイヤー)の設定
+HTTP_TIMEOUT = 20 # 1リクエストあたりのタイムアウト(秒)
+HTTP_MAX_RETRIES = 5 # 429/5xxや接続エラーの場合に何回までリトライするか
+HTTP_BACKOFF_BASE = 1.0 # 指数バックオフの基準(秒)。1.0なら最大で1, 2, 4, 8...秒待つ
+HTTP_BACKOFF_MAX = 60.0 # バックオフおよびRetry-Afterで待つ時間の上限(秒)
+
+# http_cache.py(1と3のレスポンスキャッシュ)の設定。キャッシュは各段のディレクトリのhttp_cache/に保存される
+HTTP_CACHE_ENABLED = True
+HTTP_CACHE_MAX_AGE = 0 # この秒数以内に取得したページは再検証もせずにキャッシュを使う。0なら毎回ETag/Last-Modifiedで再検証する
+OFFLINE_MODE = False # Trueにすると1と3をキャッシュだけで実行し、一切通信しない(キャッシュにないページはエラー)。各段単体のベンチマークにも使える
+
 CLEANED_URLS_CSV = 'cleaned_urls_08_07_2024.csv'
 
+DEDUPE_MODE = 'memory' # 2の重複除去の方式。'memory'(全行をメモリに読む), 'two_pass'(ファイルを2回読む), 'partitioned'(一時ファイルに分割。メモリに収まらない大きさ用)
+DEDUPE_PARTITIONS = 64 # 'partitioned'の場合の一時ファイルの数
+
+# 差分実行の設定。Trueにすると前回のスナップショットと比べて、追加・変更された記事だけを処理し、それ以外は前回の結果を引き継ぐ
+DELTA_MODE = False
+PREVIOUS_CLEANED_URLS_CSV = 'cleaned_urls_07_23_2024.csv' # 2で比較する前回のurlリスト(2の階層に置く)
+PREVIOUS_SQLITE_TABLE_NAME = 'EN_07_23_2024' # 3で内容を引き継ぐ前回のテーブル(同じ言語のもの)
+PREVIOUS_JSON_FILE_NAME = './output_files/JA_07_23_2024_V3.json' # 5でベクトルを引き継ぐ前回のチャンク
+PREVIOUS_FAISS_DATABASE_NAME = './output_files/JA_07_23_2024_V3_g.faiss' # 5でベクトルを引き継ぐ前回のインデックス
+EMBEDDING_CACHE_ENABLED = True # Trueなら5で一度embeddingしたチャンクのベクトルを保存しておき、DELTA_MODEに関係なく次回以降はAPIに送らない
+EMBEDDING_CACHE_PATH = './embedding_cache.sqlite3' # 5のベクトルのキャッシュの保存先。キーはチャンクの内容とモデル名
+
 
 # 固定
 SQLITE_PATH='./knowledge.sqlite3'
+NORMALIZED_STORAGE = False # Trueなら3は本文を圧縮してcontent_blobs/pagesテーブルに保存し、テーブル名と同じ名前のviewで従来どおり読めるようにする(content_store.py)。
+# 既存のデータベースでTrueにする場合は、先に3のmigrate_to_normalized_schema.pyで従来の形式のテーブルを移行しておくこと
+CONTENT_COMPRESSION = 'zlib' # 本文の圧縮方式。'zlib'または'zstd'(要zstandard。なければzlibになる)
+
+# 3のブラウザの設定
+BROWSER_CONCURRENCY = 3 # 1つのChromiumで同時に開いて描画するタブの数
+BROWSER_RESTART_EVERY = 100 # このページ数を描画するごとにChromiumを起動し直し、メモリの増加を抑える
+SCRAPE_MAX_ATTEMPTS = 3 # 1ページの描画に失敗した場合、新しいタブで何回まで試すか
+BLOCK_REQUESTS = True # Trueにすると下記のリソースとホストへのリクエストを中断し、.article-containerが現れた時点で描画を進める
+BLOCKING_COMPARE_EVERY = 50 # BLOCK_REQUESTSがTrueの場合、このページ数ごとに1ページを中断なしでも描画し直し、短縮できた描画時間をログに出す(0なら比べない)
+BLOCKED_RESOURCE_TYPES = ['image', 'media', 'font', 'texttrack', 'eventsource', 'websocket', 'manifest'] # 4でどうせ取り除くか、使わないもの
+BLOCKED_HOSTS = [ # 解析・広告・埋め込み動画など、本文の描画に関係のないホスト(サブドメインも含む)
+    'google-analytics.com',
+    'googletagmanager.com',
+    'doubleclick.net',
+    'googlesyndication.com',
+    'play.google.com',
+    'youtube.com',
+    'ytimg.com',
+]
+ZIPPY_SETTLE_MS = 300 # zippyを全て開いた後、DOMの変化がこのミリ秒数なければ開き終わったとみなす
+ZIPPY_SETTLE_TIMEOUT_MS = 5000 # DOMの変化が続いていても、このミリ秒数で打ち切ってhtmlを取得する
+SQLITE_WRITE_BATCH_SIZE = 20 # 3でsqlite3に書き込む際、この件数が溜まったらまとめてコミットする
+SQLITE_WRITE_INTERVAL = 5.0 # 件数が溜まらなくても、最初の1件からこの秒数が経ったらコミットする
+JOB_MAX_ATTEMPTS = 3 # 3の作業キューで1記事を何回まで取り出して試すか。超えたものはfailedになる
+JOB_STALE_SECONDS = 600 # 処理中のままこの秒数が経ったジョブは、プロセスが落ちたとみなして取り直す
+JOB_RETRY_FAILED = False # Trueにするとfailedになったジョブをpendingに戻してから実行する
 
 LANGUAGE='ja'
 SQLITE_TABLE_NAME='EN_08_07_2024'
-JSON_FILE_NAME = './output_files/JA_08_02_2024_V3.json'
+# 3で複数の言語を1回の実行でまとめて描画する場合の言語のリスト。空なら従来どおりLANGUAGEだけを描画してSQLITE_TABLE_NAMEに保存する
+# 空でなければ全言語の結果を(answer_id, language)をキーにしたARTICLES_TABLE_NAMEに保存し、4はそこからLANGUAGEの分だけを読む
+LANGUAGES = [] # 例: ['ja', 'ko', 'vi', 'th', 'id', 'en']
+ARTICLES_TABLE_NAME = 'articles_08_07_2024'
+JSON_FILE_NAME = './output_files/JA_08_02_2024_V3.json' # 4で出力、5で入力。拡張子を.jsonlにするとJSON Linesで1チャンクずつ書き出し、5でも1行ずつ読む(chunk_io.py)
 
 MIN_LENGTH = 300 #日本語の場合には170, 英語,インドネシア、タイ語の場合には300、韓国語は200、ベトナム語は230で良いかと
 MAX_LENGTH = 5000 #日本語の場合には3000, 英語,インドネシア、タイ語の場合には5000、韓国語は3500、ベトナム語は4000で良いかと
+CHUNK_WORKERS = 1 # 4で記事を並列に処理するプロセス数。1なら並列にしない。--workersで上書きできる
+CHUNK_SIZE_UNIT = 'chars' # 4でチャンクの大きさを何で測るか。'chars'ならMIN_LENGTH, MAX_LENGTH(文字数)、'tokens'ならMIN_TOKENS, MAX_TOKENS(トークン数)を使う
+MIN_TOKENS = 75 # 'tokens'の場合のMIN_LENGTHに相当する値。トークン数なので言語ごとに変える必要はない
+MAX_TOKENS = 1250 # 'tokens'の場合のMAX_LENGTHに相当する値。embeddingのモデルの入力の上限(text-embedding-004は2048)より十分小さくする
+TOKENIZER = 'heuristic' # トークン数の数え方(token_estimator.py)。'heuristic'は文字の種類からの見積もり、'tiktoken'はtiktokenがあればそれで数える
+TIKTOKEN_ENCODING = 'cl100k_base' # TOKENIZER = 'tiktoken'の場合のエンコーディング。ファイルがtiktokenのキャッシュにない場合はダウンロードせずheuristicで数える
+CHUNK_CACHE_ENABLED = True # Trueなら4で記事のhtmlと分割の設定が前回と同じ場合に、分割をやり直さず前回の結果を使う
+CHUNK_CACHE_PATH = './chunk_cache.sqlite3' # 4の分割結果のキャッシュの保存先
 
 # OPENAI_API_KEY='OPENAI_API_KEY'
 # OPENAI_EMBEDDING_MODEL='text-embedding-3-large'
+OPENAI_API_BASE = 'https://api.openai.com' # mock_embedding_server.pyで試す場合は'http://127.0.0.1:8765'
+OPENAI_EMBEDDING_RPM = 3000 # 1分あたりに送るリクエスト数の上限(契約しているTierに合わせる)
+OPENAI_EMBEDDING_TPM = 1000000 # 1分あたりに送るトークン数の上限
 
 # geminiのembeddingの最新版は英語のみ対応なことに注意
 GEMINI_API_KEY='GEMINI_API_KEY'
 GEMINI_EMBEDDING_MODEL='models/text-multilingual-embedding-002'
+GEMINI_API_BASE = 'https://generativelanguage.googleapis.com' # mock_embedding_server.pyで試す場合は'http://127.0.0.1:8765'
+GEMINI_EMBEDDING_RPM = 10 # 1分あたりに送るリクエスト数の上限。1リクエストで100チャンクなので、フリーバージョンの1分あたり1000チャンクに合わせて10
+GEMINI_EMBEDDING_TPM = 1000000 # 1分あたりに送るトークン数の上限(token_estimator.pyで数えた値)
+
+# 5のembedding APIへの送り方(embedding_runner.py)
+EMBEDDING_CONCURRENCY = 4 # 同時に送るバッチの数
+EMBEDDING_MAX_RETRIES = 6 # 429/5xx/通信エラーの場合に、失敗した1バッチを何回まで送り直すか。待ち時間はHTTP_BACKOFF_BASE, HTTP_BACKOFF_MAXに従う
+EMBEDDING_RESUME = True # Trueなら5が途中で終わった場合に、次の実行で最後に終わったバッチの次から再開する(vector_store.py)。Falseなら最初からやり直す
+EMBEDDING_CHECKPOINT_EVERY = 0 # このバッチ数ごとにFAISSのインデックスを書き出す。0なら最後に1回だけ書き出す
 
 FAISS_DATABASE_NAME='./output_files/JA_08_02_2024_V3_g.faiss'
+FAISS_ID_MAP = False # Trueならインデックスを、チャンクごとに1から固定のIDを振るIndexIDMap2で作り、差分実行では前回のインデックス(PREVIOUS_FAISS_DATABASE_NAME)のIDを引き継いで変わったチャンクだけを入れ替える。
+# この場合、検索結果のIDはjsonでの位置ではないので、<インデックス名>.meta.sqlite3の対応表(vector_metadata.VectorMetadata.lookup())でチャンクを引くこと。Falseなら従来どおりjsonの順(IDは0からの位置)のIndexFlatL2を作り直す
 
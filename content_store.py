@@ -0,0 +1,133 @@
+"""
+knowledge.sqlite3の正規化したスキーマ。スナップショット(従来のテーブル名)ごとにテーブルを作って本文をTEXTで丸ごと持つ代わりに、
+- content_blobs: 描画済みのhtmlを圧縮(zlib、またはzstandardがあればzstd)して、内容のハッシュ値(sha256)をキーに1回だけ保存する
+- pages: スナップショット・記事(answer_id)・言語ごとに、カテゴリ、url、本文のハッシュ値を持つ
+の2つのテーブルに分ける。スナップショット間で内容の変わらない記事は同じblobを指すので、スナップショットを重ねてもファイルはほとんど増えない。
+従来のテーブルと同じ形で読めるように、スナップショット名のviewを作る。viewの本文はdecompress_content()で展開するので、
+読む側の接続ではregister_functions()を呼んでおく必要がある(3と4で呼んでいる)。
+"""
+
+import hashlib
+import zlib
+import config as cfg
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CONTENT_COMPRESSION = cfg.CONTENT_COMPRESSION
+ZLIB_LEVEL = 9
+
+
+# 圧縮方式を決める。zstdが指定されていてもzstandardがインストールされていなければzlibにする
+def resolve_codec(codec=CONTENT_COMPRESSION):
+    if codec == 'zstd' and zstandard is None:
+        return 'zlib'
+    return codec
+
+
+def content_hash(html):
+    return hashlib.sha256(html.encode('utf-8')).hexdigest()
+
+
+def compress(html, codec):
+    data = html.encode('utf-8')
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=19).compress(data)
+    if codec == 'zlib':
+        return zlib.compress(data, ZLIB_LEVEL)
+    raise ValueError(f'未対応の圧縮方式です: {codec}')
+
+
+def decompress(codec, data):
+    if data is None:
+        return None
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstdで圧縮された本文を読むにはzstandardをインストールしてください')
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    if codec == 'zlib':
+        return zlib.decompress(data).decode('utf-8')
+    raise ValueError(f'未対応の圧縮方式です: {codec}')
+
+
+# viewから本文を読む接続で呼んでおく
+def register_functions(conn):
+    conn.create_function('decompress_content', 2, decompress, deterministic=True)
+
+
+def prepare_schema(conn):
+    conn.executescript('''
+    CREATE TABLE IF NOT EXISTS content_blobs (
+        hash TEXT PRIMARY KEY,
+        codec TEXT NOT NULL,
+        size INTEGER NOT NULL, -- 圧縮前のバイト数
+        data BLOB NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS pages (
+        snapshot TEXT NOT NULL,
+        answer_id TEXT NOT NULL,
+        language TEXT NOT NULL,
+        row_index INTEGER,
+        category TEXT,
+        reference_url TEXT,
+        content_hash TEXT NOT NULL REFERENCES content_blobs (hash),
+        PRIMARY KEY (snapshot, answer_id, language)
+    );
+    CREATE INDEX IF NOT EXISTS idx_pages_reference_url ON pages (reference_url);
+    CREATE INDEX IF NOT EXISTS idx_pages_language_snapshot ON pages (language, snapshot, row_index);
+    CREATE INDEX IF NOT EXISTS idx_pages_snapshot_row ON pages (snapshot, row_index);
+    CREATE INDEX IF NOT EXISTS idx_pages_content_hash ON pages (content_hash);
+    ''')
+    conn.commit()
+
+
+def _quote(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+# スナップショットを従来のテーブルと同じ名前・同じ列(id, category, reference_url, content, language)で読めるviewを作る。
+# 3で複数言語をまとめて描画した場合の列(answer_id, language, row_index)も含めている
+def create_snapshot_view(conn, snapshot):
+    conn.execute(f'''
+    CREATE VIEW IF NOT EXISTS {snapshot} AS
+    SELECT pages.row_index + 1 AS id,
+           pages.category AS category,
+           pages.reference_url AS reference_url,
+           decompress_content(content_blobs.codec, content_blobs.data) AS content,
+           pages.language AS language,
+           pages.answer_id AS answer_id,
+           pages.row_index AS row_index
+    FROM pages JOIN content_blobs ON content_blobs.hash = pages.content_hash
+    WHERE pages.snapshot = {_quote(snapshot)}
+    ''')
+    conn.commit()
+
+
+# 1記事1言語分を保存する(sql, params)のリスト。本文は同じハッシュ値のblobがなければ追加し、pagesはupsertする
+def page_statements(snapshot, article_id, language, row_index, category, url, html, codec):
+    digest = content_hash(html)
+    return [
+        ('INSERT OR IGNORE INTO content_blobs (hash, codec, size, data) VALUES (?, ?, ?, ?)',
+         (digest, codec, len(html.encode('utf-8')), compress(html, codec))),
+        ('''INSERT INTO pages (snapshot, answer_id, language, row_index, category, reference_url, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?)
+         ON CONFLICT (snapshot, answer_id, language) DO UPDATE SET
+             row_index = excluded.row_index,
+             category = excluded.category,
+             reference_url = excluded.reference_url,
+             content_hash = excluded.content_hash''',
+         (snapshot, article_id, language, row_index, category, url, digest)),
+    ]
+
+
+# どのpagesからも参照されなくなったblobを削除する
+def delete_orphan_blobs(conn):
+    deleted = conn.execute('DELETE FROM content_blobs WHERE hash NOT IN (SELECT content_hash FROM pages)').rowcount
+    conn.commit()
+    return deleted
+
+
+def object_type(conn, name):
+    row = conn.execute('SELECT type FROM sqlite_master WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else None
@@ -0,0 +1,98 @@
+"""
+ページのレスポンスをローカルに保存しておくためのキャッシュ。
+キーは正規化したurlと言語(hl)の組み合わせで、本文はその内容のハッシュ値をファイル名にして保存する(content-addressed)。
+ETagとLast-Modifiedも一緒に保存しておき、次回はIf-None-Match/If-Modified-Sinceで再検証することで、
+変更のないページは304(またはキャッシュの有効期限内であれば通信なし)で済ませる。
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+import config as cfg
+from url_canon import normalize_url, url_language
+
+HTTP_CACHE_MAX_AGE = cfg.HTTP_CACHE_MAX_AGE
+
+
+# ファイルの書き込み途中でプロセスが落ちても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える
+def _atomic_write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class CacheEntry:
+    def __init__(self, body, etag=None, last_modified=None, fetched_at=0.0):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+
+    def is_fresh(self, max_age=HTTP_CACHE_MAX_AGE):
+        return max_age > 0 and time.time() - self.fetched_at < max_age
+
+    # 再検証用のリクエストヘッダー
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.index_dir = self.cache_dir / 'index'
+        self.blob_dir = self.cache_dir / 'blobs'
+
+    def _key(self, url, language=None):
+        language = url_language(url) if language is None else language
+        return hashlib.sha256(f'{normalize_url(url)}\n{language}'.encode('utf-8')).hexdigest()
+
+    def _index_path(self, key):
+        return self.index_dir / key[:2] / f'{key}.json'
+
+    def _blob_path(self, digest):
+        return self.blob_dir / digest[:2] / f'{digest}.html.gz'
+
+    def get(self, url, language=None):
+        index_path = self._index_path(self._key(url, language))
+        try:
+            meta = json.loads(index_path.read_text(encoding='utf-8'))
+            with gzip.open(self._blob_path(meta['sha256']), 'rt', encoding='utf-8') as file:
+                body = file.read()
+        except (FileNotFoundError, KeyError, ValueError, OSError):
+            return None
+        return CacheEntry(body, meta.get('etag'), meta.get('last_modified'), meta.get('fetched_at', 0.0))
+
+    def put(self, url, body, etag=None, last_modified=None, language=None):
+        data = body.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(digest)
+        if not blob_path.exists(): # 同じ内容の本文は1つだけ保存する
+            _atomic_write(blob_path, gzip.compress(data))
+        meta = {
+            'url': url,
+            'language': url_language(url) if language is None else language,
+            'sha256': digest,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetched_at': time.time(),
+        }
+        _atomic_write(self._index_path(self._key(url, language)), json.dumps(meta, ensure_ascii=False).encode('utf-8'))
+
+    # 304が返ってきた場合など、内容は変わらず取得時刻だけを更新する
+    def touch(self, url, entry, language=None):
+        self.put(url, entry.body, entry.etag, entry.last_modified, language)
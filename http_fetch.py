@@ -0,0 +1,169 @@
+"""
+各段で共通して使うHTTP取得レイヤー。
+keep-aliveで接続を使い回すSession(コネクションプール)、gzip/br圧縮、リクエストごとのタイムアウト、
+429/5xxや接続エラーに対するジッター付き指数バックオフでのリトライ、Retry-Afterヘッダーの尊重をまとめて扱う。
+リトライしきれなかった場合は、requestsの例外をそのまま呼び出し側に投げる。
+ResponseCache(http_cache.py)を渡すと、get_text()で条件付きリクエストによる再検証とオフライン再生ができる。
+"""
+
+import email.utils
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+import config as cfg
+
+HTTP_TIMEOUT = cfg.HTTP_TIMEOUT
+HTTP_MAX_RETRIES = cfg.HTTP_MAX_RETRIES
+HTTP_BACKOFF_BASE = cfg.HTTP_BACKOFF_BASE
+HTTP_BACKOFF_MAX = cfg.HTTP_BACKOFF_MAX
+
+# これらのステータスコードは一時的なものとみなしてリトライする
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+logger = logging.getLogger(__name__)
+
+
+# オフラインモードでキャッシュに存在しないページを要求された場合の例外。
+# 呼び出し側では通常のリクエストエラーと同じように扱えるよう、RequestExceptionを継承している
+class OfflineCacheMiss(requests.exceptions.RequestException):
+    pass
+
+
+# brotliがインストールされている場合のみ、urllib3がbrの展開に対応する
+def accept_encoding():
+    try:
+        import brotli  # noqa: F401
+        return 'gzip, deflate, br'
+    except ImportError:
+        return 'gzip, deflate'
+
+
+# Retry-Afterヘッダーは秒数またはHTTP日付のどちらかで返ってくる。解釈できない場合はNone
+def parse_retry_after(value):
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+# ホストごとにリクエストの間隔を空けるためのレートリミッター。全ワーカーで1つを共有する。
+# 各リクエストに固定のsleepを入れる代わりに、次にリクエストを送ってよい時刻を予約していく方式
+class HostRateLimiter:
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_allowed = {}
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            scheduled = max(now, self._next_allowed.get(host, now))
+            # 間隔が機械的に一定にならないよう、少しだけ揺らぎを入れる
+            self._next_allowed[host] = scheduled + self.min_interval * random.uniform(1, 1.5)
+        delay = scheduled - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Fetcher:
+    def __init__(self, headers, pool_size=10, rate_limiter=None, timeout=HTTP_TIMEOUT,
+                 max_retries=HTTP_MAX_RETRIES, backoff_base=HTTP_BACKOFF_BASE, backoff_max=HTTP_BACKOFF_MAX,
+                 cache=None, offline=False):
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.offline = offline
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # キャッシュの効き具合の集計。fresh=通信なし, not_modified=304, fetched=本文を取得
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.session.headers['Accept-Encoding'] = accept_encoding()
+        # リトライはこのクラスで行うので、urllib3側のリトライは無効にしておく
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    # フルジッター方式の指数バックオフ
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def get(self, url, headers=None):
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.wait(url)
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f'通信エラーのため {delay:.1f}秒後にリトライします({attempt + 1}/{self.max_retries}): {url} {err}')
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    response.raise_for_status()
+                    return response
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                delay = min(self.backoff_max, retry_after) if retry_after is not None else self._backoff(attempt)
+                logger.warning(f'ステータス{response.status_code}のため {delay:.1f}秒後にリトライします({attempt + 1}/{self.max_retries}): {url}')
+                response.close()
+
+            time.sleep(delay)
+            attempt += 1
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    # キャッシュを考慮してページの本文を返す。
+    # 有効期限内のキャッシュは通信せずに返し、それ以外はETag/Last-Modifiedで再検証して304ならキャッシュを返す
+    def get_text(self, url, language=None):
+        entry = self.cache.get(url, language) if self.cache else None
+        if entry and (self.offline or entry.is_fresh()):
+            self._count('fresh')
+            return entry.body
+        if self.offline:
+            raise OfflineCacheMiss(f'オフラインモードですが、このページはキャッシュに存在しません: {url}')
+
+        response = self.get(url, headers=entry.conditional_headers() if entry else None)
+        if response.status_code == 304 and entry:
+            self._count('not_modified')
+            self.cache.touch(url, entry, language)
+            return entry.body
+
+        self._count('fetched')
+        if self.cache:
+            self.cache.put(url, response.text, response.headers.get('ETag'), response.headers.get('Last-Modified'), language)
+        return response.text
+
+    # 保存しておいたETag/Last-Modifiedでサーバーに問い合わせ、ページが変わっていなければTrueを返す
+    def is_not_modified(self, url, entry):
+        headers = entry.conditional_headers()
+        if not headers:
+            return False
+        response = self.get(url, headers=headers)
+        response.close()
+        if response.status_code == 304:
+            self._count('not_modified')
+            return True
+        return False
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,90 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer
+import pytest
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, '5_embedding'))
+from embedding_runner import EmbeddingRunner, RateLimiter, GeminiProvider, OpenAIProvider
+from mock_embedding_server import MockState, fake_vector, make_handler
+
+DIMENSION = 8
+
+
+@pytest.fixture
+def mock_server():
+    state = MockState(DIMENSION, rpm=0, fail_rate=0.0, delay=0.05)
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(state))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}', state
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_batches(count, size=3):
+    return [(n, [f'batch {n} chunk {i}' for i in range(size)], 10) for n in range(count)]
+
+
+def run_all(provider, batches, concurrency=4, backoff_max=5.0):
+    runner = EmbeddingRunner(provider, RateLimiter(6000, 10 ** 9), concurrency, max_retries=3, backoff_base=0.01, backoff_max=backoff_max)
+
+    async def collect():
+        return [result async for result in runner.run(batches)]
+
+    try:
+        return asyncio.run(collect()), runner.stats
+    finally:
+        provider.close()
+
+
+def gemini(base_url):
+    return GeminiProvider('test-key', 'text-multilingual-embedding-002', base_url)
+
+
+# 429が返ってきたらRetry-Afterの秒数だけ待ってから、そのバッチを送り直す
+def test_rate_limited_batch_is_retried_after_retry_after(mock_server):
+    base_url, state = mock_server
+    state.fail_next(1, retry_after=1)
+    results, stats = run_all(gemini(base_url), make_batches(1))
+
+    assert [key for key, _ in results] == [0]
+    assert stats['rate_limited'] == 1 and stats['retried'] == 1
+    (failed_at, failed_texts, failed_status), (retried_at, retried_texts, retried_status) = state.requests
+    assert (failed_status, retried_status) == (429, 200)
+    assert retried_texts == failed_texts
+    assert retried_at - failed_at >= 0.9
+
+
+# 同時に複数のバッチを送り、途中で429が返ってきても、結果はバッチを渡した順に、テキストの順のベクトルで返ってくる
+def test_results_keep_batch_order_under_concurrency(mock_server):
+    base_url, state = mock_server
+    batches = make_batches(12)
+    state.fail_next(2, retry_after=1)
+    results, _ = run_all(gemini(base_url), batches, concurrency=4)
+
+    assert [key for key, _ in results] == [key for key, _, _ in batches]
+    for (_, texts, _), (_, vectors) in zip(batches, results):
+        assert vectors == [fake_vector(text, DIMENSION) for text in texts]
+    # 最初のconcurrency個のバッチは、1つ目の応答(delay秒後)を待たずに送られている
+    assert state.requests[3][0] - state.requests[0][0] < state.delay
+
+
+# 失敗したバッチだけを送り直し、成功したバッチは1回しか送らない
+def test_only_failed_batch_is_resent(mock_server):
+    base_url, state = mock_server
+    batches = make_batches(6)
+    state.fail_next(1, retry_after=1)
+    results, stats = run_all(OpenAIProvider('test-key', 'text-embedding-3-large', base_url), batches, concurrency=1)
+
+    sent = Counter(tuple(texts) for _, texts, _ in state.requests)
+    failed = [tuple(texts) for _, texts, status in state.requests if status == 429]
+    assert len(failed) == 1
+    assert sent[failed[0]] == 2
+    assert all(count == 1 for texts, count in sent.items() if texts != failed[0])
+    assert stats['requests'] == len(batches) + 1
+    assert [key for key, _ in results] == [key for key, _, _ in batches]
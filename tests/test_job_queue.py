@@ -0,0 +1,43 @@
+import os
+import sys
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, '3_scrape_and_save'))
+from job_queue import JobQueue
+
+
+def finish_all(jobs):
+    while (job := jobs.claim()) is not None:
+        jobs.conn.execute(*jobs.done_statement(job[0], job[1]))
+
+
+def job_rows(jobs):
+    return jobs.conn.execute('SELECT row_index, category, url, status, attempts FROM scrape_jobs ORDER BY row_index').fetchall()
+
+
+# csvを作り直して同じ行番号の記事が変わった場合は、新しいurlでやり直す。カテゴリだけの変更ではやり直さない
+def test_seed_replaces_jobs_from_regenerated_csv(tmp_path):
+    jobs = JobQueue(str(tmp_path / 'knowledge.sqlite3'), 'EN_08_07_2024', max_attempts=3, stale_after=600)
+    assert jobs.seed([('A', 'https://example.com/0'), ('A', 'https://example.com/1'), ('A', 'https://example.com/2')], ['ja']) == 3
+    finish_all(jobs)
+
+    assert jobs.seed([('A', 'https://example.com/0'), ('B', 'https://example.com/1'), ('A', 'https://example.com/9')], ['ja']) == 2
+    assert job_rows(jobs) == [
+        (0, 'A', 'https://example.com/0', 'done', 1),
+        (1, 'B', 'https://example.com/1', 'done', 1),
+        (2, 'A', 'https://example.com/9', 'pending', 0),
+    ]
+    assert jobs.seed([('A', 'https://example.com/0'), ('B', 'https://example.com/1'), ('A', 'https://example.com/9')], ['ja']) == 0
+    assert jobs.claim()[3] == 'https://example.com/9'
+    jobs.close()
+
+
+# 処理中のまま止まったジョブは取り直すが、試行回数が上限に達していればfailedにする
+def test_stale_jobs_fail_at_max_attempts(tmp_path):
+    jobs = JobQueue(str(tmp_path / 'knowledge.sqlite3'), 'EN_08_07_2024', max_attempts=2, stale_after=0)
+    jobs.seed([('A', 'https://example.com/0')], ['ja'])
+    assert jobs.claim() is not None
+    assert jobs.claim() is not None # 1回目が処理中のまま止まったとみなして取り直す
+    assert jobs.claim() is None
+    assert jobs.counts() == {'failed': 1}
+    jobs.close()
@@ -0,0 +1,46 @@
+import os
+import sqlite3
+import sys
+import pytest
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, '3_scrape_and_save'))
+import content_store
+from migrate_to_normalized_schema import migrate_table
+
+
+def create_legacy_table(rows):
+    conn = sqlite3.connect(':memory:')
+    content_store.register_functions(conn)
+    content_store.prepare_schema(conn)
+    conn.execute('CREATE TABLE EN_08_07_2024 (id INTEGER PRIMARY KEY, category TEXT, reference_url TEXT, content TEXT, language TEXT)')
+    conn.executemany('INSERT INTO EN_08_07_2024 (id, category, reference_url, content, language) VALUES (?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    return conn
+
+
+def test_migrate_table():
+    conn = create_legacy_table([
+        (1, 'A', 'https://support.google.com/youtube/answer/100?hl=ja', '<p>100</p>', 'ja'),
+        (2, 'B', 'https://support.google.com/youtube/answer/200?hl=ja', '<p>200</p>', 'ja'),
+    ])
+    migrate_table(conn, 'EN_08_07_2024')
+    assert content_store.object_type(conn, 'EN_08_07_2024') == 'view'
+    assert content_store.object_type(conn, 'EN_08_07_2024_legacy') == 'table'
+    assert conn.execute('SELECT id, category, reference_url, content FROM EN_08_07_2024 ORDER BY id').fetchall() == [
+        (1, 'A', 'https://support.google.com/youtube/answer/100?hl=ja', '<p>100</p>'),
+        (2, 'B', 'https://support.google.com/youtube/answer/200?hl=ja', '<p>200</p>'),
+    ]
+
+
+# 同じ記事がurlの形を変えて2行ある場合は、1行にまとめて片方の内容を失う代わりに、移行せずにエラーにする
+def test_migrate_table_rejects_two_url_forms_of_same_answer():
+    conn = create_legacy_table([
+        (1, 'A', 'https://support.google.com/youtube/answer/100?hl=ja', '<p>old</p>', 'ja'),
+        (2, 'A', 'https://support.google.com/youtube/answer/100?hl=ja&ref_topic=9257498', '<p>new</p>', 'ja'),
+    ])
+    with pytest.raises(ValueError):
+        migrate_table(conn, 'EN_08_07_2024')
+    assert content_store.object_type(conn, 'EN_08_07_2024') == 'table'
+    assert conn.execute('SELECT COUNT(*) FROM EN_08_07_2024').fetchone()[0] == 2
+    assert conn.execute('SELECT COUNT(*) FROM pages').fetchone()[0] == 0
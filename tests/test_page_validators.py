@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, '3_scrape_and_save'))
+from http_fetch import Fetcher
+from page_validators import prepare_validator_table, validator_statement, load_validators, is_previous_unchanged
+
+
+# ETagで条件付きGETに答えるだけのサーバー。pages[path]を書き換えるとETagも変わる
+@pytest.fixture
+def server():
+    pages = {'/youtube/answer/100': 'v1'}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            etag = f'"{pages[self.path]}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = f'<div>{pages[self.path]}</div>'.encode('utf-8')
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}', pages
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def save_and_load(snapshot, url_key, etag, html):
+    conn = sqlite3.connect(':memory:')
+    prepare_validator_table(conn)
+    conn.execute(*validator_statement(snapshot, url_key, 'ja', etag, None, html))
+    validators = load_validators(conn, snapshot)
+    conn.close()
+    return validators
+
+
+# 前回から引き継いだ記事の内容が変わった場合は、前回のhtmlを使わずに描画し直すと判定される
+def test_retained_article_changes_are_picked_up(server):
+    base_url, pages = server
+    url = f'{base_url}/youtube/answer/100'
+    previous_html = '<article>rendered v1</article>'
+    validator = save_and_load('EN_07_23_2024', '100', '"v1"', previous_html)[('100', 'ja')]
+    fetcher = Fetcher({}, max_retries=0)
+    try:
+        assert is_previous_unchanged(fetcher, url, previous_html, validator)
+        pages['/youtube/answer/100'] = 'v2'
+        assert not is_previous_unchanged(fetcher, url, previous_html, validator)
+    finally:
+        fetcher.close()
+
+
+# 記録がない、通信できない、記録したときと前回のhtmlが違う場合は、変更を確かめられないので描画し直す
+def test_unverifiable_article_is_rendered(server):
+    base_url, _ = server
+    url = f'{base_url}/youtube/answer/100'
+    previous_html = '<article>rendered v1</article>'
+    validator = save_and_load('EN_07_23_2024', '100', '"v1"', previous_html)[('100', 'ja')]
+    fetcher = Fetcher({}, max_retries=0)
+    try:
+        assert not is_previous_unchanged(fetcher, url, previous_html, None)
+        assert not is_previous_unchanged(None, url, previous_html, validator)
+        assert not is_previous_unchanged(fetcher, url, '<article>edited by hand</article>', validator)
+        assert not is_previous_unchanged(fetcher, url, previous_html, (None, None, validator[2]))
+    finally:
+        fetcher.close()
+
+
+def test_load_validators_without_table():
+    conn = sqlite3.connect(':memory:')
+    assert load_validators(conn, 'EN_07_23_2024') == {}
+    conn.close()
@@ -0,0 +1,33 @@
+import json
+import os
+import sys
+import pytest
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, '4_split_into_md_chunks'))
+from split_and_make_md_chunks_json import clean_up_tags, splitter, ChunkEngine
+
+# 期待値は、1回だけ木を辿る方式・行のリストで作る方式に変える前のclean_up_tags(), splitter()の出力を保存したもの
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+
+# zippyの見出し、gkms-context-selector、img、iframe、入れ子のdiv、table、空のタグ、span、&nbsp;、コメントやscriptを含む記事
+def test_clean_up_tags_matches_saved_output():
+    assert clean_up_tags(read_fixture('article.html')) == read_fixture('article.cleaned.html')
+
+
+# 見出しでの分割(min_lengthを超えた場合)と、target_countを超えた場合の分割の両方が起きる大きさで比べる
+@pytest.mark.parametrize('target_count, min_length', [(400, 150), (800, 300)])
+def test_splitter_matches_saved_output(target_count, min_length):
+    content = read_fixture('article.cleaned.html')
+    h1_index = content.find('</h1>')
+    content = content[:h1_index + 5] + '\n' + content[h1_index + 5:]
+    expected = json.loads(read_fixture('article.chunks.json'))[f'{target_count}:{min_length}']
+
+    chunks = splitter(content.split('\n'), ChunkEngine.new_converter(), target_count, len, min_length)
+    assert chunks == expected
@@ -0,0 +1,52 @@
+import os
+import sqlite3
+import sys
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, '3_scrape_and_save'))
+from sqlite_writer import SQLiteWriter, prepare_article_table, article_statements
+
+
+def create_legacy_table(path):
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE articles (id INTEGER PRIMARY KEY, category TEXT, reference_url TEXT, content TEXT)')
+    prepare_article_table(conn, 'articles', 'ja')
+    conn.close()
+
+
+def write_rows(path, rows):
+    writer = SQLiteWriter(path, batch_size=10, flush_interval=0.1)
+    writer.start()
+    for row_id, url, content in rows:
+        writer.put(article_statements('articles', row_id, 'category', url, 'ja', content))
+    writer.close()
+
+
+def read_rows(path):
+    conn = sqlite3.connect(path)
+    rows = conn.execute('SELECT id, reference_url, content FROM articles ORDER BY id').fetchall()
+    conn.close()
+    return rows
+
+
+# 再実行でidとurlの組み合わせがずれても(csvの行の増減、urlの正規化)、書き込みスレッドが落ちずに最新の内容になる
+def test_rerun_with_shifted_ids(tmp_path):
+    path = str(tmp_path / 'knowledge.sqlite3')
+    create_legacy_table(path)
+    write_rows(path, [(1, 'https://example.com/a', 'a1'), (2, 'https://example.com/b', 'b1'), (3, 'https://example.com/c', 'c1')])
+
+    # 先頭の行がなくなり、残りの行のidが1つずつ前にずれた
+    write_rows(path, [(1, 'https://example.com/b', 'b2'), (2, 'https://example.com/c', 'c2')])
+    assert read_rows(path) == [(1, 'https://example.com/b', 'b2'), (2, 'https://example.com/c', 'c2')]
+
+    # 先頭に行が増え、idが1つずつ後ろにずれた
+    write_rows(path, [(1, 'https://example.com/z', 'z3'), (2, 'https://example.com/b', 'b3'), (3, 'https://example.com/c', 'c3')])
+    assert read_rows(path) == [(1, 'https://example.com/z', 'z3'), (2, 'https://example.com/b', 'b3'), (3, 'https://example.com/c', 'c3')]
+
+
+def test_rerun_with_same_ids_updates_content(tmp_path):
+    path = str(tmp_path / 'knowledge.sqlite3')
+    create_legacy_table(path)
+    write_rows(path, [(1, 'https://example.com/a', 'a1')])
+    write_rows(path, [(1, 'https://example.com/a', 'a2')])
+    assert read_rows(path) == [(1, 'https://example.com/a', 'a2')]
@@ -0,0 +1,123 @@
+import json
+import os
+import sys
+import zlib
+import pytest
+np = pytest.importorskip('numpy')
+faiss = pytest.importorskip('faiss')
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+sys.path.insert(0, os.path.join(project_root, '5_embedding'))
+from chunk_io import iter_chunk_records
+from content_store import content_hash
+from vector_store import VectorStore
+from vector_metadata import VectorMetadata, metadata_path, write_index_with_metadata
+
+DIMENSION = 16
+
+
+def fake_vector(content):
+    return np.random.default_rng(zlib.crc32(content.encode('utf-8'))).random(DIMENSION, dtype=np.float32)
+
+
+def chunk(article, index, text):
+    return {'content': f'{text}\n[SOURCE] https://support.google.com/youtube/answer/{article}?hl=ja',
+            'article_id': str(article), 'chunk_index': index, 'source_url': f'https://support.google.com/youtube/answer/{article}?hl=ja',
+            'category': 'A - B'}
+
+
+# チャンクをjsonlに書き、ベクトルを保存したstoreを作る(embeddingの代わりに内容から決まるベクトルを使う)
+def make_store(tmp_path, name, chunks):
+    json_path = tmp_path / f'{name}.jsonl'
+    with open(json_path, 'w', encoding='utf-8') as f:
+        for record in chunks:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    store = VectorStore(tmp_path / f'{name}.faiss', DIMENSION, 'fake', json_path, batch_size=100, resume=False)
+    store.append(1, np.array([fake_vector(record['content']) for record in chunks]))
+    return store, json_path
+
+
+def write(tmp_path, name, chunks, id_map=True, base_path=None):
+    store, json_path = make_store(tmp_path, name, chunks)
+    faiss_path = tmp_path / f'{name}.faiss'
+    counts = write_index_with_metadata(store, iter_chunk_records(json_path), faiss_path, id_map, 'ja', base_path=base_path)
+    return faiss_path, counts
+
+
+def ids_by_key(faiss_path):
+    meta = VectorMetadata(metadata_path(faiss_path))
+    try:
+        return {chunk_key: vector_id for chunk_key, (vector_id, _) in meta.existing().items()}
+    finally:
+        meta.close()
+
+
+# 全てのチャンクについて、自分のベクトルで検索した1位のIDを対応表で引くと、そのチャンクが返ってくる
+def assert_search_maps_back(faiss_path, chunks):
+    index = faiss.read_index(str(faiss_path))
+    assert index.ntotal == len(chunks)
+    meta = VectorMetadata(metadata_path(faiss_path))
+    try:
+        _, found = index.search(np.array([fake_vector(record['content']) for record in chunks]), 1)
+        hits = meta.lookup(found[:, 0])
+        for record, vector_id in zip(chunks, found[:, 0]):
+            hit = hits[int(vector_id)]
+            assert hit['chunk_key'] == f"{record['article_id']}:ja:{record['chunk_index']}"
+            assert hit['content_hash'] == content_hash(record['content'])
+            assert hit['source_url'] == record['source_url']
+    finally:
+        meta.close()
+
+
+def test_positional_ids_are_json_positions(tmp_path):
+    chunks = [chunk(100, 0, 'a'), chunk(100, 1, 'b'), chunk(200, 0, 'c')]
+    faiss_path, _ = write(tmp_path, 'v1', chunks, id_map=False)
+    assert isinstance(faiss.read_index(str(faiss_path)), faiss.IndexFlatL2)
+    assert ids_by_key(faiss_path) == {'100:ja:0': 0, '100:ja:1': 1, '200:ja:0': 2}
+    assert_search_maps_back(faiss_path, chunks)
+
+
+# 同じファイル名のインデックスを2回更新しても、内容の変わらないチャンクのIDは変わらず、検索結果は正しいチャンクに戻る
+def test_id_map_updated_twice_in_place(tmp_path):
+    v1 = [chunk(100, 0, 'a'), chunk(100, 1, 'b'), chunk(200, 0, 'c'), chunk(300, 0, 'd')]
+    faiss_path, counts = write(tmp_path, 'index', v1)
+    assert counts == {'added': 4, 'removed': 0, 'kept': 0}
+    first = ids_by_key(faiss_path)
+    assert sorted(first.values()) == [1, 2, 3, 4]
+    assert_search_maps_back(faiss_path, v1)
+
+    # 100:1を変更、300を削除、400を追加
+    v2 = [chunk(100, 0, 'a'), chunk(100, 1, 'b changed'), chunk(200, 0, 'c'), chunk(400, 0, 'e')]
+    faiss_path, counts = write(tmp_path, 'index', v2)
+    assert counts == {'added': 2, 'removed': 2, 'kept': 2}
+    second = ids_by_key(faiss_path)
+    assert second['100:ja:0'] == first['100:ja:0'] and second['200:ja:0'] == first['200:ja:0']
+    assert second['100:ja:1'] not in first.values() and second['400:ja:0'] not in first.values()
+    assert_search_maps_back(faiss_path, v2)
+
+    # 200を削除。一度使ったIDは再利用しない
+    v3 = [chunk(100, 0, 'a'), chunk(100, 1, 'b changed'), chunk(400, 0, 'e'), chunk(500, 0, 'f')]
+    faiss_path, counts = write(tmp_path, 'index', v3)
+    assert counts == {'added': 1, 'removed': 1, 'kept': 3}
+    third = ids_by_key(faiss_path)
+    assert all(third[key] == second[key] for key in ['100:ja:0', '100:ja:1', '400:ja:0'])
+    assert third['500:ja:0'] > max(second.values())
+    assert_search_maps_back(faiss_path, v3)
+
+
+# スナップショットごとに別のファイル名でも、前回のインデックスを指定すればIDを引き継ぎ、前回のファイルは変更しない
+def test_id_map_from_previous_snapshot(tmp_path):
+    v1 = [chunk(100, 0, 'a'), chunk(200, 0, 'b'), chunk(300, 0, 'c')]
+    previous_path, _ = write(tmp_path, 'JA_07_23_2024', v1)
+    previous_ids = ids_by_key(previous_path)
+
+    v2 = [chunk(100, 0, 'a'), chunk(200, 0, 'b changed'), chunk(400, 0, 'd')]
+    current_path, counts = write(tmp_path, 'JA_08_02_2024', v2, base_path=previous_path)
+    assert counts == {'added': 2, 'removed': 2, 'kept': 1}
+    current_ids = ids_by_key(current_path)
+    assert current_ids['100:ja:0'] == previous_ids['100:ja:0']
+    assert min(current_ids['200:ja:0'], current_ids['400:ja:0']) > max(previous_ids.values())
+    assert_search_maps_back(current_path, v2)
+
+    assert ids_by_key(previous_path) == previous_ids
+    assert_search_maps_back(previous_path, v1)
@@ -0,0 +1,77 @@
+"""
+ネットワークを使わずにテキストのトークン数を見積もる。4のチャンク分割(トークン数で大きさを決める場合)と5の確認用スクリプトで使う。
+- 'heuristic': 文字の種類ごとの平均的なトークン数から見積もる。速く、依存パッケージも不要
+  (漢字・かな・ハングルは1文字あたり約1トークン、タイ語などは約0.5トークン、ASCIIの文字は約4文字で1トークン)
+- 'tiktoken': tiktokenがインストールされていれば、そのエンコーディング(cfg.TIKTOKEN_ENCODING)で実際に数える。
+  embeddingのモデル(geminiなど)のトークナイザーとは完全には一致しないが、見積もりより正確になる
+tiktokenが指定されていてもインストールされていなければheuristicになる。
+tiktokenは初めて使うエンコーディングのファイルをネットワークから取ってくるので、手元(tiktokenのキャッシュ)に
+ファイルがない場合もheuristicになる。tiktokenで数えたい場合は、ネットワークのある環境で一度
+tiktoken.get_encoding(cfg.TIKTOKEN_ENCODING)を実行しておくか、ダウンロードしたファイルを置いた
+ディレクトリを環境変数TIKTOKEN_CACHE_DIRで指定する(ファイル名はtiktoken_cache_path()を参照)。
+"""
+
+import hashlib
+import logging
+import math
+import os
+import re
+import tempfile
+import config as cfg
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+TOKENIZER = cfg.TOKENIZER
+TIKTOKEN_ENCODING = cfg.TIKTOKEN_ENCODING
+
+# 1文字をほぼ1トークンとして数える文字(CJK統合漢字、ひらがな、カタカナ、ハングル、全角記号など)
+WIDE_CHAR_PATTERN = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+# 単語の区切りが空白でなく、2文字で約1トークンになる文字(タイ語、ラオ語、ミャンマー語、クメール語)
+SOUTHEAST_ASIAN_CHAR_PATTERN = re.compile(r'[\u0e00-\u0eff\u1000-\u109f\u1780-\u17ff]')
+ASCII_CHARS_PER_TOKEN = 4 # 英語などは空白や記号を含めて約4文字で1トークン
+OTHER_CHARS_PER_TOKEN = 2 # それ以外のASCII以外の文字(ベトナム語の声調記号付きの文字など)
+TAG_PATTERN = re.compile(r'<[^>]*>')
+TIKTOKEN_BLOB_URL = 'https://openaipublic.blob.core.windows.net/encodings/{}.tiktoken' # cl100k_base, o200k_baseなどの配布元
+
+logger = logging.getLogger(__name__)
+
+
+# tiktokenがエンコーディングのファイルをキャッシュする場所(tiktoken.loadと同じ決め方。ファイル名は配布元URLのsha1)
+def tiktoken_cache_path(encoding):
+    cache_dir = os.environ.get('TIKTOKEN_CACHE_DIR') or os.environ.get('DATA_GYM_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'data-gym-cache')
+    return os.path.join(cache_dir, hashlib.sha1(TIKTOKEN_BLOB_URL.format(encoding).encode()).hexdigest())
+
+
+# 文字の種類ごとに数えて足し合わせる。1文字ずつPythonで調べると遅いので、数えるのはencodeと正規表現(C実装)に任せる
+def estimate_tokens(text):
+    ascii_count = len(text.encode('ascii', 'ignore'))
+    non_ascii = len(text) - ascii_count
+    if not non_ascii:
+        return math.ceil(ascii_count / ASCII_CHARS_PER_TOKEN)
+    wide = len(WIDE_CHAR_PATTERN.findall(text))
+    southeast_asian = len(SOUTHEAST_ASIAN_CHAR_PATTERN.findall(text)) if wide < non_ascii else 0
+    other = non_ascii - wide - southeast_asian
+    return wide + math.ceil(ascii_count / ASCII_CHARS_PER_TOKEN + southeast_asian / 2 + other / OTHER_CHARS_PER_TOKEN)
+
+
+class TokenCounter:
+    def __init__(self, tokenizer=TOKENIZER, encoding=TIKTOKEN_ENCODING):
+        self.encoding = None
+        if tokenizer == 'tiktoken' and tiktoken is not None:
+            if os.path.exists(tiktoken_cache_path(encoding)):
+                self.encoding = tiktoken.get_encoding(encoding)
+            else:
+                logger.warning(f'tiktokenのエンコーディング{encoding}が手元にないので(ダウンロードはしない)、見積もりで数えます: {tiktoken_cache_path(encoding)}')
+        self.name = f'tiktoken({encoding})' if self.encoding else 'heuristic'
+
+    def count(self, text):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return estimate_tokens(text)
+
+    # htmlの1行のトークン数。タグはマークダウンに変換すると消えるので数えない
+    def count_html(self, html):
+        return self.count(TAG_PATTERN.sub('', html))
@@ -0,0 +1,49 @@
+"""
+ヘルプ記事のurlの正規化。
+同じ記事でも'https://support.google.com//youtube/answer/13646088?hl=en'(スラッシュが2つ)や、
+ref_topicなどのパラメーターの有無で表記が揺れるので、answerのurlは記事ID(answer ID)だけを元に1つの形に揃える。
+1のmodify_url()と2の重複除去の両方で使う。http_cacheのキャッシュのキーも、ここのnormalize_url()で作る。
+"""
+
+import re
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+BASE_URL = 'https://support.google.com'
+ANSWER_ID_PATTERN = re.compile(r'/youtube/answer/(\d+)')
+# 正規化したurl(http_cacheのキー、重複判定のキー)に含めないクエリパラメーター。hlは言語として別に扱い、ref_topicはどのtopicから辿ったかを表すだけなので無視する
+IGNORED_QUERY_PARAMS = {'hl', 'ref_topic'}
+
+
+# スキームとホストを小文字に揃え、パスの連続したスラッシュ(modify_urlで作られる'//youtube/...'など)を1つにまとめ、
+# 無視するパラメーターとフラグメントを除いてクエリをソートする
+def normalize_url(url):
+    parsed = urlparse(url.strip())
+    path = '/'.join(part for part in parsed.path.split('/') if part)
+    query = sorted((k, v) for k, v in parse_qsl(parsed.query) if k not in IGNORED_QUERY_PARAMS)
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(), '/' + path, '', urlencode(query), ''))
+
+
+def url_language(url):
+    return dict(parse_qsl(urlparse(url).query)).get('hl', '')
+
+
+# answerのurlであれば記事IDを、そうでなければNoneを返す
+def answer_id(url):
+    match = ANSWER_ID_PATTERN.search(url)
+    return match.group(1) if match else None
+
+
+# 正規化したurlを返す。languageを省略した場合は元のurlのhlを使い、hlもなければ英語とする
+def canonical_url(url, language=None):
+    language = language or url_language(url) or 'en'
+    article_id = answer_id(url)
+    if article_id:
+        return f'{BASE_URL}/youtube/answer/{article_id}?hl={language}'
+    normalized = normalize_url(url)
+    return f"{normalized}{'&' if '?' in normalized else '?'}hl={language}"
+
+
+# 重複判定に使うキー。answerは記事IDだけで判定する
+def dedupe_key(url):
+    article_id = answer_id(url)
+    return f'answer:{article_id}' if article_id else normalize_url(url)